@@ -1,5 +1,7 @@
 from django.contrib import admin, messages
-from django.utils.translation import ngettext
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from catalogue.models import (
     Category,
@@ -8,8 +10,15 @@ from catalogue.models import (
     Product,
     ProductImage,
     ProductAttribute,
-    ProductAttributeValue
+    ProductAttributeValue,
+    AdminJob
 )
+from catalogue.cache import invalidate_products
+from catalogue.jobs import BackgroundActionMixin, job_action
+from catalogue.pagination import EstimatedCountPaginator
+from catalogue.search import get_search_engine
+
+ADMIN_SEARCH_LIMIT = 500
 
 
 class ProductAttributeInline(admin.TabularInline):
@@ -21,6 +30,12 @@ class ProductAttributeValueInline(admin.TabularInline):
     model = ProductAttributeValue
     extra = 1
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # Choice labels include the product type of each attribute
+        if db_field.name == 'product_attribute':
+            kwargs['queryset'] = ProductAttribute.objects.select_related('product_type')
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
 
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
@@ -33,40 +48,84 @@ class ProductTypeAdmin(admin.ModelAdmin):
 
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(BackgroundActionMixin, admin.ModelAdmin):
     inlines = (ProductAttributeValueInline, ProductImageInline)
     list_display = ('upc', 'title', 'product_type', 'quantity', 'category', 'brand', 'is_available')
-    list_filter = ('is_available', 'product_type__title')
+    list_select_related = ('product_type', 'category', 'brand')
+    # Choices of a related filter come from the small product type table, not from products
+    list_filter = ('is_available', 'product_type')
     list_editable = ('is_available',)
-    search_fields = ('upc', 'title', 'description', 'category__name', 'brand__name')
+    # Searched with the search engine, see get_search_results
+    search_fields = ('title',)
     prepopulated_fields = {'slug': ('title',)}
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     actions = ('make_is_available', 'make_is_unavailable')
 
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Exact UPC or the indexed search of the catalogue instead of icontains on every
+        column. Only the best ADMIN_SEARCH_LIMIT matches are listed, the user is told
+        when there are more.
+        """
+        if not search_term.strip():
+            return queryset, False
+        products = get_search_engine(queryset.db).search(
+            search_term, queryset=queryset, limit=ADMIN_SEARCH_LIMIT + 1
+        )
+        if len(products) > ADMIN_SEARCH_LIMIT:
+            products = products[:ADMIN_SEARCH_LIMIT]
+            self.message_user(request, (
+                f'Only the {ADMIN_SEARCH_LIMIT} best matches of "{search_term}" are listed, '
+                'refine the search to see the others.'
+            ), messages.WARNING)
+        matches = Q(pk__in=[product.pk for product in products])
+        if search_term.strip().isdigit():
+            matches |= Q(upc=int(search_term))
+        return queryset.filter(matches), False
+
     @admin.action(description='Available selected products')
     def make_is_available(self, request, queryset):
-        updated = queryset.update(is_available=True)
-        self.message_user(request, ngettext(
-            '%d story was successfully marked as available.',
-            '%d stories were successfully marked as available.',
-            updated,
-        ) % updated, messages.SUCCESS)
+        self.run_in_background(request, 'set_product_availability', queryset, is_available=True)
 
     @admin.action(description='Unavailable selected products')
     def make_is_unavailable(self, request, queryset):
-        updated = queryset.update(is_available=False)
-        self.message_user(request, ngettext(
-            '%d story was successfully marked as unavailable.',
-            '%d stories were successfully marked as unavailable.',
-            updated,
-        ) % updated, messages.SUCCESS)
+        self.run_in_background(request, 'set_product_availability', queryset, is_available=False)
+
+
+@job_action('set_product_availability')
+def set_product_availability(product_ids, is_available):
+    Product.objects.filter(pk__in=product_ids).update(is_available=is_available, update_time=timezone.now())
+    transaction.on_commit(lambda: invalidate_products(product_ids))
 
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
     list_display = ('name', 'parent')
+    list_select_related = ('parent',)
 
 
 @admin.register(Brand)
 class BrandAdmin(admin.ModelAdmin):
     list_display = ('name', 'parent')
+    list_select_related = ('parent',)
+
+
+@admin.register(AdminJob)
+class AdminJobAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'action', 'model', 'status', 'progress', 'user', 'create_time', 'finish_time')
+    list_filter = ('status',)
+    list_select_related = ('user',)
+    exclude = ('object_ids',)
+    readonly_fields = (
+        'action', 'params', 'model', 'batch_size', 'status', 'total', 'processed', 'progress', 'error', 'user',
+        'create_time', 'start_time', 'finish_time', 'locked_until'
+    )
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(description='Progress')
+    def progress(self, job):
+        return f'{job.progress}%'
@@ -0,0 +1,178 @@
+import hashlib
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+
+from catalogue.models import Category, Product
+
+TAG_KEY = 'catalogue:tag:{tag}'
+RESPONSE_KEY = 'catalogue:response:{key}'
+HITS_KEY = 'catalogue:response:hits'
+MISSES_KEY = 'catalogue:response:misses'
+
+NAVBAR_TAG = 'navbar'
+PRODUCTS_TAG = 'products'
+# Listings with facet values of every brand
+FACETS_TAG = 'facets'
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOGUE_CACHE_ALIAS', 'default')]
+
+
+def get_tag_versions(tags):
+    """
+    Current version of every tag. A missing tag gets a new random version, so an
+    evicted tag can never match versions stored in older entries.
+    """
+    cache = get_cache()
+    keys = {TAG_KEY.format(tag=tag): tag for tag in tags}
+    versions = cache.get_many(keys)
+    missing = {key: uuid.uuid4().hex for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def invalidate_tags(tags):
+    """Expire every cached response tagged with any of tags, one cache round-trip"""
+    if tags:
+        get_cache().set_many({TAG_KEY.format(tag=tag): uuid.uuid4().hex for tag in tags}, timeout=None)
+
+
+def invalidate_tags_on_commit(tags):
+    """
+    invalidate_tags once the current transaction commits. Bumped earlier, a page
+    rendered meanwhile from the old committed rows would be stored under the new
+    versions and served until it times out.
+    """
+    tags = set(tags)
+    transaction.on_commit(lambda: invalidate_tags(tags))
+
+
+def category_products_tags(paths):
+    """Subtree listings of every category on paths contain products of the category"""
+    return {
+        f'category-products:{pk}' for path in paths for pk in path.split(Category.PATH_SEPARATOR) if pk
+    }
+
+
+def product_tags(products):
+    """Tags of pages showing products, products are (pk, category_id, brand_id) rows"""
+    products = list(products)
+    paths = Category.objects.filter(pk__in={row[1] for row in products}).values_list('path', flat=True)
+
+    tags = {PRODUCTS_TAG, *category_products_tags(paths)}
+    for pk, category_id, brand_id in products:
+        tags.update((f'product:{pk}', f'brand-products:{brand_id}'))
+    return tags
+
+
+def product_ids_tags(product_ids):
+    """product_tags of products by pk, two queries whatever the number of products"""
+    return product_tags(Product.objects.filter(pk__in=product_ids).values_list('pk', 'category_id', 'brand_id'))
+
+
+def invalidate_product_rows(products):
+    invalidate_tags(product_tags(products))
+
+
+def invalidate_products(product_ids):
+    """Expire pages showing products, two queries whatever the number of products"""
+    invalidate_tags(product_ids_tags(product_ids))
+
+
+def product_detail_tags(product):
+    tags = [NAVBAR_TAG, f'product:{product.pk}', f'brand:{product.brand_id}']
+    tags += [f'category:{pk}' for pk in product.category.ancestor_ids]
+    tags += [f'partner:{offer.partner_id}' for offer in getattr(product, 'offers', [])]
+    return tags
+
+
+def category_page_tags(category):
+    tags = [NAVBAR_TAG, FACETS_TAG, f'category-products:{category.pk}']
+    return tags + [f'category:{pk}' for pk in category.ancestor_ids]
+
+
+def brand_page_tags(brand):
+    return [NAVBAR_TAG, f'brand:{brand.pk}', f'brand-products:{brand.pk}']
+
+
+def product_list_tags():
+    return [NAVBAR_TAG, FACETS_TAG, PRODUCTS_TAG]
+
+
+def get_cache_stats():
+    cache = get_cache()
+    stats = cache.get_many((HITS_KEY, MISSES_KEY))
+    hits, misses = stats.get(HITS_KEY, 0), stats.get(MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hits / (hits + misses) if hits + misses else 0,
+    }
+
+
+def reset_cache_stats():
+    get_cache().delete_many((HITS_KEY, MISSES_KEY))
+
+
+def _count(key):
+    cache = get_cache()
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+
+def cache_response(view):
+    """
+    Cache GET responses of view. The view sets response.cache_tags to the tags of
+    the rows it rendered; an entry is served only while all its tag versions are
+    unchanged, so a hit costs two cache lookups and no queries.
+
+    Stored versions are read before the view runs, so a row changed during the
+    render leaves the entry already stale. Tags of a page are only known after its
+    first render, that render stores them without content. Headers set by the view
+    are stored with the content, a hit returns the same response as a miss.
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        cache = get_cache()
+        key = RESPONSE_KEY.format(key=hashlib.md5(request.get_full_path().encode()).hexdigest())
+        entry = cache.get(key)
+        versions = get_tag_versions(entry['tags']) if entry is not None else {}
+        if entry is not None and entry['content'] is not None and versions == entry['tags']:
+            _count(HITS_KEY)
+            response = HttpResponse(entry['content'], status=entry['status'])
+            for header, value in entry['headers']:
+                response[header] = value
+            return response
+
+        _count(MISSES_KEY)
+        response = view(request, *args, **kwargs)
+        tags = getattr(response, 'cache_tags', None)
+        if tags and response.status_code == 200 and not response.streaming:
+            if versions.keys() >= set(tags):
+                entry = {
+                    'tags': {tag: versions[tag] for tag in tags},
+                    'content': response.content,
+                    'status': response.status_code,
+                    'headers': list(response.items()),
+                }
+            else:
+                entry = {'tags': dict.fromkeys(tags), 'content': None}
+            cache.set(key, entry, timeout=getattr(settings, 'CATALOGUE_CACHE_TIMEOUT', 600))
+        return response
+
+    return wrapper
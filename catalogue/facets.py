@@ -0,0 +1,365 @@
+import threading
+import uuid
+from collections import OrderedDict, defaultdict
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.text import slugify
+
+from catalogue.models import Category, Product, ProductAttributeValue, ProductFacet
+
+FACET_EPOCH_KEY = 'catalogue:facets:epoch'
+FACET_VERSION_KEY = 'catalogue:facets:version'
+FACET_CHANGES_KEY = 'catalogue:facets:{epoch}:{version}'
+CHANGES_TIMEOUT = 60 * 60 * 24
+# Bigger changes are recorded as a full reload
+MAX_CHANGED_PRODUCTS = 10000
+PRICE_PARAMS = ('price_min', 'price_max')
+CHUNK_SIZE = 1000
+CACHE_SIZE = 256
+
+
+def attribute_facet(attribute):
+    return f'{ProductFacet.ATTRIBUTE_PREFIX}{slugify(attribute.title)}'
+
+
+def is_facet(name):
+    return name in (ProductFacet.BRAND, ProductFacet.CATEGORY) or name.startswith(ProductFacet.ATTRIBUTE_PREFIX)
+
+
+def _new_epoch():
+    epoch = uuid.uuid4().hex
+    cache.set_many({FACET_EPOCH_KEY: epoch, FACET_VERSION_KEY: 0}, timeout=None)
+    return epoch, 0
+
+
+def get_facet_version():
+    """
+    (epoch, version) of facet rows. Every recorded change increments version, a new
+    epoch (the cache was cleared or lost the counter) makes every process reload.
+    """
+    versions = cache.get_many((FACET_EPOCH_KEY, FACET_VERSION_KEY))
+    if len(versions) < 2:
+        return _new_epoch()
+    return versions[FACET_EPOCH_KEY], versions[FACET_VERSION_KEY]
+
+
+def _record_changes(product_ids):
+    epoch = cache.get(FACET_EPOCH_KEY)
+    try:
+        version = cache.incr(FACET_VERSION_KEY)
+    except ValueError:
+        version = None
+    if epoch is None or version is None:
+        _new_epoch()
+        return
+    changes = product_ids if len(product_ids) <= MAX_CHANGED_PRODUCTS else None
+    cache.set(FACET_CHANGES_KEY.format(epoch=epoch, version=version), changes, timeout=CHANGES_TIMEOUT)
+
+
+def mark_products_changed(product_ids):
+    """
+    Record that facet rows or best price of products changed. Processes apply the
+    change to their index on next use, once the current transaction has committed.
+    """
+    product_ids = list(product_ids)
+    if product_ids:
+        transaction.on_commit(lambda: _record_changes(product_ids))
+
+
+def rebuild_product_facets(product_ids):
+    """Recompute facet rows of products, a fixed number of queries per chunk"""
+    product_ids = list(product_ids)
+    for i in range(0, len(product_ids), CHUNK_SIZE):
+        chunk = product_ids[i:i + CHUNK_SIZE]
+        products = list(Product.objects.filter(pk__in=chunk).select_related('brand', 'category'))
+
+        ancestor_ids = {pk for product in products for pk in product.category.ancestor_ids}
+        category_slugs = dict(Category.objects.filter(pk__in=ancestor_ids).values_list('pk', 'slug'))
+
+        facets = []
+        for product in products:
+            facets.append(ProductFacet(product=product, facet=ProductFacet.BRAND, value=product.brand.slug))
+            facets.extend(
+                ProductFacet(product=product, facet=ProductFacet.CATEGORY, value=category_slugs[pk])
+                for pk in product.category.ancestor_ids if pk in category_slugs
+            )
+        attribute_values = ProductAttributeValue.objects.filter(product_id__in=chunk).select_related(
+            'product_attribute'
+        )
+        facets.extend(
+            ProductFacet(
+                product_id=attribute_value.product_id,
+                facet=attribute_facet(attribute_value.product_attribute),
+                value=str(attribute_value.value)[:64]
+            )
+            for attribute_value in attribute_values
+        )
+
+        with transaction.atomic():
+            ProductFacet.objects.filter(product_id__in=chunk).delete()
+            ProductFacet.objects.bulk_create(facets, ignore_conflicts=True)
+    mark_products_changed(product_ids)
+
+
+def parse_filters(params):
+    """Facet filters {facet: [values]} and price range from query params"""
+    filters = {name: params.getlist(name) for name in params if is_facet(name) and params.getlist(name)}
+
+    price_range = []
+    for name in PRICE_PARAMS:
+        try:
+            price = Decimal(params[name]) if params.get(name) else None
+        except InvalidOperation:
+            price = None
+        # NaN and Infinity parse but can not be compared to prices, they are no bound either
+        price_range.append(price if price is not None and price.is_finite() else None)
+    return filters, tuple(price_range)
+
+
+def _bitmap(rows):
+    """Integer with the bits of rows set, built in one pass instead of one big int per row"""
+    rows = list(rows)
+    if not rows:
+        return 0
+    data = bytearray(max(rows) // 8 + 1)
+    for row in rows:
+        data[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(data, 'little')
+
+
+def _cached(entries, key, compute):
+    """Value of key in entries (an OrderedDict), computed on a miss, the last CACHE_SIZE keys are kept"""
+    try:
+        entries.move_to_end(key)
+        return entries[key]
+    except KeyError:
+        value = entries[key] = compute()
+        if len(entries) > CACHE_SIZE:
+            entries.popitem(last=False)
+        return value
+
+
+class FacetIndex:
+    """
+    In-memory bitmap per facet value over dense row numbers of this process (bit n
+    set = product of row n has the value) and the best price of every row, loaded
+    from ProductFacet rows. Size and counting time depend on the number of indexed
+    products, not on their pks. Counts and price masks are kept per query until
+    changed products are applied, which updates their rows in place.
+    """
+
+    def __init__(self):
+        self.rows = {}  # product id -> row
+        self.values = []  # row -> ((facet, value), ...)
+        self.prices = []  # row -> best price
+        self.free_rows = []
+        self.bitmaps = defaultdict(dict)
+        self.all = 0
+        self._lock = threading.RLock()
+        self._counts = OrderedDict()
+        self._price_masks = OrderedDict()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def load(cls):
+        index = cls()
+        values = defaultdict(list)
+        rows = ProductFacet.objects.values_list('product_id', 'facet', 'value').iterator(chunk_size=10000)
+        for product_id, facet, value in rows:
+            values[product_id].append((facet, value))
+        prices = Product.objects.values_list('pk', 'best_price').iterator(chunk_size=10000)
+        prices = {pk: price for pk, price in prices if pk in values}
+
+        rows_of_value = defaultdict(list)
+        for row, (product_id, product_values) in enumerate(values.items()):
+            index.rows[product_id] = row
+            index.values.append(tuple(product_values))
+            index.prices.append(prices.get(product_id))
+            for facet_value in product_values:
+                rows_of_value[facet_value].append(row)
+        for (facet, value), value_rows in rows_of_value.items():
+            index.bitmaps[facet][value] = _bitmap(value_rows)
+        index.all = (1 << len(index.values)) - 1
+        return index
+
+    def update(self, product_ids):
+        """Reload rows of products, two queries per chunk"""
+        product_ids = list(product_ids)
+        for i in range(0, len(product_ids), CHUNK_SIZE):
+            chunk = product_ids[i:i + CHUNK_SIZE]
+            values = defaultdict(list)
+            rows = ProductFacet.objects.filter(product_id__in=chunk).values_list('product_id', 'facet', 'value')
+            for product_id, facet, value in rows:
+                values[product_id].append((facet, value))
+            prices = dict(Product.objects.filter(pk__in=chunk).values_list('pk', 'best_price'))
+
+            with self._lock:
+                for product_id in chunk:
+                    self._set(product_id, values.get(product_id, ()), prices.get(product_id))
+                self._counts.clear()
+                self._price_masks.clear()
+
+    def _set(self, product_id, values, price):
+        row = self.rows.get(product_id)
+        if row is not None:
+            bit = 1 << row
+            for facet, value in self.values[row]:
+                bitmaps = self.bitmaps[facet]
+                bitmaps[value] &= ~bit
+                if not bitmaps[value]:
+                    del bitmaps[value]
+                    if not bitmaps:
+                        del self.bitmaps[facet]
+            self.all &= ~bit
+
+        if not values:
+            # Deleted product, its row is reused by the next new one
+            if row is not None:
+                del self.rows[product_id]
+                self.values[row], self.prices[row] = (), None
+                self.free_rows.append(row)
+            return
+
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                row = len(self.values)
+                self.values.append(())
+                self.prices.append(None)
+            self.rows[product_id] = row
+        bit = 1 << row
+        self.values[row], self.prices[row] = tuple(values), price
+        for facet, value in values:
+            bitmaps = self.bitmaps[facet]
+            bitmaps[value] = bitmaps.get(value, 0) | bit
+        self.all |= bit
+
+    def mask(self, filters, base=None, exclude=None):
+        """Products matching every facet filter, values of one facet are OR-ed"""
+        mask = self.all if base is None else base
+        for facet, values in filters.items():
+            if facet == exclude:
+                continue
+            bitmaps = self.bitmaps.get(facet, {})
+            facet_mask = 0
+            for value in values:
+                facet_mask |= bitmaps.get(value, 0)
+            mask &= facet_mask
+        return mask
+
+    def price_mask(self, price_min=None, price_max=None):
+        """Products with a best price in range"""
+        def compute():
+            return _bitmap(
+                row for row, price in enumerate(self.prices)
+                if price is not None and (price_min is None or price >= price_min)
+                and (price_max is None or price <= price_max)
+            )
+
+        with self._lock:
+            return _cached(self._price_masks, (price_min, price_max), compute)
+
+    def counts(self, filters, scope=None, price_range=(None, None)):
+        """
+        {facet: {value: count}} of products in scope (a (facet, value) pair) and price
+        range matching filters. Each facet is counted with the filters of the other
+        facets so selected values keep siblings. The result is shared, do not modify it.
+        """
+        def compute():
+            base = self.all
+            if scope:
+                base &= self.mask({scope[0]: [scope[1]]})
+            if any(price_range):
+                base &= self.price_mask(*price_range)
+
+            counts = {}
+            for facet, bitmaps in self.bitmaps.items():
+                mask = self.mask(filters, base=base, exclude=facet)
+                if not mask:
+                    continue
+                facet_counts = {value: (bitmap & mask).bit_count() for value, bitmap in bitmaps.items()}
+                facet_counts = {value: count for value, count in facet_counts.items() if count}
+                if facet_counts:
+                    counts[facet] = dict(sorted(facet_counts.items()))
+            return counts
+
+        key = (
+            tuple(sorted((facet, tuple(sorted(set(values)))) for facet, values in filters.items())),
+            scope,
+            tuple(price_range),
+        )
+        with self._lock:
+            return _cached(self._counts, key, compute)
+
+
+_facet_index = None  # (epoch, version, index)
+_facet_index_lock = threading.Lock()
+
+
+def _changed_products(epoch, start, end):
+    """Product ids changed after version start up to end, None when they are not all recorded"""
+    if end - start > CACHE_SIZE:
+        return None
+    keys = [FACET_CHANGES_KEY.format(epoch=epoch, version=version) for version in range(start + 1, end + 1)]
+    changes = cache.get_many(keys)
+    if len(changes) < len(keys) or None in changes.values():
+        # Evicted, not stored yet or too big
+        return None
+    return {product_id for product_ids in changes.values() for product_id in product_ids}
+
+
+def get_facet_index():
+    """
+    Facet index of this process. Changes recorded since it was built are applied to
+    it, it is reloaded for a new epoch or when the changes are not all recorded.
+    """
+    global _facet_index
+    epoch, version = get_facet_version()
+    with _facet_index_lock:
+        if _facet_index is not None and _facet_index[0] == epoch and _facet_index[1] < version:
+            index = _facet_index[2]
+            product_ids = _changed_products(epoch, _facet_index[1], version)
+            if product_ids is not None and len(product_ids) <= max(len(index), CHUNK_SIZE):
+                index.update(product_ids)
+                _facet_index = (epoch, version, index)
+
+        if _facet_index is None or _facet_index[:2] != (epoch, version):
+            _facet_index = (epoch, version, FacetIndex.load())
+        return _facet_index[2]
+
+
+def get_facets(request, filters, scope=None, price_range=(None, None)):
+    """
+    Facet values with counts and toggle urls for listing template.
+
+    scope limits counted products to a facet value (e.g. the category of the page),
+    price_range (min, max) to products with a best price in it.
+    """
+    index = get_facet_index()
+
+    facets = []
+    for facet, counts in index.counts(filters, scope=scope, price_range=price_range).items():
+        if scope and facet == scope[0]:
+            continue
+        values = []
+        for value, count in counts.items():
+            params = request.GET.copy()
+            params.pop('cursor', None)
+            selected = value in filters.get(facet, [])
+            selected_values = [v for v in params.getlist(facet) if v != value]
+            if not selected:
+                selected_values.append(value)
+            params.setlist(facet, selected_values)
+            values.append({
+                'value': value,
+                'count': count,
+                'selected': selected,
+                'url': f'{request.path}?{params.urlencode()}',
+            })
+        facets.append({'name': facet.replace(ProductFacet.ATTRIBUTE_PREFIX, ''), 'values': values})
+    return facets
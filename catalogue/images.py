@@ -0,0 +1,190 @@
+"""
+Derivatives of product images: every original is resized to fixed widths and
+encoded once per supported format (AVIF and WebP when Pillow can write them, JPEG
+always). Files are named by the hash of their content, so their urls never change
+meaning and can be cached forever.
+
+Decoding and encoding run in a process pool, the parent process only reads the
+originals and writes the results through the default storage. Derivatives no
+image refers to any more (the image was replaced or deleted) are deleted.
+"""
+import atexit
+import hashlib
+import logging
+import multiprocessing
+import operator
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+from PIL import Image
+
+from catalogue.cache import invalidate_tags
+from catalogue.imaging import render_derivatives
+from catalogue.jobs import job_action, submit_job
+from catalogue.models import ProductImage
+
+logger = logging.getLogger(__name__)
+
+WIDTHS = (160, 320, 640, 1280)
+# Preferred first, a browser takes the first <source> type it supports
+FORMATS = ('avif', 'webp', 'jpeg')
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg'}
+DERIVATIVE_DIR = 'products/derived'
+CHUNK_SIZE = 32
+
+_pool = None
+
+
+def get_widths():
+    return tuple(getattr(settings, 'CATALOGUE_IMAGE_WIDTHS', WIDTHS))
+
+
+def get_formats():
+    """Formats Pillow of this installation can write (AVIF needs a plugin, WebP libwebp)"""
+    Image.init()
+    return tuple(image_format for image_format in FORMATS if image_format.upper() in Image.SAVE)
+
+
+def create_pool(max_workers=None):
+    """
+    Process pool whose workers are started by a fork server (a fresh process where
+    available, spawned otherwise): forking this process would copy the locks of its
+    threads and its database connections in whatever state they are.
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+
+def get_pool():
+    """Pool of the process shared by background jobs, shut down at exit"""
+    global _pool
+    if _pool is None:
+        _pool = create_pool(getattr(settings, 'CATALOGUE_IMAGE_WORKERS', None))
+        atexit.register(shutdown_pool)
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def save_derivative(image_format, content):
+    digest = hashlib.sha256(content).hexdigest()[:20]
+    name = f'{DERIVATIVE_DIR}/{digest}.{EXTENSIONS[image_format]}'
+    if default_storage.exists(name):
+        # Same content, the existing file is the derivative
+        return name
+    return default_storage.save(name, ContentFile(content))
+
+
+def read_original(image):
+    with image.image.open('rb') as file:
+        return file.read()
+
+
+def build_derivatives(images, pool=None, chunk_size=CHUNK_SIZE):
+    """
+    Build derivatives of ProductImage rows on pool (in this process without one),
+    chunk_size originals in memory at a time. An image that can not be decoded is
+    logged and marked done with no derivatives. Return (built, failed) counts.
+    """
+    widths, formats = get_widths(), get_formats()
+    images = list(images)
+    built = failed = 0
+    for start in range(0, len(images), chunk_size):
+        chunk = [image for image in images[start:start + chunk_size] if image.image]
+        sources = [_call(read_original, image) for image in chunk]
+        if pool is None:
+            results = [
+                source if isinstance(source, Exception) else _call(render_derivatives, source, widths, formats)
+                for source in sources
+            ]
+        else:
+            futures = [
+                source if isinstance(source, Exception) else pool.submit(render_derivatives, source, widths, formats)
+                for source in sources
+            ]
+            results = [future if isinstance(future, Exception) else _call(future.result) for future in futures]
+
+        replaced = set()
+        for image, result in zip(chunk, results):
+            replaced.update(derivative['name'] for derivative in image.derivatives)
+            image.derivatives_source = image.image.name
+            if isinstance(result, Exception):
+                logger.warning('Can not build derivatives of image %s: %s', image.pk, result)
+                image.width = image.height = None
+                image.derivatives = []
+                failed += 1
+                continue
+            image.width, image.height, variants = result
+            image.derivatives = [
+                {'width': width, 'height': height, 'format': image_format, 'name': save_derivative(image_format, data)}
+                for width, height, image_format, data in variants
+            ]
+            built += 1
+
+        ProductImage.objects.bulk_update(chunk, fields=('width', 'height', 'derivatives', 'derivatives_source'))
+        tags = {f'product:{image.product_id}' for image in chunk}
+        transaction.on_commit(lambda tags=tags: invalidate_tags(tags))
+        transaction.on_commit(lambda replaced=replaced: delete_derivatives(replaced))
+    return built, failed
+
+
+def _call(function, *args):
+    # Failures of one image are returned, not raised, so the others are still built
+    try:
+        return function(*args)
+    except Exception as e:
+        return e
+
+
+def delete_derivatives(names):
+    """
+    Delete derivative files of names no image refers to. Files are content addressed,
+    images with identical originals share them. One query for all names.
+    """
+    names = set(names)
+    if not names:
+        return
+    in_use = reduce(operator.or_, (Q(derivatives__icontains=name) for name in names))
+    for derivatives in ProductImage.objects.filter(in_use).values_list('derivatives', flat=True):
+        names.difference_update(derivative['name'] for derivative in derivatives)
+    for name in names:
+        default_storage.delete(name)
+
+
+@job_action('build_image_derivatives')
+def build_image_derivatives(image_ids):
+    build_derivatives(ProductImage.objects.filter(pk__in=image_ids), pool=get_pool())
+
+
+def submit_derivatives(images):
+    """Build derivatives of images queryset rows that have none of their current image, in the background"""
+    images = images.exclude(image='').exclude(derivatives_source=F('image'))
+    if images.exists():
+        return submit_job('build_image_derivatives', images)
+    return None
+
+
+def srcset(image, image_format):
+    """srcset attribute value of the derivatives of image in image_format"""
+    return ', '.join(
+        f'{default_storage.url(derivative["name"])} {derivative["width"]}w'
+        for derivative in image.derivatives if derivative['format'] == image_format
+    )
+
+
+def fallback(image, width):
+    """Smallest JPEG derivative at least width wide, the largest one otherwise"""
+    derivatives = [derivative for derivative in image.derivatives if derivative['format'] == 'jpeg']
+    if not derivatives:
+        return None
+    return next((derivative for derivative in derivatives if derivative['width'] >= width), derivatives[-1])
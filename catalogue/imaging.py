@@ -0,0 +1,45 @@
+"""
+Resizing and encoding of product images. Runs in the worker processes of
+catalogue.images, which are started fresh (not forked from a process with
+threads and database connections), so this module only imports Pillow.
+"""
+import io
+
+from PIL import Image, ImageOps
+
+QUALITY = {'avif': 50, 'webp': 75, 'jpeg': 80}
+
+
+def prepare(image, image_format):
+    """Mode the format can store, transparency is kept except in JPEG where it becomes white"""
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    if image_format != 'jpeg':
+        return image.convert('RGBA' if has_alpha else 'RGB')
+    if not has_alpha:
+        return image.convert('RGB')
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, 'white')
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def render_derivatives(data, widths, formats):
+    """
+    Resize the original in data to widths (never larger than the original) and
+    encode every size in formats. Runs in worker processes, so it only uses Pillow.
+    Return (original width, original height, [(width, height, format, content)]).
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        original = ImageOps.exif_transpose(original)
+        original_width, original_height = original.size
+        variants = []
+        for width in sorted({min(width, original_width) for width in widths}):
+            height = max(1, round(original_height * width / original_width))
+            resized = original.resize((width, height), Image.LANCZOS) if width < original_width else original
+            for image_format in formats:
+                buffer = io.BytesIO()
+                prepare(resized, image_format).save(
+                    buffer, format=image_format.upper(), quality=QUALITY[image_format], optimize=True
+                )
+                variants.append((width, height, image_format, buffer.getvalue()))
+    return original_width, original_height, variants
@@ -0,0 +1,441 @@
+"""
+Streaming catalogue import and export.
+
+Records are flat dicts keyed by natural keys (slugs, UPC, titles, partner name), one
+kind of record per model, written as NDJSON lines ({"model": kind, ...}) or one CSV
+file per kind. Import reads records one at a time and writes them in chunks, so
+memory is bounded by the chunk size and the small lookup tables (types, attributes,
+categories, brands, partners), not by the file size.
+"""
+import csv
+import json
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from catalogue.cache import NAVBAR_TAG, invalidate_products, invalidate_tags
+from catalogue.facets import rebuild_product_facets
+from catalogue.images import submit_derivatives
+from catalogue.models import Brand, Category, Product, ProductAttribute, ProductAttributeValue, ProductImage, ProductType
+from catalogue.navbar import bump_navbar_version
+from catalogue.search import update_search_vectors
+from partner.models import Partner, PartnerStock
+
+CHUNK_SIZE = 1000
+MAX_ERRORS = 100
+
+# kind: (model, {record field: lookup}, ordering), in the order records can be imported
+EXPORTS = {
+    'product_type': (ProductType, {'title': 'title', 'description': 'description'}, ('pk',)),
+    'attribute': (
+        ProductAttribute,
+        {'product_type': 'product_type__title', 'title': 'title', 'attribute_type': 'attribute_type'},
+        ('pk',)
+    ),
+    'category': (Category, {'slug': 'slug', 'name': 'name', 'parent': 'parent__slug'}, ('path',)),
+    'brand': (Brand, {'slug': 'slug', 'name': 'name', 'parent': 'parent__slug'}, ('pk',)),
+    'product': (
+        Product,
+        {
+            'upc': 'upc', 'title': 'title', 'slug': 'slug', 'description': 'description',
+            'is_available': 'is_available', 'quantity': 'quantity', 'product_type': 'product_type__title',
+            'category': 'category__slug', 'brand': 'brand__slug',
+        },
+        ('pk',)
+    ),
+    'attribute_value': (
+        ProductAttributeValue,
+        {
+            'product': 'product__upc', 'product_type': 'product_attribute__product_type__title',
+            'attribute': 'product_attribute__title', 'value': 'value',
+        },
+        ('pk',)
+    ),
+    'image': (ProductImage, {'product': 'product__upc', 'image': 'image'}, ('pk',)),
+    'stock': (PartnerStock, {'product': 'product__upc', 'partner': 'partner__name', 'price': 'price'}, ('pk',)),
+}
+KINDS = tuple(EXPORTS)
+
+
+class RecordError(ValueError):
+    pass
+
+
+def export_records(kinds=KINDS, chunk_size=CHUNK_SIZE):
+    """Yield (kind, record) of every row of kinds, read with server-side chunks"""
+    for kind in kinds:
+        model, fields, ordering = EXPORTS[kind]
+        rows = model.objects.order_by(*ordering).values_list(*fields.values())
+        for row in rows.iterator(chunk_size=chunk_size):
+            yield kind, dict(zip(fields, row))
+
+
+def write_ndjson(records, stream):
+    count = 0
+    for kind, record in records:
+        stream.write(json.dumps({'model': kind, **record}, cls=DjangoJSONEncoder) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(kind, stream, chunk_size=CHUNK_SIZE):
+    writer = csv.DictWriter(stream, fieldnames=list(EXPORTS[kind][1]))
+    writer.writeheader()
+    count = 0
+    for _, record in export_records((kind,), chunk_size=chunk_size):
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+def read_ndjson(stream):
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            kind = record.pop('model')
+        except (ValueError, KeyError, AttributeError):
+            yield None, {'line': line_number}
+            continue
+        yield kind, record
+
+
+def read_csv(kind, stream):
+    for record in csv.DictReader(stream):
+        yield kind, record
+
+
+class CatalogueImporter:
+    """
+    Upsert records chunk by chunk. A chunk of one kind is matched against existing
+    rows with one query and written with one bulk_update and one bulk_create, then
+    derived data of touched products (search vector, facets, offer summary, cached
+    pages) is recomputed with a fixed number of statements.
+    """
+
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.stats = defaultdict(lambda: {'created': 0, 'updated': 0, 'errors': 0})
+        self.errors = []
+        self._lookups = {}
+        self._category_parents = {}
+        self._brand_parents = {}
+        self._imported_categories = set()
+        self._imported_brands = set()
+
+    def run(self, records):
+        chunk, chunk_kind = [], None
+        for kind, record in records:
+            if kind != chunk_kind or len(chunk) >= self.chunk_size:
+                self._import_chunk(chunk_kind, chunk)
+                chunk, chunk_kind = [], kind
+            chunk.append(record)
+        self._import_chunk(chunk_kind, chunk)
+        self._finish()
+        return dict(self.stats)
+
+    def error(self, kind, record, message):
+        self.stats[kind]['errors'] += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f'{kind} {record}: {message}')
+
+    # Lookup maps of small tables, loaded once
+
+    def lookup(self, name):
+        if name not in self._lookups:
+            self._lookups[name] = {
+                'product_type': lambda: {t.title: t for t in ProductType.objects.all()},
+                'attribute': lambda: {
+                    (a.product_type.title, a.title): a for a in ProductAttribute.objects.select_related('product_type')
+                },
+                'category': lambda: dict(Category.objects.values_list('slug', 'pk')),
+                'brand': lambda: dict(Brand.objects.values_list('slug', 'pk')),
+                'partner': lambda: dict(Partner.objects.values_list('name', 'pk')),
+            }[name]()
+        return self._lookups[name]
+
+    def resolve(self, name, key):
+        try:
+            return self.lookup(name)[key]
+        except KeyError:
+            raise RecordError(f'unknown {name} "{key}"')
+
+    def product_ids(self, records):
+        upcs = set()
+        for record in records:
+            try:
+                upcs.add(int(record['product']))
+            except (KeyError, TypeError, ValueError):
+                pass
+        return dict(Product.objects.filter(upc__in=upcs).values_list('upc', 'pk'))
+
+    @staticmethod
+    def product_id(record, products):
+        try:
+            return products[int(record['product'])]
+        except (KeyError, TypeError, ValueError):
+            raise RecordError(f'unknown product "{record.get("product")}"')
+
+    @staticmethod
+    def value(model, name, record):
+        """Record value converted like a form field (CSV gives strings), default of field when missing"""
+        field = model._meta.get_field(name)
+        value = record[name] if name in record else field.get_default()
+        if value == '' and field.null:
+            return None
+        try:
+            value = field.to_python(value)
+        except ValidationError as e:
+            raise RecordError(f'{name}: {" ".join(e.messages)}')
+        if value is None and not field.null:
+            raise RecordError(f'missing {name}')
+        return value
+
+    # Chunks
+
+    def _import_chunk(self, kind, records):
+        if not records:
+            return
+        if kind not in EXPORTS:
+            for record in records:
+                self.error(kind, record, 'unknown record model')
+            return
+
+        instances = []
+        products = self.product_ids(records) if 'product' in EXPORTS[kind][1] else {}
+        for record in records:
+            try:
+                instances.append(getattr(self, f'_build_{kind}')(record, products))
+            except RecordError as e:
+                self.error(kind, record, e)
+            except KeyError as e:
+                self.error(kind, record, f'missing {e}')
+
+        created, updated = getattr(self, f'_write_{kind}')(instances)
+        self.stats[kind]['created'] += len(created)
+        self.stats[kind]['updated'] += len(updated)
+
+    def upsert(self, kind, model, instances, key, fields):
+        """
+        Update instances whose key fields match an existing row, create the others.
+        When the chunk breaks a constraint, rows are written one by one and the
+        failing ones are reported. Return (created, updated) instances.
+        """
+        by_key = {tuple(getattr(instance, field) for field in key): instance for instance in instances}
+        candidates = model.objects.filter(**{f'{key[0]}__in': {k[0] for k in by_key}})
+        existing = {tuple(row[1:]): row[0] for row in candidates.values_list('pk', *key)}
+
+        created, updated = [], []
+        now = timezone.now()
+        for k, instance in by_key.items():
+            if k in existing:
+                instance.pk = existing[k]
+                if hasattr(instance, 'update_time'):
+                    instance.update_time = now
+                updated.append(instance)
+            else:
+                created.append(instance)
+
+        if hasattr(model, 'update_time'):
+            fields = (*fields, 'update_time')
+
+        def write(created, updated):
+            with transaction.atomic():
+                if updated and fields:
+                    model.objects.bulk_update(updated, fields=fields, batch_size=self.chunk_size)
+                model.objects.bulk_create(created, batch_size=self.chunk_size)
+
+        try:
+            write(created, updated)
+        except IntegrityError:
+            written = ([], [])
+            for instance in created + updated:
+                row = ([instance], []) if instance.pk is None else ([], [instance])
+                try:
+                    write(*row)
+                except IntegrityError as e:
+                    self.error(kind, {field: getattr(instance, field) for field in key}, e)
+                    continue
+                written[0].extend(row[0])
+                written[1].extend(row[1])
+            created, updated = written
+        return created, updated
+
+    def _build_product_type(self, record, products):
+        return ProductType(title=record['title'], description=self.value(ProductType, 'description', record))
+
+    def _write_product_type(self, instances):
+        created, updated = self.upsert('product_type', ProductType, instances, ('title',), ('description',))
+        self._lookups.pop('product_type', None)
+        return created, updated
+
+    def _build_attribute(self, record, products):
+        return ProductAttribute(
+            product_type=self.resolve('product_type', record['product_type']),
+            title=record['title'],
+            attribute_type=self.value(ProductAttribute, 'attribute_type', record)
+        )
+
+    def _write_attribute(self, instances):
+        previous_types = {
+            key: attribute.attribute_type for key, attribute in self.lookup('attribute').items()
+        }
+        created, updated = self.upsert(
+            'attribute', ProductAttribute, instances, ('product_type_id', 'title'), ('attribute_type',)
+        )
+        for attribute in updated:
+            if previous_types.get((attribute.product_type.title, attribute.title)) != attribute.attribute_type:
+                ProductAttributeValue.retype_values(attribute)
+                self._refresh_products(Product.objects.filter(attribute_values__product_attribute=attribute))
+        self._lookups.pop('attribute', None)
+        return created, updated
+
+    def _build_category(self, record, products):
+        self._category_parents[record['slug']] = record.get('parent') or None
+        return Category(slug=record['slug'], name=record['name'])
+
+    def _write_category(self, instances):
+        created, updated = self.upsert('category', Category, instances, ('slug',), ('name',))
+        self._imported_categories.update(instance.slug for instance in created + updated)
+        self._lookups.pop('category', None)
+        return created, updated
+
+    def _build_brand(self, record, products):
+        self._brand_parents[record['slug']] = record.get('parent') or None
+        return Brand(slug=record['slug'], name=record['name'])
+
+    def _write_brand(self, instances):
+        created, updated = self.upsert('brand', Brand, instances, ('slug',), ('name',))
+        self._imported_brands.update(instance.slug for instance in created + updated)
+        self._lookups.pop('brand', None)
+        return created, updated
+
+    def _build_product(self, record, products):
+        product = Product(
+            product_type=self.resolve('product_type', record['product_type']),
+            category_id=self.resolve('category', record['category']),
+            brand_id=self.resolve('brand', record['brand']),
+        )
+        for field in ('upc', 'title', 'slug', 'description', 'is_available', 'quantity'):
+            setattr(product, field, self.value(Product, field, record))
+        return product
+
+    def _write_product(self, instances):
+        fields = ('title', 'slug', 'description', 'is_available', 'quantity', 'product_type', 'category', 'brand')
+        created, updated = self.upsert('product', Product, instances, ('upc',), fields)
+        self._refresh_products(Product.objects.filter(upc__in=[instance.upc for instance in instances]))
+        return created, updated
+
+    def _build_attribute_value(self, record, products):
+        attribute_value = ProductAttributeValue(
+            product_id=self.product_id(record, products),
+            product_attribute=self.resolve('attribute', (record['product_type'], record['attribute'])),
+            value=record['value']
+        )
+        try:
+            attribute_value.assign_typed_value()
+        except ValidationError as e:
+            raise RecordError(' '.join(e.messages))
+        return attribute_value
+
+    def _write_attribute_value(self, instances):
+        created, updated = self.upsert(
+            'attribute_value', ProductAttributeValue, instances,
+            ('product_id', 'product_attribute_id'), ('value', 'value_int', 'value_float')
+        )
+        self._refresh_products(Product.objects.filter(pk__in={instance.product_id for instance in instances}))
+        return created, updated
+
+    def _build_image(self, record, products):
+        return ProductImage(product_id=self.product_id(record, products), image=record['image'])
+
+    def _write_image(self, instances):
+        created, updated = self.upsert('image', ProductImage, instances, ('product_id', 'image'), ())
+        product_ids = {instance.product_id for instance in instances}
+        # bulk_create sends no post_save, new images get their derivatives here
+        submit_derivatives(ProductImage.objects.filter(product_id__in=product_ids))
+        invalidate_products(product_ids)
+        return created, updated
+
+    def _build_stock(self, record, products):
+        if record['partner'] not in self.lookup('partner'):
+            partner = Partner.objects.create(name=record['partner'])
+            self.lookup('partner')[partner.name] = partner.pk
+        return PartnerStock(
+            product_id=self.product_id(record, products),
+            partner_id=self.resolve('partner', record['partner']),
+            price=self.value(PartnerStock, 'price', record)
+        )
+
+    def _write_stock(self, instances):
+        created, updated = self.upsert('stock', PartnerStock, instances, ('product_id', 'partner_id'), ('price',))
+        product_ids = {instance.product_id for instance in instances}
+        Product.refresh_offer_summaries(Product.objects.filter(pk__in=product_ids))
+        invalidate_products(product_ids)
+        return created, updated
+
+    # Derived data
+
+    def _refresh_products(self, products):
+        """Search vector, facets and cached pages of products queryset, a chunk at a time"""
+        product_ids = products.order_by('pk').values_list('pk', flat=True).distinct()
+        last_pk = 0
+        while True:
+            chunk = list(product_ids.filter(pk__gt=last_pk)[:self.chunk_size])
+            if not chunk:
+                return
+            update_search_vectors(Product.objects.filter(pk__in=chunk))
+            rebuild_product_facets(chunk)
+            invalidate_products(chunk)
+            last_pk = chunk[-1]
+
+    def _set_parents(self, model, parents, name):
+        """
+        Parents are set after all rows of model exist, a parent may come after its
+        children. A parent that would make a cycle is reported and not set.
+        """
+        ids = self.lookup(name)
+        parent_of = dict(model.objects.values_list('pk', 'parent_id'))
+        instances = []
+        for slug, parent_slug in parents.items():
+            if slug not in ids:
+                continue
+            record = {'slug': slug, 'parent': parent_slug}
+            if parent_slug is not None and parent_slug not in ids:
+                self.error(name, record, f'unknown {name} "{parent_slug}"')
+                continue
+
+            pk, parent_id = ids[slug], ids.get(parent_slug)
+            ancestor_id = parent_id
+            while ancestor_id is not None and ancestor_id != pk:
+                ancestor_id = parent_of.get(ancestor_id)
+            if ancestor_id == pk:
+                self.error(name, record, f'{name} can not be moved under its own subtree')
+                continue
+            parent_of[pk] = parent_id
+            instances.append(model(pk=pk, parent_id=parent_id))
+        model.objects.bulk_update(instances, fields=('parent',), batch_size=self.chunk_size)
+
+    def _finish(self):
+        if not (self._category_parents or self._brand_parents):
+            return
+
+        self._set_parents(Category, self._category_parents, 'category')
+        self._set_parents(Brand, self._brand_parents, 'brand')
+        Category.rebuild_paths()
+        bump_navbar_version()
+        invalidate_tags([NAVBAR_TAG])
+
+        # Names and positions of categories and brands are part of product search vectors and facets, products
+        # written before the paths of their categories were built are refreshed here too
+        if self._imported_categories or self._imported_brands:
+            paths = Category.objects.filter(slug__in=self._imported_categories).values_list('path', flat=True)
+            in_subtree = Q(pk__in=[])
+            for path in paths:
+                in_subtree |= Q(category__path__startswith=path)
+            self._refresh_products(Product.objects.filter(in_subtree | Q(brand__slug__in=self._imported_brands)))
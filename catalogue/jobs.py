@@ -0,0 +1,141 @@
+"""
+Admin actions run in the background.
+
+An action is a function registered with job_action that processes one batch of
+row ids in one database transaction. Submitting an action stores the selected ids
+in an AdminJob row and runs the batches on a local thread pool, updating progress
+after each batch. A job left pending or running by a stopped process is resumed
+with the run_admin_jobs command once the lease of its worker expired.
+"""
+import logging
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import messages
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
+
+from catalogue.models import AdminJob
+
+logger = logging.getLogger(__name__)
+
+JOB_ACTIONS = {}
+
+_executor = None
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def get_lease():
+    """Time a worker owns a running job without finishing a batch"""
+    return timedelta(seconds=getattr(settings, 'ADMIN_JOB_LEASE', 300))
+
+
+def job_action(name):
+    """Register function(ids, **params) as the background action name"""
+    def decorator(function):
+        JOB_ACTIONS[name] = function
+        return function
+
+    return decorator
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'ADMIN_JOB_WORKERS', 2), thread_name_prefix='admin-job'
+        )
+    return _executor
+
+
+def submit_job(action, queryset, user=None, **params):
+    """
+    Store ids of queryset rows in a new job and run it on the thread pool once the
+    current transaction commits. Ids are read with one query, rows are not loaded.
+    """
+    if action not in JOB_ACTIONS:
+        raise ValueError(f'Unknown job action "{action}"')
+    object_ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+    job = AdminJob.objects.create(
+        action=action,
+        params=params,
+        model=queryset.model._meta.label_lower,
+        object_ids=object_ids,
+        batch_size=getattr(settings, 'ADMIN_JOB_BATCH_SIZE', 1000),
+        total=len(object_ids),
+        user=user,
+    )
+    transaction.on_commit(lambda: get_executor().submit(run_job_in_thread, job.pk))
+    return job
+
+
+def run_job_in_thread(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        # Connections of pool threads are not closed by the request cycle
+        connection.close()
+
+
+def run_job(job_id, resume=False):
+    """
+    Run batches of job not processed yet. The job is claimed with a conditional
+    update so only one worker runs it, resume also claims a running job whose lease
+    expired. Each batch renews the lease in its transaction, a batch of a worker
+    whose job was claimed by another one is rolled back and the worker stops.
+    """
+    now = timezone.now()
+    claimable = Q(status=AdminJob.PENDING)
+    if resume:
+        claimable |= Q(status=AdminJob.RUNNING) & (Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+    worker = uuid.uuid4().hex
+    claimed = AdminJob.objects.filter(claimable, pk=job_id).update(
+        status=AdminJob.RUNNING, start_time=now, worker=worker, locked_until=now + get_lease()
+    )
+    if not claimed:
+        return None
+    owned = AdminJob.objects.filter(pk=job_id, worker=worker)
+
+    job = AdminJob.objects.get(pk=job_id)
+    function = JOB_ACTIONS.get(job.action)
+    try:
+        if function is None:
+            raise ValueError(f'Unknown job action "{job.action}"')
+        for start in range(job.processed, job.total, job.batch_size):
+            batch = job.object_ids[start:start + job.batch_size]
+            with transaction.atomic():
+                function(batch, **job.params)
+                if not owned.update(processed=F('processed') + len(batch), locked_until=timezone.now() + get_lease()):
+                    raise LeaseLost
+            logger.info('Admin job %s: %s of %s rows processed', job.pk, start + len(batch), job.total)
+    except LeaseLost:
+        logger.warning('Admin job %s was claimed by another worker, batch rolled back', job.pk)
+        return None
+    except Exception:
+        logger.exception('Admin job %s failed', job.pk)
+        owned.update(status=AdminJob.FAILED, error=traceback.format_exc(), finish_time=timezone.now())
+    else:
+        owned.update(status=AdminJob.DONE, finish_time=timezone.now())
+    job.refresh_from_db()
+    return job
+
+
+class BackgroundActionMixin:
+    """ModelAdmin helper for actions that submit a job instead of changing rows in the request"""
+
+    def run_in_background(self, request, action, queryset, **params):
+        job = submit_job(action, queryset, user=request.user, **params)
+        url = reverse('admin:catalogue_adminjob_change', args=(job.pk,))
+        self.message_user(request, format_html(
+            'Job <a href="{}">#{}</a> started for {} rows, progress is shown on the job page.', url, job.pk, job.total
+        ), messages.SUCCESS)
+        return job
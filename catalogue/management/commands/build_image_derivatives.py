@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from catalogue.images import CHUNK_SIZE, build_derivatives, create_pool
+from catalogue.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = 'Build thumbnails and WebP/AVIF variants of product images in parallel'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild images that already have derivatives')
+        parser.add_argument('--workers', type=int, default=None, help='Worker processes, 0 builds in this process')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Images read per chunk')
+
+    def handle(self, *args, **options):
+        images = ProductImage.objects.exclude(image='').order_by('pk')
+        if not options['all']:
+            images = images.exclude(derivatives_source=F('image'))
+
+        pool = create_pool(options['workers']) if options['workers'] != 0 else None
+        built = failed = 0
+        last_pk = 0
+        try:
+            while True:
+                chunk = list(images.filter(pk__gt=last_pk)[:options['chunk_size']])
+                if not chunk:
+                    break
+                chunk_built, chunk_failed = build_derivatives(chunk, pool=pool, chunk_size=options['chunk_size'])
+                built, failed, last_pk = built + chunk_built, failed + chunk_failed, chunk[-1].pk
+                self.stdout.write(f'{built + failed} images, up to image {last_pk}')
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.stdout.write(self.style.SUCCESS(f'Built derivatives of {built} images, {failed} failed'))
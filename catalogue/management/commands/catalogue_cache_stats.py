@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from catalogue.cache import get_cache_stats, reset_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Show hit ratio of catalogue page cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset counters after showing them')
+
+    def handle(self, *args, **options):
+        stats = get_cache_stats()
+        self.stdout.write(f"hits: {stats['hits']} misses: {stats['misses']} hit ratio: {stats['hit_ratio']:.2%}")
+        if options['reset']:
+            reset_cache_stats()
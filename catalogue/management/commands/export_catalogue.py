@@ -0,0 +1,38 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catalogue.importexport import KINDS, CHUNK_SIZE, export_records, write_csv, write_ndjson
+
+
+class Command(BaseCommand):
+    help = 'Stream catalogue to NDJSON (a file or - for stdout) or CSV (one file per model in a directory)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file, - for stdout, or directory for CSV')
+        parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+        parser.add_argument('--model', action='append', choices=KINDS, help='Export only these models')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Rows fetched per query')
+
+    def handle(self, *args, **options):
+        kinds = [kind for kind in KINDS if kind in (options['model'] or KINDS)]
+        path, chunk_size = options['path'], options['chunk_size']
+
+        if options['format'] == 'csv':
+            if path == '-':
+                raise CommandError('CSV export needs a directory')
+            os.makedirs(path, exist_ok=True)
+            for kind in kinds:
+                with open(os.path.join(path, f'{kind}.csv'), 'w', newline='', encoding='utf-8') as stream:
+                    count = write_csv(kind, stream, chunk_size=chunk_size)
+                self.stderr.write(f'{kind}: {count}')
+            return
+
+        records = export_records(kinds, chunk_size=chunk_size)
+        if path == '-':
+            count = write_ndjson(records, sys.stdout)
+        else:
+            with open(path, 'w', encoding='utf-8') as stream:
+                count = write_ndjson(records, stream)
+        self.stderr.write(f'{count} records exported')
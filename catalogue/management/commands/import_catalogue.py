@@ -0,0 +1,46 @@
+import os
+import sys
+from contextlib import ExitStack
+from itertools import chain
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catalogue.importexport import KINDS, CHUNK_SIZE, CatalogueImporter, read_csv, read_ndjson
+
+
+class Command(BaseCommand):
+    help = 'Upsert catalogue from NDJSON (a file or - for stdin) or CSV (a file or a directory of <model>.csv)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file, - for stdin, CSV file or directory of CSV files')
+        parser.add_argument('--model', choices=KINDS, help='Model of a CSV file not named <model>.csv')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Records written per chunk')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        importer = CatalogueImporter(chunk_size=options['chunk_size'])
+
+        with ExitStack() as files:
+            if path == '-':
+                records = read_ndjson(sys.stdin)
+            elif os.path.isdir(path):
+                paths = [(kind, os.path.join(path, f'{kind}.csv')) for kind in KINDS]
+                records = chain.from_iterable(
+                    read_csv(kind, files.enter_context(open(csv_path, newline='', encoding='utf-8')))
+                    for kind, csv_path in paths if os.path.exists(csv_path)
+                )
+            elif path.endswith('.csv'):
+                kind = options['model'] or os.path.splitext(os.path.basename(path))[0]
+                if kind not in KINDS:
+                    raise CommandError(f'Model of {path} is unknown, use --model')
+                records = read_csv(kind, files.enter_context(open(path, newline='', encoding='utf-8')))
+            else:
+                records = read_ndjson(files.enter_context(open(path, encoding='utf-8')))
+            stats = importer.run(records)
+
+        for kind, counts in stats.items():
+            self.stdout.write(
+                f'{kind}: {counts["created"]} created, {counts["updated"]} updated, {counts["errors"]} errors'
+            )
+        for error in importer.errors:
+            self.stderr.write(error)
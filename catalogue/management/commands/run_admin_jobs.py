@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from catalogue.jobs import run_job
+from catalogue.models import AdminJob
+
+
+class Command(BaseCommand):
+    help = (
+        'Run admin jobs left pending or running (e.g. by a restarted server) whose lease expired, continuing after '
+        'processed rows'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('job_ids', nargs='*', type=int, help='Only these jobs')
+
+    def handle(self, *args, **options):
+        jobs = AdminJob.objects.filter(status__in=(AdminJob.PENDING, AdminJob.RUNNING)).order_by('pk')
+        if options['job_ids']:
+            jobs = jobs.filter(pk__in=options['job_ids'])
+
+        for job_id in jobs.values_list('pk', flat=True):
+            job = run_job(job_id, resume=True)
+            if job is None:
+                continue
+            if job.status == AdminJob.DONE:
+                self.stdout.write(self.style.SUCCESS(f'Job {job.pk} done, {job.processed} rows'))
+            else:
+                self.stdout.write(self.style.ERROR(f'Job {job.pk} failed after {job.processed} rows'))
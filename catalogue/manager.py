@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models import OuterRef, Subquery, Prefetch, Q
+
+from catalogue.pagination import KeysetPage, PAGE_SIZE
 
 
 class ProductQuerySet(models.QuerySet):
@@ -11,6 +14,96 @@ class ProductQuerySet(models.QuerySet):
     def join(self):
         return self.select_related('category', 'brand')
 
+    def in_category(self, category):
+        return self.filter(category__path__startswith=category.path)
+
+    def keyset_paginate(self, cursor=None, per_page=PAGE_SIZE):
+        return KeysetPage(self, cursor=cursor, per_page=per_page)
+
+    def filter_facets(self, filters):
+        """Products matching every facet filter {facet: [values]}"""
+        from catalogue.models import ProductFacet
+
+        qs = self
+        for facet, values in filters.items():
+            qs = qs.filter(pk__in=ProductFacet.objects.filter(facet=facet, value__in=values).values('product_id'))
+        return qs
+
+    @staticmethod
+    def _attribute_values(attribute, **lookups):
+        """Values of attribute filtered on its typed (indexed) column"""
+        from catalogue.models import ProductAttributeValue
+
+        field = ProductAttributeValue.typed_field(attribute.attribute_type)
+        lookups = {
+            f'{field}__{lookup}': ProductAttributeValue.parse_value(attribute.attribute_type, value)
+            for lookup, value in lookups.items() if value is not None
+        }
+        return ProductAttributeValue.objects.filter(product_attribute=attribute, **lookups)
+
+    def attribute_equals(self, attribute, value):
+        return self.filter(pk__in=self._attribute_values(attribute, exact=value).values('product_id'))
+
+    def attribute_range(self, attribute, value_min=None, value_max=None):
+        values = self._attribute_values(attribute, gte=value_min, lte=value_max)
+        return self.filter(pk__in=values.values('product_id'))
+
+    def order_by_attribute(self, attribute, descending=False):
+        from catalogue.models import ProductAttributeValue
+
+        field = ProductAttributeValue.typed_field(attribute.attribute_type)
+        value = self._attribute_values(attribute).filter(product_id=OuterRef('pk')).values(field)[:1]
+        qs = self.annotate(attribute_value=Subquery(value))
+        return qs.order_by('-attribute_value' if descending else 'attribute_value', 'pk')
+
+    def price_range(self, price_min=None, price_max=None):
+        qs = self
+        if price_min is not None:
+            qs = qs.filter(best_price__gte=price_min)
+        if price_max is not None:
+            qs = qs.filter(best_price__lte=price_max)
+        return qs
+
+    def for_detail(self, pk, slug):
+        """
+        Product by pk or UPC with category chain, brand, images, attributes and offers
+        loaded in a fixed number of queries (5), whatever the number of rows.
+        """
+        from catalogue.models import ProductAttributeValue
+
+        products = list(
+            self.select_related('category', 'brand', 'product_type')
+            .prefetch_related(
+                'images',
+                Prefetch(
+                    'attribute_values',
+                    queryset=ProductAttributeValue.objects.select_related('product_attribute').order_by('pk')
+                )
+            )
+            .with_offers()
+            .filter(Q(pk=pk) | Q(upc=pk), slug=slug)
+            .order_by('pk')[:2]
+        )
+        if not products:
+            return None
+
+        # pk takes precedence when another product has it as UPC
+        product = next((product for product in products if product.pk == pk), products[0])
+        product.get_category_list  # noqa: cache category chain (1 query)
+        return product
+
+    def with_offers(self):
+        """All offers of fetched products in one query, cheapest first, as product.offers"""
+        from partner.models import PartnerStock
+
+        return self.prefetch_related(
+            Prefetch(
+                'partners',
+                queryset=PartnerStock.objects.select_related('partner').order_by('price', 'pk'),
+                to_attr='offers'
+            )
+        )
+
 
 class ProductManager(models.Manager):
     def get_queryset(self):
@@ -24,3 +117,30 @@ class ProductManager(models.Manager):
 
     def join(self):
         return self.get_queryset().join()
+
+    def in_category(self, category):
+        return self.get_queryset().in_category(category)
+
+    def keyset_paginate(self, cursor=None, per_page=PAGE_SIZE):
+        return self.get_queryset().keyset_paginate(cursor=cursor, per_page=per_page)
+
+    def filter_facets(self, filters):
+        return self.get_queryset().filter_facets(filters)
+
+    def price_range(self, price_min=None, price_max=None):
+        return self.get_queryset().price_range(price_min, price_max)
+
+    def attribute_equals(self, attribute, value):
+        return self.get_queryset().attribute_equals(attribute, value)
+
+    def attribute_range(self, attribute, value_min=None, value_max=None):
+        return self.get_queryset().attribute_range(attribute, value_min, value_max)
+
+    def order_by_attribute(self, attribute, descending=False):
+        return self.get_queryset().order_by_attribute(attribute, descending)
+
+    def with_offers(self):
+        return self.get_queryset().with_offers()
+
+    def for_detail(self, pk, slug):
+        return self.get_queryset().for_detail(pk, slug)
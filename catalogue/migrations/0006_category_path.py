@@ -0,0 +1,40 @@
+# Generated by Django 3.2.9 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+def build_category_paths(apps, schema_editor):
+    Category = apps.get_model('catalogue', 'Category')
+    parents = dict(Category.objects.values_list('pk', 'parent_id'))
+
+    paths = {}
+
+    def build(pk):
+        if pk not in paths:
+            parent_id = parents[pk]
+            paths[pk] = (build(parent_id) if parent_id is not None else '') + f'{pk}/'
+        return paths[pk]
+
+    categories = [Category(pk=pk, path=build(pk), depth=build(pk).count('/') - 1) for pk in parents]
+    Category.objects.bulk_update(categories, fields=('path', 'depth'), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0005_alter_productimage_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(build_category_paths, migrations.RunPython.noop),
+    ]
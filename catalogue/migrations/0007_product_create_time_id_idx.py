@@ -0,0 +1,17 @@
+# Generated by Django 3.2.9 on 2026-10-18 06:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0006_category_path'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['-create_time', '-id'], name='product_create_time_id_idx'),
+        ),
+    ]
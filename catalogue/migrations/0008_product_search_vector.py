@@ -0,0 +1,63 @@
+# Generated by Django 3.2.9 on 2026-10-18 11:02
+
+import django.contrib.postgres.search
+from django.db import migrations, transaction, DatabaseError
+
+
+def create_search_indexes(apps, schema_editor):
+    """GIN index on search vector and trigram index on title, PostgreSQL only"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS product_search_vector_idx ON catalogue_product USING gin (search_vector)'
+    )
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except DatabaseError:
+        # Not available or not permitted, search works without the typo fallback
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS product_title_trgm_idx ON catalogue_product USING gin (title gin_trgm_ops)'
+    )
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS product_title_trgm_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS product_search_vector_idx')
+
+
+def build_search_vectors(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('''
+        UPDATE catalogue_product AS p SET search_vector =
+            setweight(to_tsvector('simple', coalesce(p.title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(b.name, '') || ' ' || coalesce(c.name, '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce((
+                SELECT string_agg(v.value, ' ') FROM catalogue_productattributevalue AS v WHERE v.product_id = p.id
+            ), '')), 'B') ||
+            setweight(to_tsvector('simple', coalesce(p.description, '')), 'C')
+        FROM catalogue_brand AS b, catalogue_category AS c
+        WHERE b.id = p.brand_id AND c.id = p.category_id
+    ''')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0007_product_create_time_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+        migrations.RunPython(build_search_vectors, migrations.RunPython.noop),
+    ]
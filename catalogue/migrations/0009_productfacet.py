@@ -0,0 +1,60 @@
+# Generated by Django 3.2.9 on 2026-10-18 11:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils.text import slugify
+
+
+def build_product_facets(apps, schema_editor):
+    Category = apps.get_model('catalogue', 'Category')
+    Product = apps.get_model('catalogue', 'Product')
+    ProductAttributeValue = apps.get_model('catalogue', 'ProductAttributeValue')
+    ProductFacet = apps.get_model('catalogue', 'ProductFacet')
+
+    category_slugs = dict(Category.objects.values_list('pk', 'slug'))
+    category_paths = dict(Category.objects.values_list('pk', 'path'))
+
+    facets = []
+    for product in Product.objects.select_related('brand').iterator():
+        facets.append(ProductFacet(product_id=product.pk, facet='brand', value=product.brand.slug))
+        facets.extend(
+            ProductFacet(product_id=product.pk, facet='category', value=category_slugs[int(pk)])
+            for pk in category_paths[product.category_id].split('/') if pk
+        )
+    facets.extend(
+        ProductFacet(
+            product_id=attribute_value.product_id,
+            facet=f'attr.{slugify(attribute_value.product_attribute.title)}',
+            value=attribute_value.value[:64]
+        )
+        for attribute_value in ProductAttributeValue.objects.select_related('product_attribute').iterator()
+    )
+    ProductFacet.objects.bulk_create(facets, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0008_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facet', models.CharField(max_length=64)),
+                ('value', models.CharField(max_length=64)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='facets', to='catalogue.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='productfacet',
+            index=models.Index(fields=['facet', 'value'], name='product_facet_value_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='productfacet',
+            unique_together={('product', 'facet', 'value')},
+        ),
+        migrations.RunPython(build_product_facets, migrations.RunPython.noop),
+    ]
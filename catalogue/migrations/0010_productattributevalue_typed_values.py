@@ -0,0 +1,56 @@
+# Generated by Django 3.2.9 on 2026-10-18 12:15
+
+from django.db import migrations, models
+
+INTEGER, FLOAT = 1, 3
+
+
+def fill_typed_values(apps, schema_editor):
+    ProductAttributeValue = apps.get_model('catalogue', 'ProductAttributeValue')
+
+    attribute_values = []
+    for attribute_value in ProductAttributeValue.objects.select_related('product_attribute').iterator():
+        attribute_type = attribute_value.product_attribute.attribute_type
+        try:
+            if attribute_type == INTEGER:
+                attribute_value.value_int = int(attribute_value.value.strip())
+            elif attribute_type == FLOAT:
+                attribute_value.value_float = float(attribute_value.value.strip())
+        except ValueError:
+            # Left empty, the row fails validation on its next edit
+            continue
+        attribute_values.append(attribute_value)
+    ProductAttributeValue.objects.bulk_update(attribute_values, fields=('value_int', 'value_float'), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0009_productfacet'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productattributevalue',
+            name='value_float',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='productattributevalue',
+            name='value_int',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='productattributevalue',
+            index=models.Index(fields=['product_attribute', 'value_int'], name='attribute_value_int_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productattributevalue',
+            index=models.Index(fields=['product_attribute', 'value_float'], name='attribute_value_float_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='productattributevalue',
+            index=models.Index(fields=['product_attribute', 'value'], name='attribute_value_str_idx'),
+        ),
+        migrations.RunPython(fill_typed_values, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.9 on 2026-10-18 13:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import OuterRef, Subquery, Max, Count
+from django.db.models.functions import Coalesce
+
+
+def fill_offer_summaries(apps, schema_editor):
+    Product = apps.get_model('catalogue', 'Product')
+    PartnerStock = apps.get_model('partner', 'PartnerStock')
+
+    stocks = PartnerStock.objects.filter(product=OuterRef('pk'))
+    best_stock = stocks.order_by('price', 'pk')
+    totals = stocks.order_by().values('product')
+    Product.objects.update(
+        best_price=Subquery(best_stock.values('price')[:1]),
+        best_partner=Subquery(best_stock.values('partner_id')[:1]),
+        max_price=Subquery(totals.annotate(max_price=Max('price')).values('max_price')),
+        offer_count=Coalesce(Subquery(totals.annotate(offer_count=Count('pk')).values('offer_count')), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('partner', '0001_initial'),
+        ('catalogue', '0010_productattributevalue_typed_values'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='best_partner',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='partner.partner'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='best_price',
+            field=models.DecimalField(blank=True, db_index=True, decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='max_price',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='offer_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_offer_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:18
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('catalogue', '0011_product_offer_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdminJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(max_length=64)),
+                ('params', models.JSONField(blank=True, default=dict)),
+                ('model', models.CharField(max_length=100)),
+                ('object_ids', models.JSONField(default=list)),
+                ('batch_size', models.PositiveIntegerField(default=1000)),
+                ('status', models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (2, 'Running'), (3, 'Done'), (4, 'Failed')], db_index=True, default=1)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('create_time', models.DateTimeField(auto_now_add=True)),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('finish_time', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='admin_jobs', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0013_productimage_derivatives'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adminjob',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='adminjob',
+            name='worker',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+    ]
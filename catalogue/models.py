@@ -1,4 +1,11 @@
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.search import SearchVectorField
+from django.core.exceptions import ValidationError
+from django.apps import apps
+from django.db import models, transaction
+from django.db.models import F, Value, OuterRef, Subquery, Max, Count
+from django.db.models.functions import Concat, Substr, Coalesce
+from django.utils.functional import cached_property
 
 from catalogue.manager import ProductManager
 
@@ -44,6 +51,8 @@ class ProductAttribute(models.Model):
 
 
 class Category(models.Model):
+    PATH_SEPARATOR = '/'
+
     name = models.CharField(max_length=32)
     slug = models.SlugField(max_length=32, unique=True)
     parent = models.ForeignKey(
@@ -53,6 +62,8 @@ class Category(models.Model):
         blank=True,
         null=True
     )
+    path = models.CharField(max_length=255, db_index=True, editable=False, default='')
+    depth = models.PositiveSmallIntegerField(editable=False, default=0)
 
     create_time = models.DateTimeField(auto_now_add=True)
     update_time = models.DateTimeField(auto_now=True)
@@ -68,13 +79,79 @@ class Category(models.Model):
         from django.urls import reverse
         return reverse(viewname='catalogue:category-product-list', kwargs={'pk': self.pk, 'slug': self.slug})
 
+    def save(self, *args, **kwargs):
+        """
+        Save category and keep materialized path of it and its subtree in sync.
+        Paths are already up to date when post_save receivers run.
+        """
+        with transaction.atomic():
+            if self.pk is None:
+                super().save(*args, **kwargs)
+                parent_path = Category.objects.filter(pk=self.parent_id).values_list('path', flat=True).first()
+                self.path = f'{parent_path or ""}{self.pk}{self.PATH_SEPARATOR}'
+                self.depth = self.path.count(self.PATH_SEPARATOR) - 1
+                Category.objects.filter(pk=self.pk).update(path=self.path, depth=self.depth)
+                return
+
+            paths = dict(Category.objects.filter(pk__in=(self.pk, self.parent_id)).values_list('pk', 'path'))
+            old_path = paths.get(self.pk, '')
+            new_path = f'{paths.get(self.parent_id, "")}{self.pk}{self.PATH_SEPARATOR}'
+            new_depth = new_path.count(self.PATH_SEPARATOR) - 1
+
+            if old_path and new_path != old_path:
+                if new_path.startswith(old_path):
+                    raise ValueError('Category can not be moved under its own subtree')
+
+                # Move the whole subtree in one statement by replacing the old prefix with the new one
+                Category.objects.filter(path__startswith=old_path).update(
+                    path=Concat(Value(new_path), Substr('path', len(old_path) + 1)),
+                    depth=F('depth') + (new_depth - (old_path.count(self.PATH_SEPARATOR) - 1))
+                )
+            self.previous_path = old_path
+            self.path, self.depth = new_path, new_depth
+            super().save(*args, **kwargs)
+
+    @classmethod
+    def rebuild_paths(cls):
+        """Rebuild materialized path of all categories (after bulk writes)"""
+        parents = dict(cls.objects.values_list('pk', 'parent_id'))
+
+        paths = {}
+
+        def build(pk):
+            if pk not in paths:
+                parent_id = parents[pk]
+                paths[pk] = (build(parent_id) if parent_id is not None else '') + f'{pk}{cls.PATH_SEPARATOR}'
+            return paths[pk]
+
+        categories = [
+            cls(pk=pk, path=build(pk), depth=build(pk).count(cls.PATH_SEPARATOR) - 1) for pk in parents
+        ]
+        cls.objects.bulk_update(categories, fields=('path', 'depth'), batch_size=500)
+
+    @property
+    def ancestor_ids(self):
+        return [int(pk) for pk in self.path.split(self.PATH_SEPARATOR) if pk]
+
+    def get_descendants(self, include_self=True):
+        """All categories of subtree in one query"""
+        qs = Category.objects.filter(path__startswith=self.path)
+        if not include_self:
+            qs = qs.exclude(pk=self.pk)
+        return qs.order_by('path')
+
+    def get_ancestors(self, include_self=True):
+        """Chain of categories from root to this category in one query"""
+        ancestor_ids = self.ancestor_ids if include_self else self.ancestor_ids[:-1]
+        return Category.objects.filter(pk__in=ancestor_ids).order_by('depth')
+
+    def get_products(self):
+        """All products under subtree of category in one query"""
+        return Product.objects.in_category(self)
+
     @property
     def get_children_category(self):
-        children = list(self.children.all())
-        yield self
-        for child in children:
-            for _ in child.get_children_category:
-                yield _
+        return self.get_descendants()
 
 
 class Brand(models.Model):
@@ -117,22 +194,67 @@ class Product(models.Model):
         on_delete=models.PROTECT,
         related_name='products'
     )
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    # Offer summary, maintained from partner stocks
+    best_price = models.DecimalField(
+        max_digits=10, decimal_places=2, blank=True, null=True, db_index=True, editable=False
+    )
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, editable=False)
+    offer_count = models.PositiveIntegerField(default=0, editable=False)
+    best_partner = models.ForeignKey(
+        to='partner.Partner',
+        on_delete=models.SET_NULL,
+        related_name='+',
+        blank=True,
+        null=True,
+        editable=False
+    )
 
     objects = ProductManager()
 
     create_time = models.DateTimeField(auto_now_add=True)
     update_time = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = (
+            # Keyset pagination order of listings
+            models.Index(fields=('-create_time', '-id'), name='product_create_time_id_idx'),
+        )
+
     def __str__(self):
         return f'[{self.product_type}] - {self.title}'
 
-    @property
+    @classmethod
+    def refresh_offer_summaries(cls, products):
+        """Recompute offer summary of products queryset in one UPDATE"""
+        from catalogue.facets import mark_products_changed
+
+        PartnerStock = apps.get_model('partner', 'PartnerStock')
+
+        stocks = PartnerStock.objects.filter(product=OuterRef('pk'))
+        best_stock = stocks.order_by('price', 'pk')
+        totals = stocks.order_by().values('product')
+        products.update(
+            best_price=Subquery(best_stock.values('price')[:1]),
+            best_partner=Subquery(best_stock.values('partner_id')[:1]),
+            max_price=Subquery(totals.annotate(max_price=Max('price')).values('max_price')),
+            offer_count=Coalesce(Subquery(totals.annotate(offer_count=Count('pk')).values('offer_count')), 0),
+        )
+        # Best price is part of the facet index
+        mark_products_changed(products.values_list('pk', flat=True))
+
+    @cached_property
     def get_stock(self):
-        return self.partners.order_by('price').first()
+        if hasattr(self, 'offers'):
+            return self.offers[0] if self.offers else None
+        return self.partners.select_related('partner').order_by('price').first()
 
     @property
     def get_stocks(self):
-        return self.partners.prefetch_related('partner').exclude(partner_id=self.get_stock.partner.pk).order_by('price')
+        if hasattr(self, 'offers'):
+            return [offer for offer in self.offers if offer.partner_id != self.get_stock.partner_id]
+        return self.partners.select_related('partner').exclude(partner_id=self.get_stock.partner_id).order_by('price')
 
     @property
     def get_attributes(self):
@@ -146,15 +268,9 @@ class Product(models.Model):
         from django.urls import reverse
         return reverse(viewname='catalogue:product-detail', kwargs={'pk': self.pk, 'slug': self.slug})
 
-    @property
+    @cached_property
     def get_category_list(self):
-        category = self.category
-
-        category_list = []
-        while category is not None:
-            category_list.append(category)
-            category = category.parent
-        return category_list
+        return list(self.category.get_ancestors())[::-1]
 
 
 class ProductImage(models.Model):
@@ -165,9 +281,19 @@ class ProductImage(models.Model):
     )
     image = models.ImageField(upload_to='products/')
 
+    # Resized copies, built in the background from the image named derivatives_source
+    width = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    height = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    derivatives = models.JSONField(default=list, blank=True, editable=False)
+    derivatives_source = models.CharField(max_length=100, blank=True, editable=False)
+
     def __str__(self):
         return f'{self.product}'
 
+    @property
+    def has_derivatives(self):
+        return bool(self.derivatives) and self.derivatives_source == self.image.name
+
 
 class ProductAttributeValue(models.Model):
     product = models.ForeignKey(
@@ -181,9 +307,148 @@ class ProductAttributeValue(models.Model):
         related_name='attribute_values'
     )
     value = models.CharField(max_length=48)
+    value_int = models.BigIntegerField(blank=True, null=True, editable=False)
+    value_float = models.FloatField(blank=True, null=True, editable=False)
 
     create_time = models.DateTimeField(auto_now_add=True)
     update_time = models.DateTimeField(auto_now=True)
 
+    TYPED_FIELDS = {
+        ProductAttribute.INTEGER: 'value_int',
+        ProductAttribute.STRING: 'value',
+        ProductAttribute.FLOAT: 'value_float',
+    }
+    PARSERS = {
+        ProductAttribute.INTEGER: int,
+        ProductAttribute.STRING: str,
+        ProductAttribute.FLOAT: float,
+    }
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('product_attribute', 'value_int'), name='attribute_value_int_idx'),
+            models.Index(fields=('product_attribute', 'value_float'), name='attribute_value_float_idx'),
+            models.Index(fields=('product_attribute', 'value'), name='attribute_value_str_idx'),
+        )
+
     def __str__(self):
         return f'[{self.product}] - {self.product_attribute.title} : {self.value}'
+
+    @classmethod
+    def typed_field(cls, attribute_type):
+        return cls.TYPED_FIELDS[attribute_type]
+
+    @classmethod
+    def parse_value(cls, attribute_type, value):
+        """Value converted to python type of attribute, ValidationError if it does not fit"""
+        try:
+            return cls.PARSERS[attribute_type](str(value).strip())
+        except ValueError:
+            raise ValidationError(
+                {'value': f'"{value}" is not a valid {dict(ProductAttribute.ATTRIBUTE_TYPE_CHOICES)[attribute_type]}'}
+            )
+
+    @property
+    def typed_value(self):
+        return getattr(self, self.typed_field(self.product_attribute.attribute_type))
+
+    def assign_typed_value(self):
+        """Fill typed column from value, other typed columns are cleared"""
+        attribute_type = self.product_attribute.attribute_type
+        typed_value = self.parse_value(attribute_type, self.value)
+        self.value_int = typed_value if attribute_type == ProductAttribute.INTEGER else None
+        self.value_float = typed_value if attribute_type == ProductAttribute.FLOAT else None
+
+    @classmethod
+    def retype_values(cls, attribute):
+        """Refill typed columns after type of attribute has changed, invalid values are left empty"""
+        attribute_values = list(attribute.attribute_values.all())
+        for attribute_value in attribute_values:
+            attribute_value.product_attribute = attribute
+            try:
+                attribute_value.assign_typed_value()
+            except ValidationError:
+                attribute_value.value_int = attribute_value.value_float = None
+        cls.objects.bulk_update(attribute_values, fields=('value_int', 'value_float'), batch_size=1000)
+
+    def clean(self):
+        if self.product_attribute_id is not None:
+            self.assign_typed_value()
+
+    def save(self, *args, **kwargs):
+        self.assign_typed_value()
+        super().save(*args, **kwargs)
+
+
+class ProductFacet(models.Model):
+    """Denormalized (facet, value) pairs of product, source of the facet index"""
+    BRAND = 'brand'
+    CATEGORY = 'category'
+    ATTRIBUTE_PREFIX = 'attr.'
+
+    product = models.ForeignKey(
+        to=Product,
+        on_delete=models.CASCADE,
+        related_name='facets'
+    )
+    facet = models.CharField(max_length=64)
+    value = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('product', 'facet', 'value')
+        indexes = (
+            models.Index(fields=('facet', 'value'), name='product_facet_value_idx'),
+        )
+
+    def __str__(self):
+        return f'{self.product_id} - {self.facet}: {self.value}'
+
+
+class AdminJob(models.Model):
+    """
+    Admin action running in the background over selected rows, batch by batch.
+    processed counts rows of finished batches, a resumed job starts after them.
+    A running job is leased by its worker until locked_until, the lease is renewed
+    after each batch and only a job with an expired lease is resumed.
+    """
+    PENDING = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    action = models.CharField(max_length=64)
+    params = models.JSONField(default=dict, blank=True)
+    model = models.CharField(max_length=100)
+    object_ids = models.JSONField(default=list)
+    batch_size = models.PositiveIntegerField(default=1000)
+    status = models.PositiveSmallIntegerField(choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    total = models.PositiveIntegerField(default=0)
+    processed = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=32, blank=True, editable=False)
+    locked_until = models.DateTimeField(blank=True, null=True, editable=False)
+    user = models.ForeignKey(
+        to=settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        related_name='admin_jobs',
+        blank=True,
+        null=True
+    )
+
+    create_time = models.DateTimeField(auto_now_add=True)
+    start_time = models.DateTimeField(blank=True, null=True)
+    finish_time = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.action} - {self.get_status_display()} - {self.processed}/{self.total}'
+
+    @property
+    def progress(self):
+        return round(100 * self.processed / self.total) if self.total else 100
@@ -0,0 +1,50 @@
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+from catalogue.models import Category
+
+NAVBAR_VERSION_KEY = 'catalogue:category-navbar:version'
+NAVBAR_KEY = 'catalogue:category-navbar:{version}'
+
+
+def get_navbar_version():
+    return cache.get_or_set(NAVBAR_VERSION_KEY, 1, timeout=None)
+
+
+def bump_navbar_version():
+    """Invalidate rendered navbar, called on every category change"""
+    try:
+        cache.incr(NAVBAR_VERSION_KEY)
+    except ValueError:
+        cache.set(NAVBAR_VERSION_KEY, 1, timeout=None)
+
+
+def build_category_tree():
+    """
+    Load all categories in one query and link them as a tree. Rows are indexed
+    before children are attached, so the tree does not depend on depth being up
+    to date (e.g. after bulk writes, before paths are rebuilt).
+    """
+    categories = {}
+    for category in Category.objects.order_by('name', 'pk'):  # hit-1
+        category.tree_children = []
+        categories[category.pk] = category
+
+    nodes = []
+    for category in categories.values():
+        parent = categories.get(category.parent_id)
+        if parent is None:
+            nodes.append(category)
+        else:
+            parent.tree_children.append(category)
+    return nodes
+
+
+def render_category_navbar():
+    """Rendered navbar fragment, cached until category version changes"""
+    key = NAVBAR_KEY.format(version=get_navbar_version())
+    html = cache.get(key)
+    if html is None:
+        html = render_to_string('partials/category_navbar.html', {'parent_categories': build_category_tree()})
+        cache.set(key, html, timeout=None)
+    return html
@@ -0,0 +1,118 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+PAGE_SIZE = 20
+ESTIMATE_THRESHOLD = 10000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(create_time, pk):
+    data = json.dumps([create_time.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        create_time, pk = json.loads(data)
+        return datetime.fromisoformat(create_time), int(pk)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise InvalidCursor(f'Invalid cursor: {cursor}') from e
+
+
+class KeysetPage:
+    """
+    One page of a queryset ordered by (-create_time, -pk).
+
+    The next page starts after the last row of this page, so fetching it is an
+    index range scan no matter how deep the page is (no OFFSET).
+    """
+
+    def __init__(self, queryset, cursor=None, per_page=PAGE_SIZE):
+        queryset = queryset.order_by('-create_time', '-pk')
+        if cursor:
+            create_time, pk = decode_cursor(cursor)
+            queryset = queryset.filter(Q(create_time__lt=create_time) | Q(create_time=create_time, pk__lt=pk))
+
+        object_list = list(queryset[:per_page + 1])
+        self.has_next = len(object_list) > per_page
+        self.object_list = object_list[:per_page]
+        self.cursor = cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def next_cursor(self):
+        if not self.has_next:
+            return None
+        last = self.object_list[-1]
+        return encode_cursor(last.create_time, last.pk)
+
+    def next_page_url(self, request):
+        """Current url with cursor of next page, other query params are kept"""
+        if not self.has_next:
+            return None
+        params = request.GET.copy()
+        params['cursor'] = self.next_cursor
+        return f'{request.path}?{params.urlencode()}'
+
+
+def estimate_count(queryset):
+    """
+    Planner estimate of the number of rows of queryset (PostgreSQL only). An
+    unfiltered queryset reads reltuples of the table and its partitions from
+    pg_class, a filtered one the row estimate of its plan. None when unknown.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            table = queryset.model._meta.db_table
+            cursor.execute(
+                'SELECT SUM(reltuples) FROM pg_class WHERE reltuples >= 0 AND ('
+                'oid = %s::regclass OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass))',
+                [table, table]
+            )
+            estimate = cursor.fetchone()[0]
+            return None if estimate is None else int(estimate)
+
+        sql, params = queryset.order_by().values('pk').query.sql_with_params()
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    # psycopg2 decodes json, other drivers may return text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that trusts the planner estimate above threshold rows instead of
+    running COUNT(*), which reads the whole table or every matching row. Counts
+    below threshold stay exact.
+    """
+    threshold = ESTIMATE_THRESHOLD
+
+    @cached_property
+    def count(self):
+        if hasattr(self.object_list, 'query'):
+            estimate = estimate_count(self.object_list)
+            if estimate is not None and estimate > self.threshold:
+                return estimate
+        return super().count
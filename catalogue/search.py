@@ -0,0 +1,141 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db import connections
+from django.db.models import F
+
+from catalogue.models import Product
+
+SEARCH_CONFIG = 'simple'
+SEARCH_LIMIT = 50
+TRIGRAM_THRESHOLD = 0.3
+
+# Weights: A title, B brand/category names and attribute values, C description
+UPDATE_SEARCH_VECTOR_SQL = f'''
+UPDATE catalogue_product AS p SET search_vector =
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(p.title, '')), 'A') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(b.name, '') || ' ' || coalesce(c.name, '')), 'B') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce((
+        SELECT string_agg(v.value, ' ') FROM catalogue_productattributevalue AS v WHERE v.product_id = p.id
+    ), '')), 'B') ||
+    setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(p.description, '')), 'C')
+FROM catalogue_brand AS b, catalogue_category AS c
+WHERE b.id = p.brand_id AND c.id = p.category_id AND p.id IN ({{products}})
+'''
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def update_search_vectors(products):
+    """Recompute search vector of products queryset in one statement (PostgreSQL only)"""
+    connection = connections[products.db]
+    if connection.vendor != 'postgresql':
+        return
+    sql, params = products.values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(UPDATE_SEARCH_VECTOR_SQL.format(products=sql), params)
+
+
+def has_trigram_extension(connection):
+    if not hasattr(connection, '_has_pg_trgm'):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            connection._has_pg_trgm = cursor.fetchone() is not None
+    return connection._has_pg_trgm
+
+
+class PostgresSearchEngine:
+    """Ranked prefix search over the maintained search vector, trigram similarity on title for typos"""
+
+    def search(self, query, queryset=None, limit=SEARCH_LIMIT):
+        if queryset is None:
+            queryset = Product.objects.all()
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        search_query = SearchQuery(' & '.join(f'{term}:*' for term in terms), config=SEARCH_CONFIG, search_type='raw')
+        products = list(
+            queryset.annotate(rank=SearchRank(F('search_vector'), search_query))
+            .filter(search_vector=search_query)
+            .order_by('-rank', '-pk')[:limit]
+        )
+        if products or not has_trigram_extension(connections[queryset.db]):
+            return products
+
+        return list(
+            queryset.annotate(rank=TrigramSimilarity('title', ' '.join(terms)))
+            .filter(rank__gte=TRIGRAM_THRESHOLD)
+            .order_by('-rank', '-pk')[:limit]
+        )
+
+
+def trigrams(text):
+    """Trigrams of text the same way pg_trgm builds them"""
+    result = set()
+    for word in tokenize(text):
+        word = f'  {word} '
+        result.update(word[i:i + 3] for i in range(len(word) - 2))
+    return result
+
+
+def trigram_similarity(a, b):
+    a, b = trigrams(a), trigrams(b)
+    if not a or not b:
+        return 0
+    return len(a & b) / len(a | b)
+
+
+class InMemorySearchEngine:
+    """Pure-Python engine with the same semantics, used on databases without full-text search (SQLite)"""
+
+    WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.1}
+
+    def documents(self, queryset):
+        products = queryset.select_related('brand', 'category').prefetch_related('attribute_values')
+        for product in products:
+            yield product, (
+                ('A', tokenize(product.title)),
+                ('B', tokenize(f'{product.brand.name} {product.category.name}')),
+                ('B', [token for value in product.attribute_values.all() for token in tokenize(value.value)]),
+                ('C', tokenize(product.description)),
+            )
+
+    def rank(self, terms, document):
+        rank = 0
+        for term in terms:
+            weights = [self.WEIGHTS[weight] for weight, tokens in document if any(t.startswith(term) for t in tokens)]
+            if not weights:
+                return 0
+            rank += max(weights)
+        return rank
+
+    def search(self, query, queryset=None, limit=SEARCH_LIMIT):
+        if queryset is None:
+            queryset = Product.objects.all()
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        documents = list(self.documents(queryset))
+        results = [(self.rank(terms, document), product) for product, document in documents]
+        results = [(rank, product) for rank, product in results if rank]
+        if not results:
+            query = ' '.join(terms)
+            results = [(trigram_similarity(product.title, query), product) for product, _ in documents]
+            results = [(rank, product) for rank, product in results if rank >= TRIGRAM_THRESHOLD]
+
+        results.sort(key=lambda item: (item[0], item[1].pk), reverse=True)
+        products = []
+        for rank, product in results[:limit]:
+            product.rank = rank
+            products.append(product)
+        return products
+
+
+def get_search_engine(using='default'):
+    if connections[using].vendor == 'postgresql':
+        return PostgresSearchEngine()
+    return InMemorySearchEngine()
@@ -0,0 +1,137 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from catalogue.cache import (
+    FACETS_TAG,
+    NAVBAR_TAG,
+    category_products_tags,
+    invalidate_tags_on_commit,
+    product_ids_tags,
+    product_tags
+)
+from catalogue.images import delete_derivatives, submit_derivatives
+from catalogue.facets import rebuild_product_facets, mark_products_changed, attribute_facet
+from catalogue.models import (
+    Category,
+    Brand,
+    Product,
+    ProductAttribute,
+    ProductAttributeValue,
+    ProductFacet,
+    ProductImage
+)
+from catalogue.navbar import bump_navbar_version
+from catalogue.search import update_search_vectors
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, **kwargs):
+    bump_navbar_version()
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, **kwargs):
+    update_search_vectors(Product.objects.filter(pk=instance.pk))
+    rebuild_product_facets([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    mark_products_changed([instance.pk])
+
+
+@receiver(post_save, sender=ProductAttributeValue)
+def attribute_value_saved(sender, instance, **kwargs):
+    update_search_vectors(Product.objects.filter(pk=instance.product_id))
+    rebuild_product_facets([instance.product_id])
+
+
+@receiver(post_delete, sender=ProductAttributeValue)
+def attribute_value_deleted(sender, instance, **kwargs):
+    update_search_vectors(Product.objects.filter(pk=instance.product_id))
+    # Only remove rows here, the product itself may be in the middle of being deleted
+    ProductFacet.objects.filter(
+        product_id=instance.product_id, facet=attribute_facet(instance.product_attribute), value=instance.value[:64]
+    ).delete()
+    mark_products_changed([instance.product_id])
+
+
+@receiver(post_save, sender=ProductAttribute)
+def attribute_saved(sender, instance, created, **kwargs):
+    if not created:
+        ProductAttributeValue.retype_values(instance)
+    rebuild_product_facets(instance.attribute_values.values_list('product_id', flat=True))
+
+
+@receiver(post_save, sender=Brand)
+def brand_saved(sender, instance, **kwargs):
+    update_search_vectors(Product.objects.filter(brand=instance))
+    rebuild_product_facets(instance.products.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    if created:
+        # New category has no products yet
+        return
+    update_search_vectors(Product.objects.filter(category=instance))
+    rebuild_product_facets(Product.objects.in_category(instance).values_list('pk', flat=True))
+
+
+@receiver(pre_save, sender=Product)
+def product_saving(sender, instance, raw=False, **kwargs):
+    if instance.pk is not None and not raw:
+        instance.previous_row = Product.objects.filter(pk=instance.pk).values_list(
+            'pk', 'category_id', 'brand_id'
+        ).first()
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed_invalidate_cache(sender, instance, **kwargs):
+    rows = [(instance.pk, instance.category_id, instance.brand_id)]
+    if getattr(instance, 'previous_row', None):
+        rows.append(instance.previous_row)
+    invalidate_tags_on_commit(product_tags(rows))
+
+
+@receiver([post_save, post_delete], sender=ProductAttributeValue)
+def attribute_value_changed_invalidate_cache(sender, instance, **kwargs):
+    invalidate_tags_on_commit(product_ids_tags([instance.product_id]))
+
+
+@receiver(post_save, sender=ProductImage)
+def image_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        submit_derivatives(ProductImage.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=ProductImage)
+def image_deleted(sender, instance, **kwargs):
+    names = [derivative['name'] for derivative in instance.derivatives]
+    transaction.on_commit(lambda: delete_derivatives(names))
+
+
+@receiver([post_save, post_delete], sender=ProductImage)
+def image_changed_invalidate_cache(sender, instance, **kwargs):
+    invalidate_tags_on_commit([f'product:{instance.product_id}'])
+
+
+@receiver(post_save, sender=ProductAttribute)
+def attribute_changed_invalidate_cache(sender, instance, **kwargs):
+    invalidate_tags_on_commit(product_ids_tags(instance.attribute_values.values('product_id')))
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed_invalidate_cache(sender, instance, **kwargs):
+    tags = {NAVBAR_TAG, f'category:{instance.pk}'}
+    if getattr(instance, 'previous_path', instance.path) != instance.path:
+        # Moved, listings of old and new ancestors change
+        tags.update(category_products_tags([instance.previous_path, instance.path]))
+    invalidate_tags_on_commit(tags)
+
+
+@receiver([post_save, post_delete], sender=Brand)
+def brand_changed_invalidate_cache(sender, instance, **kwargs):
+    # Brand facet values are shown on every listing
+    invalidate_tags_on_commit([f'brand:{instance.pk}', FACETS_TAG])
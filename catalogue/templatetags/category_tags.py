@@ -1,15 +1,11 @@
 from django import template
+from django.utils.safestring import mark_safe
 
-from catalogue.models import Category
+from catalogue.navbar import render_category_navbar
 
 register = template.Library()
 
 
 @register.simple_tag
-def get_parent_category():
-    return Category.objects.filter(parent=None)
-
-
-@register.simple_tag
-def get_child_category(parent):
-    return Category.objects.filter(parent=parent)
+def category_navbar():
+    return mark_safe(render_category_navbar())
@@ -0,0 +1,39 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html, format_html_join
+
+from catalogue.images import FORMATS, fallback, srcset
+
+register = template.Library()
+
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+
+
+@register.filter(name='srcset')
+def srcset_filter(image, image_format='jpeg'):
+    return srcset(image, image_format)
+
+
+@register.simple_tag
+def product_picture(image, width=200, alt=''):
+    """
+    <picture> of a ProductImage shown width CSS pixels wide: one <source> per modern
+    format and a JPEG <img>, all with srcset so the browser downloads the smallest
+    file enough for its pixel density. Images without derivatives yet use the original.
+    """
+    if not image.has_derivatives or fallback(image, width) is None:
+        return format_html('<img src="{}" width="{}" alt="{}" loading="lazy">', image.image.url, width, alt)
+
+    src = fallback(image, width)
+    height = round(width * src['height'] / src['width'])
+    sizes = f'{width}px'
+    sources = format_html_join(
+        '', '<source type="{}" srcset="{}" sizes="{}">',
+        ((MIME_TYPES[image_format], srcset(image, image_format), sizes) for image_format in FORMATS
+         if image_format in MIME_TYPES and srcset(image, image_format))
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" width="{}" height="{}" alt="{}" loading="lazy" '
+        'decoding="async"></picture>',
+        sources, default_storage.url(src['name']), srcset(image, 'jpeg'), sizes, width, height, alt
+    )
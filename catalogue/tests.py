@@ -1,3 +1,1009 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User, Permission
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import QueryDict
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from catalogue.cache import cache_response, get_cache, get_cache_stats, invalidate_tags
+from catalogue.facets import get_facet_index, parse_filters
+from catalogue.images import build_derivatives, get_formats
+from catalogue.importexport import CatalogueImporter, export_records, read_csv, read_ndjson, write_csv, write_ndjson
+from catalogue.jobs import JOB_ACTIONS, job_action, run_job, submit_job
+from catalogue.navbar import build_category_tree, render_category_navbar
+from catalogue.models import Category, Brand, ProductType, ProductAttribute, ProductAttributeValue, Product, AdminJob, ProductImage
+from catalogue.models import ProductFacet
+from catalogue.pagination import PAGE_SIZE, EstimatedCountPaginator, InvalidCursor, decode_cursor, encode_cursor
+from catalogue.search import InMemorySearchEngine, get_search_engine
+from catalogue.views import product_detail_view
+from partner.models import Partner, PartnerStock
+from transaction.models import UserScore
+
+
+def create_products(upcs):
+    """Products Galaxy {upc} of upcs, in a Phone category, of Samsung brand and Mobile product type"""
+    category = Category.objects.create(name='Phone', slug='phone')
+    brand = Brand.objects.create(name='Samsung', slug='samsung')
+    product_type = ProductType.objects.create(title='Mobile')
+    return [
+        Product.objects.create(
+            product_type=product_type, upc=upc, title=f'Galaxy {upc}', slug=f'galaxy-{upc}', category=category,
+            brand=brand
+        )
+        for upc in upcs
+    ]
+
+
+class CategoryTreeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.digital = Category.objects.create(name='Digital', slug='digital')
+        cls.phone = Category.objects.create(name='Phone', slug='phone', parent=cls.digital)
+        cls.smart_phone = Category.objects.create(name='Smart Phone', slug='smart-phone', parent=cls.phone)
+        cls.home = Category.objects.create(name='Home', slug='home')
+
+    def tree(self):
+        return {slug: (path, depth) for slug, path, depth in Category.objects.values_list('slug', 'path', 'depth')}
+
+    def test_paths(self):
+        self.assertEqual(self.smart_phone.path, f'{self.digital.pk}/{self.phone.pk}/{self.smart_phone.pk}/')
+        self.assertEqual(self.smart_phone.depth, 2)
+        self.assertEqual(list(self.digital.get_descendants()), [self.digital, self.phone, self.smart_phone])
+        self.assertEqual(list(self.smart_phone.get_ancestors(include_self=False)), [self.digital, self.phone])
+
+    def test_move_subtree(self):
+        self.phone.parent = self.home
+        with CaptureQueriesContext(connection) as queries:
+            self.phone.save()
+        # Subtree is moved with one statement whatever its size
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE "catalogue_category"')]
+        self.assertEqual(len(updates), 2)
+
+        tree = self.tree()
+        self.assertEqual(tree['phone'], (f'{self.home.pk}/{self.phone.pk}/', 1))
+        self.assertEqual(tree['smart-phone'], (f'{self.home.pk}/{self.phone.pk}/{self.smart_phone.pk}/', 2))
+        self.assertEqual(list(self.digital.get_descendants(include_self=False)), [])
+
+        self.phone.parent = None
+        self.phone.save()
+        self.assertEqual(self.tree()['smart-phone'], (f'{self.phone.pk}/{self.smart_phone.pk}/', 1))
+
+    def test_move_under_own_subtree_is_rejected(self):
+        before = self.tree()
+        for parent in (self.smart_phone, self.phone):
+            self.phone.parent = parent
+            with self.assertRaises(ValueError):
+                self.phone.save()
+        self.assertEqual(self.tree(), before)
+        self.phone.refresh_from_db()
+        self.assertEqual(self.phone.parent, self.digital)
+
+    def test_rebuild_paths(self):
+        before = self.tree()
+        Category.objects.update(path='', depth=0)
+        Category.rebuild_paths()
+        self.assertEqual(self.tree(), before)
+
+
+class CategoryNavbarTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.digital = Category.objects.create(name='Digital', slug='digital')
+        cls.tablet = Category.objects.create(name='Tablet', slug='tablet', parent=cls.digital)
+        cls.phone = Category.objects.create(name='Phone', slug='phone', parent=cls.digital)
+        cls.book = Category.objects.create(name='Book', slug='book')
+
+    def setUp(self):
+        cache.clear()
+
+    def flatten(self, nodes):
+        return [(node.slug, self.flatten(node.tree_children)) for node in nodes]
+
+    def test_build_tree(self):
+        with self.assertNumQueries(1):
+            tree = build_category_tree()
+        self.assertEqual(self.flatten(tree), [('book', []), ('digital', [('phone', []), ('tablet', [])])])
+
+    def test_build_tree_with_stale_depth(self):
+        # Child sorted before its parent, as after a bulk import before paths are rebuilt
+        Category.objects.filter(pk=self.digital.pk).update(depth=5)
+        Category.objects.filter(pk__in=(self.phone.pk, self.tablet.pk)).update(depth=0)
+        self.assertEqual(
+            self.flatten(build_category_tree()), [('book', []), ('digital', [('phone', []), ('tablet', [])])]
+        )
+
+    def test_navbar_is_cached_until_category_changes(self):
+        html = render_category_navbar()
+        self.assertIn('Tablet', html)
+        with self.assertNumQueries(0):
+            self.assertEqual(render_category_navbar(), html)
+
+        self.tablet.name = 'Tablets'
+        self.tablet.save()
+        self.assertIn('Tablets', render_category_navbar())
+        self.phone.delete()
+        self.assertNotIn('Phone', render_category_navbar())
+
+
+class KeysetPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_products(range(7))
+        # Rows 2 to 5 share a create_time, pk breaks the tie
+        now = timezone.now()
+        Product.objects.filter(upc__in=(2, 3, 4, 5)).update(create_time=now)
+        Product.objects.filter(upc=6).update(create_time=now + timedelta(seconds=1))
+        cls.expected = list(Product.objects.order_by('-create_time', '-pk').values_list('upc', flat=True))
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_pages_follow_cursor(self):
+        upcs, cursor, pages = [], None, 0
+        while True:
+            page = Product.objects.keyset_paginate(cursor, per_page=2)
+            upcs.extend(product.upc for product in page)
+            pages += 1
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+            self.assertEqual(decode_cursor(cursor), (page.object_list[-1].create_time, page.object_list[-1].pk))
+
+        self.assertEqual(upcs, self.expected)
+        self.assertEqual(self.expected[:2], [6, 5])
+        self.assertEqual(pages, 4)
+        self.assertIsNone(page.next_cursor)
+
+    def test_invalid_cursor(self):
+        for cursor in ('not-a-cursor', encode_cursor(timezone.now(), 1)[:-3], 'WzFd', 'bnVsbA'):
+            with self.assertRaises(InvalidCursor):
+                Product.objects.keyset_paginate(cursor)
+        response = self.client.get('/catalogue/products/list/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_next_page_url_keeps_params(self):
+        response = self.client.get('/catalogue/products/list/', {'brand': 'samsung'})
+        page = response.context['products']
+        self.assertEqual([product.upc for product in page], self.expected[:PAGE_SIZE])
+        self.assertIsNone(response.context['next_page_url'])
+
+        request = RequestFactory().get('/catalogue/products/list/', {'brand': 'samsung'})
+        page = Product.objects.keyset_paginate(per_page=3)
+        self.assertEqual(
+            page.next_page_url(request), f'/catalogue/products/list/?brand=samsung&cursor={page.next_cursor}'
+        )
+
+
+class FacetIndexTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        digital = Category.objects.create(name='Digital', slug='digital')
+        phone = Category.objects.create(name='Phone', slug='phone', parent=digital)
+        tablet = Category.objects.create(name='Tablet', slug='tablet', parent=digital)
+        cls.samsung = Brand.objects.create(name='Samsung', slug='samsung')
+        cls.apple = Brand.objects.create(name='Apple', slug='apple')
+        product_type = ProductType.objects.create(title='Mobile')
+        color = ProductAttribute.objects.create(
+            title='Color', product_type=product_type, attribute_type=ProductAttribute.STRING
+        )
+        partner = Partner.objects.create(name='Digikala')
+
+        cls.products = {}
+        for upc, category, brand, value, price in (
+            (1, phone, cls.samsung, 'Black', 100),
+            (2, phone, cls.apple, 'White', 300),
+            (3, tablet, cls.samsung, 'Black', 200),
+            (4, tablet, cls.samsung, 'White', None),
+        ):
+            product = cls.products[upc] = Product.objects.create(
+                product_type=product_type, upc=upc, title=f'Product {upc}', slug=f'product-{upc}',
+                category=category, brand=brand
+            )
+            ProductAttributeValue.objects.create(product=product, product_attribute=color, value=value)
+            if price is not None:
+                PartnerStock.objects.create(product=product, partner=partner, price=price)
+
+    def setUp(self):
+        # New facet epoch, the index is reloaded from rows of this test
+        cache.clear()
+        get_cache().clear()
+
+    def test_counts(self):
+        index = get_facet_index()
+        self.assertEqual(sorted(index.rows.values()), [0, 1, 2, 3])
+        self.assertEqual(index.counts({}), {
+            'attr.color': {'Black': 2, 'White': 2},
+            'brand': {'apple': 1, 'samsung': 3},
+            'category': {'digital': 4, 'phone': 2, 'tablet': 2},
+        })
+
+    def test_filters_keep_sibling_values(self):
+        index = get_facet_index()
+        counts = index.counts({'brand': ['samsung'], 'attr.color': ['White']})
+        self.assertEqual(counts['brand'], {'apple': 1, 'samsung': 1})
+        self.assertEqual(counts['attr.color'], {'Black': 2, 'White': 1})
+        self.assertEqual(counts['category'], {'digital': 1, 'tablet': 1})
+
+        counts = index.counts({'category': ['phone', 'tablet']}, scope=('category', 'tablet'))
+        self.assertEqual(counts['brand'], {'samsung': 2})
+
+        products = Product.objects.filter_facets({'brand': ['samsung', 'apple'], 'attr.color': ['Black']})
+        self.assertEqual(sorted(products.values_list('upc', flat=True)), [1, 3])
+
+    def test_price_range(self):
+        index = get_facet_index()
+        counts = index.counts({}, price_range=(Decimal(150), None))
+        self.assertEqual(counts['brand'], {'apple': 1, 'samsung': 1})
+        counts = index.counts({}, scope=('category', 'phone'), price_range=(None, Decimal('100.00')))
+        self.assertEqual(counts['brand'], {'samsung': 1})
+        # Counts of a query are kept until products change
+        price_range = (Decimal(150), None)
+        self.assertIs(index.counts({}, price_range=price_range), index.counts({}, price_range=price_range))
+
+    def test_changes_are_applied_in_place(self):
+        index = get_facet_index()
+        index.counts({})
+
+        product = self.products[2]
+        with self.captureOnCommitCallbacks(execute=True):
+            product.brand = self.samsung
+            product.save()
+            PartnerStock.objects.filter(product=product).update(price=50)
+            Product.refresh_offer_summaries(Product.objects.filter(pk=product.pk))
+        with self.assertNumQueries(2):
+            self.assertIs(get_facet_index(), index)
+        self.assertEqual(index.counts({})['brand'], {'samsung': 4})
+        self.assertEqual(index.counts({}, price_range=(None, Decimal(60)))['category'], {'digital': 1, 'phone': 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[1].delete()
+        self.assertIs(get_facet_index(), index)
+        self.assertEqual(index.counts({})['category'], {'digital': 3, 'phone': 1, 'tablet': 2})
+
+        # Row of the deleted product is reused
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.objects.create(
+                product_type=product.product_type, upc=5, title='Product 5', slug='product-5',
+                category=product.category, brand=self.apple
+            )
+        self.assertIs(get_facet_index(), index)
+        self.assertEqual(sorted(index.rows.values()), [0, 1, 2, 3])
+        self.assertEqual(index.counts({})['brand'], {'apple': 1, 'samsung': 3})
+
+    def test_listing_view(self):
+        response = self.client.get('/catalogue/products/list/', {'brand': 'samsung', 'price_min': '150'})
+        self.assertEqual([product.upc for product in response.context['products']], [3])
+        facets = {facet['name']: facet['values'] for facet in response.context['facets']}
+        counts = {name: [(value['value'], value['count']) for value in values] for name, values in facets.items()}
+        self.assertEqual(counts['brand'], [('apple', 1), ('samsung', 1)])
+        self.assertEqual(counts['color'], [('Black', 1)])
+
+    def test_non_finite_prices_are_no_bound(self):
+        expected = self.client.get('/catalogue/products/list/', {'brand': 'samsung'}).context['products']
+        for price in ('NaN', 'sNaN', 'Infinity', '-inf', 'cheap'):
+            response = self.client.get(
+                '/catalogue/products/list/', {'brand': 'samsung', 'price_min': price, 'price_max': price}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [product.upc for product in response.context['products']], [product.upc for product in expected]
+            )
+        self.assertEqual(parse_filters(QueryDict('price_min=NaN&price_max=Infinity'))[1], (None, None))
+
+
+class AttributeValueTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Phone', slug='phone')
+        brand = Brand.objects.create(name='Samsung', slug='samsung')
+        product_type = ProductType.objects.create(title='Mobile')
+        cls.ram = ProductAttribute.objects.create(
+            title='Ram', product_type=product_type, attribute_type=ProductAttribute.INTEGER
+        )
+        cls.weight = ProductAttribute.objects.create(
+            title='Weight', product_type=product_type, attribute_type=ProductAttribute.FLOAT
+        )
+        cls.color = ProductAttribute.objects.create(
+            title='Color', product_type=product_type, attribute_type=ProductAttribute.STRING
+        )
+        for upc, ram, weight, color in ((1, '4', '180.5', 'Black'), (2, '12', '95', 'White'), (3, '8', '210', 'Black')):
+            product = Product.objects.create(
+                product_type=product_type, upc=upc, title=f'Galaxy {upc}', slug=f'galaxy-{upc}', category=category,
+                brand=brand
+            )
+            for attribute, value in ((cls.ram, ram), (cls.weight, weight), (cls.color, color)):
+                ProductAttributeValue.objects.create(product=product, product_attribute=attribute, value=value)
+        # No attribute values
+        Product.objects.create(
+            product_type=product_type, upc=4, title='Galaxy 4', slug='galaxy-4', category=category, brand=brand
+        )
+
+    def upcs(self, products):
+        return list(products.values_list('upc', flat=True))
+
+    def test_typed_columns(self):
+        value = ProductAttributeValue.objects.get(product__upc=2, product_attribute=self.ram)
+        self.assertEqual((value.value_int, value.value_float, value.typed_value), (12, None, 12))
+        value = ProductAttributeValue.objects.get(product__upc=1, product_attribute=self.weight)
+        self.assertEqual((value.value_int, value.value_float), (None, 180.5))
+        with self.assertRaises(ValidationError):
+            ProductAttributeValue(product=value.product, product_attribute=self.ram, value='eight').save()
+
+    def test_attribute_equals(self):
+        self.assertEqual(self.upcs(Product.objects.attribute_equals(self.ram, '8')), [3])
+        self.assertEqual(self.upcs(Product.objects.attribute_equals(self.color, 'Black').order_by('upc')), [1, 3])
+        with self.assertRaises(ValidationError):
+            Product.objects.attribute_equals(self.ram, 'eight')
+
+    def test_attribute_range(self):
+        # Compared as numbers, '12' < '4' as strings
+        self.assertEqual(self.upcs(Product.objects.attribute_range(self.ram, 5).order_by('upc')), [2, 3])
+        self.assertEqual(self.upcs(Product.objects.attribute_range(self.ram, value_max=8).order_by('upc')), [1, 3])
+        self.assertEqual(self.upcs(Product.objects.attribute_range(self.weight, '100', '200.0')), [1])
+
+    def test_order_by_attribute(self):
+        # Where products without a value go depends on the database
+        products = Product.objects.exclude(upc=4)
+        self.assertEqual(self.upcs(products.order_by_attribute(self.ram)), [1, 3, 2])
+        self.assertEqual(self.upcs(products.order_by_attribute(self.weight, descending=True)), [3, 1, 2])
+        self.assertEqual(len(Product.objects.order_by_attribute(self.ram)), 4)
+
+    def test_retype_values(self):
+        self.color.attribute_type = ProductAttribute.INTEGER
+        self.color.save()
+        self.assertFalse(ProductAttributeValue.objects.filter(product_attribute=self.color, value_int__isnull=False))
+
+        self.ram.attribute_type = ProductAttribute.FLOAT
+        self.ram.save()
+        self.assertEqual(self.upcs(Product.objects.attribute_range(self.ram, '10.5')), [2])
+
+
+class ProductSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Phone', slug='phone')
+        brand = Brand.objects.create(name='Samsung', slug='samsung')
+        product_type = ProductType.objects.create(title='Mobile')
+        attribute = ProductAttribute.objects.create(
+            title='Color', product_type=product_type, attribute_type=ProductAttribute.STRING
+        )
+
+        cls.note = Product.objects.create(
+            product_type=product_type, upc=1, title='Galaxy Note', slug='galaxy-note', category=category, brand=brand,
+            description='Large screen'
+        )
+        cls.tab = Product.objects.create(
+            product_type=product_type, upc=2, title='Galaxy Tab', slug='galaxy-tab', category=category, brand=brand
+        )
+        ProductAttributeValue.objects.create(product=cls.tab, product_attribute=attribute, value='Graphite')
+
+    def assertSearch(self, engine, query, expected):
+        self.assertEqual([product.pk for product in engine.search(query)], [product.pk for product in expected])
+
+    def check_engine(self, engine):
+        self.assertSearch(engine, 'galaxy note', [self.note])
+        self.assertSearch(engine, 'gal', [self.tab, self.note])
+        self.assertSearch(engine, 'graph', [self.tab])
+        self.assertSearch(engine, 'samsung', [self.tab, self.note])
+        self.assertSearch(engine, '', [])
+
+    def test_in_memory_engine(self):
+        engine = InMemorySearchEngine()
+        self.check_engine(engine)
+        self.assertSearch(engine, 'galxy tab', [self.tab])
+
+    def test_default_engine(self):
+        self.check_engine(get_search_engine())
+
+    def test_title_weighs_more_than_description(self):
+        self.assertSearch(get_search_engine(), 'screen', [self.note])
+
+        Product.objects.filter(pk=self.tab.pk).update(title='Screen Tab')
+        self.tab.refresh_from_db()
+        self.tab.save()
+        self.assertSearch(get_search_engine(), 'screen', [self.tab, self.note])
+
+    def test_search_view_without_query(self):
+        response = self.client.get('/catalogue/products/search/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_view(self):
+        response = self.client.get('/catalogue/products/search/', {'q': 'note'})
+        self.assertContains(response, 'Galaxy Note')
+        self.assertNotContains(response, 'Galaxy Tab')
+
+    def test_vector_updated_on_attribute_change(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('search vector is maintained on PostgreSQL only')
+        self.assertSearch(get_search_engine(), 'graphite', [self.tab])
+        ProductAttributeValue.objects.filter(product=self.tab).delete()
+        ProductAttributeValue.objects.create(
+            product=self.note, product_attribute=ProductAttribute.objects.get(), value='Graphite'
+        )
+        self.assertSearch(get_search_engine(), 'graphite', [self.note])
+
+
+class ProductDetailLoaderTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        root = Category.objects.create(name='Digital', slug='digital')
+        category = Category.objects.create(name='Phone', slug='phone', parent=root)
+        brand = Brand.objects.create(name='Samsung', slug='samsung')
+        cls.product_type = ProductType.objects.create(title='Mobile')
+        cls.product = Product.objects.create(
+            product_type=cls.product_type, upc=1234, title='Galaxy Note', slug='galaxy-note', category=category,
+            brand=brand
+        )
+
+    def add_rows(self, count):
+        start = self.product.attribute_values.count()
+        for i in range(start, start + count):
+            attribute = ProductAttribute.objects.create(title=f'Attribute {i}', product_type=self.product_type)
+            ProductAttributeValue.objects.create(product=self.product, product_attribute=attribute, value=i)
+            partner = Partner.objects.create(name=f'Partner {i}')
+            PartnerStock.objects.create(product=self.product, partner=partner, price=100 + i)
+
+    def load(self, pk):
+        product = Product.objects.for_detail(pk, 'galaxy-note')
+        [image.image for image in product.get_images]
+        [(value.product_attribute.title, value.value) for value in product.get_attributes]
+        [(stock.partner.name, stock.price) for stock in product.get_stocks]
+        [category.name for category in product.get_category_list]
+        return product, product.get_stock.partner.name, product.product_type.title, product.brand.name
+
+    def test_query_count_is_constant(self):
+        for count in (1, 5):
+            self.add_rows(count)
+            with self.assertNumQueries(5):
+                product, *_ = self.load(self.product.pk)
+        self.assertEqual(len(product.get_attributes), 6)
+        self.assertEqual(len(product.get_stocks), 5)
+        self.assertEqual([category.slug for category in product.get_category_list], ['phone', 'digital'])
+
+    def test_load_by_upc(self):
+        self.add_rows(1)
+        product, partner_name, *_ = self.load(self.product.upc)
+        self.assertEqual(product, self.product)
+        self.assertEqual(partner_name, 'Partner 0')
+        self.assertIsNone(Product.objects.for_detail(self.product.pk, 'other-slug'))
+
+    def test_view_query_count_is_constant(self):
+        cache.clear()
+        url = self.product.get_absolute_url()
+        self.client.get(url)  # warm category navbar
+
+        query_counts = []
+        for count in (1, 5):
+            self.add_rows(count)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertContains(response, 'Partner 0')
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class PageCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Phone', slug='phone')
+        cls.brand = Brand.objects.create(name='Samsung', slug='samsung')
+        cls.product = Product.objects.create(
+            product_type=ProductType.objects.create(title='Mobile'), upc=1, title='Galaxy', slug='galaxy',
+            category=cls.category, brand=cls.brand
+        )
+
+    def setUp(self):
+        get_cache().clear()
+        cache.clear()
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_hits_and_misses(self):
+        url = self.product.get_absolute_url()
+        # Tags are learned on the first render, content is stored by the second one
+        for _ in range(2):
+            self.assertGreater(self.get(url)[1], 0)
+        response, query_count = self.get(url)
+        self.assertEqual(query_count, 0)
+        self.assertContains(response, 'Galaxy')
+        self.assertEqual(get_cache_stats(), {'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3})
+
+    def test_invalidation(self):
+        url = self.product.get_absolute_url()
+        self.get(url)
+        self.get(url)
+
+        Product.objects.filter(pk=self.product.pk).update(title='Galaxy S')
+        self.assertEqual(self.get(url)[1], 0)
+        self.product.refresh_from_db()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.product.save()
+        # Versions are bumped once the save commits, not while other requests still read the old row
+        self.assertEqual(self.get(url)[1], 0)
+        for callback in callbacks:
+            callback()
+        response, query_count = self.get(url)
+        self.assertGreater(query_count, 0)
+        self.assertContains(response, 'Galaxy S')
+
+    def test_stock_change_expires_page_on_commit(self):
+        url = self.product.get_absolute_url()
+        self.get(url)
+        self.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            partner = Partner.objects.create(name='Digikala')
+            stock = PartnerStock.objects.create(product=self.product, partner=partner, price=100)
+        self.assertContains(self.get(url)[0], 'Digikala')
+        self.get(url)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            stock.delete()
+        self.assertEqual(self.get(url)[1], 0)
+        for callback in callbacks:
+            callback()
+        self.assertGreater(self.get(url)[1], 0)
+
+    def test_change_during_render_is_not_cached(self):
+        url = self.product.get_absolute_url()
+        view = product_detail_view.__wrapped__
+
+        @cache_response
+        def render_then_change(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            invalidate_tags([f'product:{self.product.pk}'])
+            return response
+
+        for _ in range(2):
+            render_then_change(RequestFactory().get(url), pk=self.product.pk, slug=self.product.slug)
+        # Entry was stored with versions read before the change
+        self.assertGreater(self.get(url)[1], 0)
+        self.assertEqual(self.get(url)[1], 0)
+
+    def test_hit_keeps_view_headers(self):
+        url = self.product.get_absolute_url()
+        view = product_detail_view.__wrapped__
+
+        @cache_response
+        def view_with_headers(request, *args, **kwargs):
+            response = view(request, *args, **kwargs)
+            response['Vary'] = 'Accept-Language'
+            response['Content-Language'] = 'fa'
+            response['X-Catalogue'] = 'product'
+            return response
+
+        responses = [
+            view_with_headers(RequestFactory().get(url), pk=self.product.pk, slug=self.product.slug) for _ in range(3)
+        ]
+        self.assertEqual(get_cache_stats()['hits'], 1)
+        self.assertEqual(dict(responses[2].items()), dict(responses[0].items()))
+        self.assertEqual(responses[2].content, responses[0].content)
+
+    def test_brand_change_expires_listings(self):
+        urls = ['/catalogue/products/list/', self.category.get_absolute_url()]
+        for url in urls:
+            self.get(url)
+            self.get(url)
+            self.assertEqual(self.get(url)[1], 0)
+
+        self.brand.slug = 'samsung-electronics'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.brand.save()
+        for url in urls:
+            response, query_count = self.get(url)
+            self.assertGreater(query_count, 0)
+
+
+class CampaignViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='user', password='secret', email='user@gmail.com')
+        cls.user.user_permissions.add(Permission.objects.get(codename='has_score_permission'))
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def test_eligible(self):
+        UserScore.change_score(self.user, 250)
+        self.assertEqual(self.client.get('/catalogue/campaign/').status_code, 200)
+        self.assertEqual(self.client.post('/catalogue/campaign/').status_code, 200)
+
+    def test_low_score_redirects_to_login(self):
+        UserScore.change_score(self.user, 200)
+        response = self.client.get('/catalogue/campaign/')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith('/admin/login/'))
+
+    def test_missing_permission(self):
+        UserScore.change_score(self.user, 250)
+        self.user.user_permissions.clear()
+        self.assertEqual(self.client.get('/catalogue/campaign/').status_code, 403)
+
+    def test_anonymous(self):
+        self.client.logout()
+        self.assertEqual(self.client.get('/catalogue/campaign/').status_code, 302)
+
+    def test_eligibility_is_cached(self):
+        UserScore.change_score(self.user, 250)
+        self.client.get('/catalogue/campaign/')
+        # Session and user lookups of the auth middleware only
+        with self.assertNumQueries(2):
+            self.client.get('/catalogue/campaign/')
+
+
+class CatalogueImportExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        root = Category.objects.create(name='Digital', slug='digital')
+        category = Category.objects.create(name='Phone', slug='phone', parent=root)
+        brand = Brand.objects.create(name='Samsung', slug='samsung')
+        product_type = ProductType.objects.create(title='Mobile')
+        attribute = ProductAttribute.objects.create(
+            title='Ram', product_type=product_type, attribute_type=ProductAttribute.INTEGER
+        )
+        cls.product = Product.objects.create(
+            product_type=product_type, upc=1, title='Galaxy Note', slug='galaxy-note', category=category, brand=brand
+        )
+        ProductAttributeValue.objects.create(product=cls.product, product_attribute=attribute, value='8')
+        PartnerStock.objects.create(product=cls.product, partner=Partner.objects.create(name='Digikala'), price=100)
+
+    def dump(self):
+        return [(kind, {k: str(v) for k, v in record.items()}) for kind, record in export_records()]
+
+    def test_ndjson_round_trip(self):
+        before = self.dump()
+        stream = io.StringIO()
+        self.assertEqual(write_ndjson(export_records(), stream), 8)
+
+        stream.seek(0)
+        importer = CatalogueImporter(chunk_size=2)
+        stats = importer.run(read_ndjson(stream))
+        self.assertEqual(importer.errors, [])
+        self.assertEqual(sum(counts['created'] for counts in stats.values()), 0)
+        self.assertEqual(stats['product']['updated'], 1)
+        self.assertEqual(self.dump(), before)
+
+    def test_csv_import_creates_and_updates(self):
+        stream = io.StringIO()
+        write_csv('product', stream)
+        stream = io.StringIO(
+            stream.getvalue().replace('Galaxy Note', 'Galaxy Note 9')
+            + '2,Galaxy Tab,galaxy-tab,,True,5,Mobile,phone,samsung\n'
+        )
+        stats = CatalogueImporter().run(read_csv('product', stream))
+        self.assertEqual(stats['product'], {'created': 1, 'updated': 1, 'errors': 0})
+
+        tab = Product.objects.get(upc=2)
+        self.assertEqual((tab.quantity, tab.category.slug, tab.brand.slug), (5, 'phone', 'samsung'))
+        self.assertEqual(Product.objects.get(upc=1).title, 'Galaxy Note 9')
+        self.assertTrue(tab.facets.filter(facet='category', value='digital').exists())
+
+    def test_new_rows_resolve_natural_keys(self):
+        records = [
+            ('category', {'slug': 'tablet', 'name': 'Tablet', 'parent': 'digital'}),
+            ('product', {
+                'upc': 3, 'title': 'Tab S', 'slug': 'tab-s', 'product_type': 'Mobile', 'category': 'tablet',
+                'brand': 'samsung',
+            }),
+            ('attribute_value', {'product': 3, 'product_type': 'Mobile', 'attribute': 'Ram', 'value': '12'}),
+            ('stock', {'product': 3, 'partner': 'Digikala', 'price': '90.50'}),
+            ('stock', {'product': 3, 'partner': 'Bamilo', 'price': '95'}),
+        ]
+        importer = CatalogueImporter()
+        importer.run(records)
+        self.assertEqual(importer.errors, [])
+
+        product = Product.objects.get(upc=3)
+        self.assertEqual(product.category.parent.slug, 'digital')
+        self.assertEqual(product.attribute_values.get().value_int, 12)
+        self.assertEqual((str(product.best_price), product.offer_count), ('90.50', 2))
+        self.assertEqual(
+            set(product.facets.filter(facet=ProductFacet.CATEGORY).values_list('value', flat=True)),
+            {'digital', 'tablet'}
+        )
+
+    def test_invalid_records_are_counted(self):
+        stream = io.StringIO('\n'.join([
+            'not json',
+            json.dumps({'model': 'product', 'upc': 4, 'title': 'X', 'slug': 'x', 'product_type': 'Mobile',
+                        'category': 'unknown', 'brand': 'samsung'}),
+            json.dumps({'model': 'attribute_value', 'product': 1, 'product_type': 'Mobile', 'attribute': 'Ram',
+                        'value': 'eight'}),
+            json.dumps({'model': 'category', 'slug': 'digital', 'name': 'Digital', 'parent': 'phone'}),
+        ]))
+        importer = CatalogueImporter()
+        stats = importer.run(read_ndjson(stream))
+        self.assertEqual(stats[None]['errors'], 1)
+        self.assertEqual(stats['product']['errors'], 1)
+        self.assertEqual(stats['attribute_value']['errors'], 1)
+        self.assertEqual(stats['category'], {'created': 0, 'updated': 1, 'errors': 1})
+        self.assertEqual(len(importer.errors), 4)
+        self.assertFalse(Product.objects.filter(upc=4).exists())
+        self.assertIsNone(Category.objects.get(slug='digital').parent)
+
+
+class ProductAdminTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(username='admin', password='secret', email='admin@gmail.com')
+        cls.product_type = ProductType.objects.create(title='Mobile')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def add_products(self, count):
+        start = Product.objects.count()
+        for i in range(start, start + count):
+            Product.objects.create(
+                product_type=self.product_type, upc=1000 + i, title=f'Galaxy {i}', slug=f'galaxy-{i}',
+                category=Category.objects.create(name=f'Category {i}', slug=f'category-{i}'),
+                brand=Brand.objects.create(name=f'Brand {i}', slug=f'brand-{i}')
+            )
+
+    def test_changelist_query_count_is_constant(self):
+        query_counts = []
+        for count in (1, 5):
+            self.add_products(count)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/admin/catalogue/product/')
+            self.assertContains(response, 'Category 0')
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_search(self):
+        self.add_products(3)
+        response = self.client.get('/admin/catalogue/product/', {'q': 'brand 1'})
+        self.assertEqual([product.upc for product in response.context['cl'].result_list], [1001])
+        response = self.client.get('/admin/catalogue/product/', {'q': '1002'})
+        self.assertEqual([product.upc for product in response.context['cl'].result_list], [1002])
+        self.assertEqual(list(response.context['messages']), [])
+
+    def test_search_limit_is_reported(self):
+        self.add_products(3)
+        with mock.patch('catalogue.admin.ADMIN_SEARCH_LIMIT', 2):
+            response = self.client.get('/admin/catalogue/product/', {'q': 'galaxy'})
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+        message, = response.context['messages']
+        self.assertIn('Only the 2 best matches of "galaxy" are listed', message.message)
+
+    def test_estimated_count(self):
+        self.add_products(3)
+        queryset = Product.objects.order_by('pk')
+        self.assertEqual(EstimatedCountPaginator(queryset, 20).count, 3)
+        if connection.vendor != 'postgresql':
+            self.skipTest('count estimates are read from PostgreSQL statistics')
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE catalogue_product')
+        paginator = EstimatedCountPaginator(queryset, 20)
+        paginator.threshold = 0
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, 3)
+        paginator = EstimatedCountPaginator(queryset.filter(upc__gte=1001), 20)
+        paginator.threshold = 0
+        self.assertGreater(paginator.count, 0)
+
+
+class AdminJobTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(username='admin', password='secret', email='admin@gmail.com')
+        create_products(range(5))
+
+    def submit(self):
+        self.client.force_login(self.admin)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post('/admin/catalogue/product/', {
+                'action': 'make_is_unavailable', 'select_across': '1', 'index': '0',
+                '_selected_action': Product.objects.values_list('pk', flat=True)[:1],
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(callbacks), 1)
+        return AdminJob.objects.get()
+
+    def test_action_runs_in_batches(self):
+        job = self.submit()
+        self.assertEqual((job.status, job.total, job.params), (AdminJob.PENDING, 5, {'is_available': False}))
+        self.assertEqual(Product.objects.filter(is_available=True).count(), 5)
+
+        AdminJob.objects.filter(pk=job.pk).update(batch_size=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            job = run_job(job.pk)
+        self.assertEqual((job.status, job.processed, job.progress), (AdminJob.DONE, 5, 100))
+        self.assertFalse(Product.objects.filter(is_available=True).exists())
+        # A finished job is not run again
+        self.assertIsNone(run_job(job.pk, resume=True))
+
+    def test_resume_starts_after_processed_rows(self):
+        job = self.submit()
+        AdminJob.objects.filter(pk=job.pk).update(status=AdminJob.RUNNING, processed=3, batch_size=1)
+        self.assertIsNone(run_job(job.pk))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            job = run_job(job.pk, resume=True)
+        self.assertEqual((job.status, job.processed), (AdminJob.DONE, 5))
+        self.assertEqual(list(Product.objects.filter(is_available=False).values_list('upc', flat=True)), [3, 4])
+
+    def test_resume_only_expired_lease(self):
+        job = self.submit()
+        AdminJob.objects.filter(pk=job.pk).update(
+            status=AdminJob.RUNNING, locked_until=timezone.now() + timedelta(minutes=1)
+        )
+        # The worker of the job is alive
+        self.assertIsNone(run_job(job.pk, resume=True))
+        self.assertEqual(Product.objects.filter(is_available=False).count(), 0)
+
+        AdminJob.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            job = run_job(job.pk, resume=True)
+        self.assertEqual((job.status, job.processed), (AdminJob.DONE, 5))
+
+    def test_worker_that_lost_lease_stops(self):
+        @job_action('claimed_by_other_worker')
+        def claimed_by_other_worker(product_ids):
+            Product.objects.filter(pk__in=product_ids).update(is_available=False)
+            # Stands for a claim committed by another worker while this batch runs
+            AdminJob.objects.update(worker='other')
+
+        self.addCleanup(JOB_ACTIONS.pop, 'claimed_by_other_worker')
+        job = AdminJob.objects.create(
+            action='claimed_by_other_worker', model='catalogue.product', total=5, batch_size=2,
+            object_ids=list(Product.objects.order_by('pk').values_list('pk', flat=True)),
+        )
+        with self.assertLogs('catalogue.jobs', 'WARNING'):
+            self.assertIsNone(run_job(job.pk))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed), (AdminJob.RUNNING, 0))
+        self.assertEqual(Product.objects.filter(is_available=False).count(), 0)
+
+    def test_failed_job(self):
+        job = AdminJob.objects.create(action='missing', model='catalogue.product', object_ids=[1], total=1)
+        with self.assertLogs('catalogue.jobs', 'ERROR'):
+            job = run_job(job.pk)
+        self.assertEqual((job.status, job.processed), (AdminJob.FAILED, 0))
+        self.assertIn('Unknown job action', job.error)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'worker threads need a database shared between connections')
+class AdminJobWorkerTest(TransactionTestCase):
+    def test_job_runs_on_thread_pool(self):
+        create_products([1])
+
+        job = submit_job('set_product_availability', Product.objects.all(), is_available=False)
+        for _ in range(100):
+            job.refresh_from_db()
+            if job.status == AdminJob.DONE:
+                break
+            time.sleep(0.05)
+        self.assertEqual(job.status, AdminJob.DONE)
+        self.assertFalse(Product.objects.get().is_available)
+
+
+class ProductImageDerivativeTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product, = create_products([1])
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media_settings = override_settings(MEDIA_ROOT=media_root, CATALOGUE_IMAGE_WIDTHS=(160, 320, 1280))
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def upload(self, name='galaxy.png', size=(800, 400)):
+        buffer = io.BytesIO()
+        Image.new('RGBA', size, (255, 0, 0, 128)).save(buffer, format='PNG')
+        with self.captureOnCommitCallbacks():
+            return ProductImage.objects.create(
+                product=self.product, image=SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+            )
+
+    def test_upload_submits_job(self):
+        image = self.upload()
+        job = AdminJob.objects.get()
+        self.assertEqual((job.action, job.object_ids), ('build_image_derivatives', [image.pk]))
+
+    def test_build_derivatives(self):
+        image = self.upload()
+        self.assertEqual(build_derivatives([image]), (1, 0))
+        image.refresh_from_db()
+
+        self.assertTrue(image.has_derivatives)
+        self.assertEqual((image.width, image.height), (800, 400))
+        formats = get_formats()
+        self.assertIn('jpeg', formats)
+        self.assertEqual(
+            [(derivative['width'], derivative['format']) for derivative in image.derivatives],
+            [(width, image_format) for width in (160, 320, 800) for image_format in formats]
+        )
+        for derivative in image.derivatives:
+            path = os.path.join(settings.MEDIA_ROOT, derivative['name'])
+            with Image.open(path) as derivative_image:
+                self.assertEqual(derivative_image.size, (derivative['width'], derivative['width'] // 2))
+
+        # Content addressed names, rebuilding writes no new files
+        names = {derivative['name'] for derivative in image.derivatives}
+        build_derivatives([image])
+        image.refresh_from_db()
+        self.assertEqual({derivative['name'] for derivative in image.derivatives}, names)
+        self.assertEqual(len(os.listdir(os.path.join(settings.MEDIA_ROOT, 'products/derived'))), len(names))
+
+    def test_broken_image(self):
+        image = self.upload(name='broken.png')
+        with open(image.image.path, 'wb') as file:
+            file.write(b'not an image')
+        with self.assertLogs('catalogue.images', 'WARNING'):
+            self.assertEqual(build_derivatives([image]), (0, 1))
+        image.refresh_from_db()
+        self.assertEqual((image.derivatives, image.derivatives_source), ([], image.image.name))
+
+    def test_derivatives_of_replaced_and_deleted_images_are_deleted(self):
+        first, second = self.upload(name='galaxy-1.png'), self.upload(name='galaxy-2.png')
+        with self.captureOnCommitCallbacks(execute=True):
+            build_derivatives([first, second])
+        first.refresh_from_db()
+        shared = {derivative['name'] for derivative in first.derivatives}
+        derived_dir = os.path.join(settings.MEDIA_ROOT, 'products/derived')
+
+        # Identical originals share their derivatives, a replaced one keeps the files of the other image
+        buffer = io.BytesIO()
+        Image.new('RGB', (400, 400), 'blue').save(buffer, format='PNG')
+        first.image.save('galaxy-3.png', ContentFile(buffer.getvalue()), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            build_derivatives([first])
+        first.refresh_from_db()
+        replaced = {derivative['name'] for derivative in first.derivatives}
+        self.assertTrue(shared.isdisjoint(replaced))
+        self.assertEqual(set(os.listdir(derived_dir)), {os.path.basename(name) for name in shared | replaced})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(set(os.listdir(derived_dir)), {os.path.basename(name) for name in shared})
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(os.listdir(derived_dir), [])
+
+    def test_backfill_command_with_worker_processes(self):
+        images = [self.upload(name=f'galaxy-{i}.png') for i in range(3)]
+        call_command('build_image_derivatives', workers=2, chunk_size=2, stdout=io.StringIO())
+        for image in images:
+            image.refresh_from_db()
+            self.assertTrue(image.has_derivatives)
+
+    def test_picture_tag(self):
+        image = self.upload()
+        response = self.client.get(self.product.get_absolute_url())
+        self.assertContains(response, f'src="{image.image.url}"')
+
+        # Cached page of the product is invalidated after commit
+        with self.captureOnCommitCallbacks(execute=True):
+            build_derivatives([image])
+        response = self.client.get(self.product.get_absolute_url())
+        self.assertContains(response, '<picture>')
+        self.assertContains(response, 'sizes="200px" width="200" height="100"')
+        self.assertContains(response, ' 160w, ')
+        self.assertNotContains(response, f'src="{image.image.url}"')
@@ -1,13 +1,23 @@
-from django.contrib.auth.decorators import login_required, user_passes_test, permission_required
-from django.db.models import Q
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render
-from django.views.decorators.http import require_http_methods, require_GET, require_POST
-
-from catalogue.models import Product, Category, Brand
+from django.views.decorators.http import require_http_methods
+
+from catalogue.cache import (
+    cache_response,
+    product_list_tags,
+    product_detail_tags,
+    category_page_tags,
+    brand_page_tags
+)
+from catalogue.facets import parse_filters, get_facets
+from catalogue.models import Product, Category, Brand, ProductFacet
+from catalogue.pagination import InvalidCursor
+from catalogue.search import get_search_engine
 from catalogue.utils import check_email
+from transaction.eligibility import eligibility_required
 
 
+@cache_response
 def product_list_view(request):
     # category = Category.objects.get(pk=2)  # hit-1
     # products = Product.objects.filter(is_available=True, category=category)  # hit-2
@@ -22,101 +32,108 @@ def product_list_view(request):
     #
     # products = Product.objects.filter(Q(is_available=True) | Q(category=category))  # or (|)
 
-    products = Product.objects.select_related('category', 'brand').all()
+    filters, price_range = parse_filters(request.GET)
+    products = Product.objects.join().filter_facets(filters).price_range(*price_range)
+
+    try:
+        page = products.keyset_paginate(request.GET.get('cursor'))
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid Cursor')
+
     context = {
-        'products': products,
+        'products': page,
+        'next_page_url': page.next_page_url(request),
+        'facets': get_facets(request, filters, price_range=price_range),
     }
-    return render(request, 'catalogue/product-list.html', context=context)
+    response = render(request, 'catalogue/product-list.html', context=context)
+    response.cache_tags = product_list_tags()
+    return response
 
 
+@cache_response
 def product_detail_view(request, pk, slug):
-    # Solution-1
-    try:
-        product = Product.objects.get(pk=pk, slug=slug)  # hit-1
-    except Product.DoesNotExist:
-        try:
-            product = Product.objects.get(upc=pk, slug=slug)  # hit-2
-        except Product.DoesNotExist:
-            return HttpResponse('Product Does Not Exist')
-
-    # Solution-2
-    # qs = Product.objects.select_related('category', 'brand').filter((Q(pk=pk) | Q(upc=pk)), slug=slug)  # hit-1
-    qs = Product.objects.select_related('category', 'brand').filter((Q(pk=pk) | Q(upc=pk)) & Q(slug=slug))  # hit-1
-    if qs.exists():
-        product = qs.first()
-    else:
+    product = Product.objects.for_detail(pk, slug)  # 5 hits, whatever the number of images, attributes and offers
+    if product is None:
         return HttpResponse('Product Does Not Exist')
 
     context = {
         'product': product,
     }
-    return render(request, 'catalogue/product-detail.html', context=context)
+    response = render(request, 'catalogue/product-detail.html', context=context)
+    response.cache_tags = product_detail_tags(product)
+    return response
 
 
+@cache_response
 def category_product_list_view(request, pk, slug):
-    # Solution-1
-    qs = Category.objects.filter(pk=pk, slug=slug)  # hit-1
-    if qs.exists():
-        category = qs.first()
-    else:
+    category = Category.objects.filter(pk=pk, slug=slug).first()  # hit-1
+    if category is None:
         return HttpResponse('Category Does Not Exist')
 
-    products = Product.objects.filter(category=category)  # hit-2
-    products = category.products.all()  # hit-2
+    filters, price_range = parse_filters(request.GET)
+    products = category.get_products().filter_facets(filters).price_range(*price_range)  # hit-2 (whole subtree)
 
-    # Solution-2
-    qs = Category.objects.prefetch_related('products').filter(pk=pk, slug=slug)  # hit-1
-    if qs.exists():
-        category = qs.first()
-    else:
-        return HttpResponse('Category Does Not Exist')
-    products = Product.objects.filter(category=category)  # hit-2
+    try:
+        page = products.keyset_paginate(request.GET.get('cursor'))
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid Cursor')
 
     context = {
         'category': category,
-        'products': products
+        'breadcrumbs': category.get_ancestors(),  # hit-3
+        'products': page,
+        'next_page_url': page.next_page_url(request),
+        'facets': get_facets(request, filters, scope=(ProductFacet.CATEGORY, category.slug), price_range=price_range),
     }
-    return render(request, 'catalogue/category-product-list.html', context=context)
+    response = render(request, 'catalogue/category-product-list.html', context=context)
+    response.cache_tags = category_page_tags(category)
+    return response
 
 
+@cache_response
 def brand_product_list_view(request, pk, slug):
-    qs = Brand.objects.prefetch_related('products').filter(pk=pk, slug=slug)
-    if qs.exists():
-        brand = qs.first()
-    else:
+    brand = Brand.objects.filter(pk=pk, slug=slug).first()
+    if brand is None:
         return HttpResponse('Brand Does Not Exist')
 
-    products = brand.products.all()
-    context = '<br>'.join([f"{product.upc} - {product.title} - {product.brand}" for product in products])
-    return HttpResponse(context)
+    try:
+        page = brand.products.keyset_paginate(request.GET.get('cursor'))
+    except InvalidCursor:
+        return HttpResponseBadRequest('Invalid Cursor')
+
+    context = '<br>'.join([f"{product.upc} - {product.title} - {brand}" for product in page])
+    if page.has_next:
+        context += f'<br><br><a href="{page.next_page_url(request)}">Next page</a>'
+    response = HttpResponse(context)
+    response.cache_tags = brand_page_tags(brand)
+    return response
 
 
 def product_search_view(request):
-    query = request.GET.get('q')
-    products = Product.objects.select_related('category').filter(is_available=True, title__icontains=query)
+    query = request.GET.get('q', '')
+    products = get_search_engine().search(query, queryset=Product.objects.select_related('category').activates())
     context = '<br>'.join([f"{product.upc} - {product.title} - {product.category.name}" for product in products])
     return HttpResponse(f'Search Page <br> <br> {context}')
 
 
-@login_required(login_url='/admin/login/')  # Check Log-in user
 @require_http_methods(request_method_list=['GET', 'POST'])  # Check allowed request method view
-@user_passes_test(test_func=lambda u: u.email.endswith('@gmail.com'), login_url='/admin/login/')
-@user_passes_test(test_func=check_email)  # Check passes test
-@user_passes_test(test_func=lambda u: u.is_active)
-@user_passes_test(test_func=lambda u: u.is_staff)
-@permission_required('transaction.has_score_permission', raise_exception=True)  # Check user has permission
-@permission_required('transaction.has_score_permission', login_url='/catalogue/product/detail/1/samsung-note-10/')
-@user_passes_test(test_func=lambda u: u.has_perm('transaction.has_score_permission'), login_url='/admin/login/')
+@eligibility_required(
+    tests=(check_email, lambda u: u.is_active, lambda u: u.is_staff),  # Check passes test
+    perms=('transaction.has_score_permission',),  # Check user has permission
+    login_url='/admin/login/',
+    raise_exception=True
+)
 def user_profile_view(request):
     return HttpResponse(f'Hello {request.user}')
 
 
-@login_required(login_url='/admin/login/')
-@require_GET
-@require_POST
-@user_passes_test(test_func=lambda u: u.score > 200, login_url='/admin/login/')
-@user_passes_test(test_func=lambda u: u.age > 15, login_url='/admin/login/')
-@permission_required('transaction.has_score_permission', raise_exception=True)
+@require_http_methods(request_method_list=['GET', 'POST'])
+@eligibility_required(
+    min_score=201,  # score > 200
+    perms=('transaction.has_score_permission',),
+    login_url='/admin/login/',
+    raise_exception=True
+)
 def campaign_view(request):
     if request.user.is_authenticated:
         """Check log-in user"""
@@ -130,8 +147,8 @@ def campaign_view(request):
         """Check allowed request method to view"""
         pass
 
-    if request.user.score > 200 and request.user.age > 15:
-        """Check passes test"""
+    if request.user.score > 200:
+        """Check passes test, score is set by eligibility_required"""
         pass
 
     if request.user.has_perm('transaction.has_score_permission'):
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# Imported after setup, the static layer reads the manifest of the configured storage
+from config.staticfiles import StaticFilesASGI  # noqa: E402
+
+application = StaticFilesASGI(application)
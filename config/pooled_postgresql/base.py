@@ -0,0 +1,67 @@
+"""
+PostgreSQL backend taking connections from a per-process pool (see pool.py).
+
+Django opens a connection per request and closes it at the end (CONN_MAX_AGE 0),
+here closing returns it to the pool, so a request only pays for the connection
+setup when the pool has no idle connection. Options are read from the POOL dict
+of the database settings: MIN_SIZE, MAX_SIZE, TIMEOUT and HEALTH_CHECK_INTERVAL.
+
+The pool discards the session state of a released connection, client encoding
+and time zone are connection parameters so they survive it and a reused
+connection needs no SET.
+"""
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql.base import DatabaseWrapper as PostgreSQLDatabaseWrapper
+
+from .creation import DatabaseCreation
+from .pool import get_pool
+
+POOL_OPTIONS = {
+    'MIN_SIZE': 'min_size',
+    'MAX_SIZE': 'max_size',
+    'TIMEOUT': 'timeout',
+    'HEALTH_CHECK_INTERVAL': 'health_check_interval',
+}
+
+
+class DatabaseWrapper(PostgreSQLDatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+
+    def get_pool(self, conn_params):
+        options = {
+            POOL_OPTIONS[name]: value for name, value in self.settings_dict.get('POOL', {}).items()
+            if name in POOL_OPTIONS
+        }
+        connect = super().get_new_connection
+        return get_pool(
+            self.alias, sorted(conn_params.items()), lambda: connect(self.session_params(conn_params)), **options
+        )
+
+    def session_params(self, conn_params):
+        """conn_params with the session settings Django would SET after connecting"""
+        params = {'client_encoding': 'UTF8', **conn_params}
+        if self.timezone_name:
+            params['options'] = f"{conn_params.get('options', '')} -c TimeZone={self.timezone_name}".strip()
+        return params
+
+    def get_new_connection(self, conn_params):
+        if self.alias == NO_DB_ALIAS:
+            # Short lived connection to the 'postgres' database (test database creation)
+            return super().get_new_connection(conn_params)
+
+        self._pool = self.get_pool(conn_params)
+        connection = self._pool.acquire()
+        # Set by the parent for new connections only, a reused one keeps its session
+        options = self.settings_dict['OPTIONS']
+        self.isolation_level = options.get('isolation_level', connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None or self._pool is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            self._pool.release(self.connection)
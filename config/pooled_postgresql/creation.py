@@ -0,0 +1,10 @@
+from django.db.backends.postgresql.creation import DatabaseCreation as PostgreSQLDatabaseCreation
+
+from .pool import close_pool
+
+
+class DatabaseCreation(PostgreSQLDatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # Idle pooled connections would keep the test database from being dropped
+        close_pool(self.connection.alias)
+        super()._destroy_test_db(test_database_name, verbosity)
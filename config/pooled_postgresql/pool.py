@@ -0,0 +1,215 @@
+"""
+Thread-safe pool of psycopg2 connections, one per database alias and process.
+
+psycopg2.pool.ThreadedConnectionPool closes every connection returned above
+minconn and fails instead of waiting when it is exhausted, so this pool keeps
+up to max_size connections open and makes callers wait up to timeout for one.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+_pools = {}
+_pools_lock = threading.Lock()
+# Pools inherited from the parent process. Their connections share sockets with the
+# parent: they are never used nor closed here, only kept from garbage collection.
+_inherited = []
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, min_size=1, max_size=10, timeout=10, health_check_interval=30):
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.closed = False
+
+        self._idle = deque()  # (connection, last use time), most recent last
+        self._size = 0
+        self._condition = threading.Condition()
+        self.metrics = {
+            'connections_created': 0, 'connections_closed': 0, 'checkouts': 0, 'waits': 0, 'wait_time': 0.0,
+            'timeouts': 0, 'health_check_failures': 0,
+        }
+
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append((self._create(), time.monotonic()))
+
+    def _create(self):
+        try:
+            connection = self.connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self.metrics['connections_created'] += 1
+        return connection
+
+    def _discard(self, connection):
+        """Close connection and free its slot, the caller holds the condition"""
+        self._size -= 1
+        self.metrics['connections_closed'] += 1
+        self._condition.notify()
+        if not connection.closed:
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+
+    def _is_healthy(self, connection, last_use):
+        if connection.closed or connection.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - last_use < self.health_check_interval:
+            return True
+        # Idle for long, the server or a proxy may have dropped it
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        """Idle connection that passes the health check, a new one while below max_size, otherwise wait"""
+        deadline = None
+        while True:
+            with self._condition:
+                if self.closed:
+                    raise psycopg2.OperationalError('connection pool is closed')
+                if self._idle:
+                    connection, last_use = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    self.metrics['checkouts'] += 1
+                    connection = None
+                else:
+                    if deadline is None:
+                        deadline = time.monotonic() + self.timeout
+                        self.metrics['waits'] += 1
+                    started = time.monotonic()
+                    if deadline <= started or not self._condition.wait(deadline - started):
+                        self.metrics['timeouts'] += 1
+                        raise PoolTimeout(f'no database connection available within {self.timeout} seconds')
+                    self.metrics['wait_time'] += time.monotonic() - started
+                    continue
+
+            if connection is None:
+                return self._create()
+            # Outside the lock, a health check may be a round trip to the server
+            healthy = self._is_healthy(connection, last_use)
+            with self._condition:
+                if healthy:
+                    self.metrics['checkouts'] += 1
+                    return connection
+                self.metrics['health_check_failures'] += 1
+                self._discard(connection)
+
+    def release(self, connection):
+        """
+        Return connection to idle with a clean session, a broken one is closed. The
+        reset is a round trip to the server, it runs outside the lock.
+        """
+        if not (self.closed or connection.closed):
+            try:
+                self._reset(connection)
+            except psycopg2.Error:
+                connection.close()
+        with self._condition:
+            if self.closed or connection.closed:
+                self._discard(connection)
+                return
+            self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @staticmethod
+    def _reset(connection):
+        """
+        Roll back an open transaction and discard the session state the last user
+        left: SET parameters, temporary tables, prepared statements, advisory locks
+        and LISTEN. Parameters given when connecting are kept.
+        """
+        if connection.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            raise psycopg2.OperationalError('connection lost')
+        connection.rollback()
+        # DISCARD ALL can not run in a transaction block
+        autocommit = connection.autocommit
+        connection.autocommit = True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('DISCARD ALL')
+        finally:
+            connection.autocommit = autocommit
+
+    def close(self):
+        """Close idle connections now, connections in use when they are released"""
+        with self._condition:
+            self.closed = True
+            while self._idle:
+                self._discard(self._idle.popleft()[0])
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                'min_size': self.min_size, 'max_size': self.max_size, 'size': self._size,
+                'idle': len(self._idle), 'in_use': self._size - len(self._idle), **self.metrics,
+            }
+
+
+def get_pool(alias, params, connect, **options):
+    """
+    Pool of alias in this process, created on first use. A pool of other
+    connection parameters (e.g. before the test database was set up) is closed.
+    """
+    with _pools_lock:
+        entry = _pools.get(alias)
+        if entry is not None and entry[0] == params and not entry[1].closed:
+            return entry[1]
+        if entry is not None:
+            entry[1].close()
+        pool = ConnectionPool(connect, **options)
+        _pools[alias] = (params, pool)
+        return pool
+
+
+def close_pool(alias):
+    with _pools_lock:
+        entry = _pools.pop(alias, None)
+    if entry is not None:
+        entry[1].close()
+
+
+def close_pools():
+    for alias in list(_pools):
+        close_pool(alias)
+
+
+def get_pool_stats():
+    """{alias: stats} of the pools of this process"""
+    with _pools_lock:
+        pools = {alias: pool for alias, (_, pool) in _pools.items()}
+    return {alias: {'pid': os.getpid(), **pool.stats()} for alias, pool in pools.items()}
+
+
+def _after_fork_in_child():
+    # Worker processes (e.g. forked by gunicorn or uvicorn) start their own pools
+    global _pools_lock
+    _inherited.extend(pool for _, pool in _pools.values())
+    _pools.clear()
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
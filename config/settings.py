@@ -80,15 +80,57 @@ WSGI_APPLICATION = 'config.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'config.pooled_postgresql',
         'NAME': DB.get('NAME'),
         'USER': DB.get('USER'),
         'PASSWORD': DB.get('PASSWORD'),
         'HOST': DB.get('HOST'),
         'PORT': DB.get('PORT'),
+        # Connections are returned to a pool of the worker process at the end of
+        # every request instead of being closed, CONN_MAX_AGE must stay 0.
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            'MIN_SIZE': DB.get('POOL_MIN_SIZE', 1),
+            'MAX_SIZE': DB.get('POOL_MAX_SIZE', 10),
+            'TIMEOUT': DB.get('POOL_TIMEOUT', 10),
+            'HEALTH_CHECK_INTERVAL': DB.get('POOL_HEALTH_CHECK_INTERVAL', 30),
+        },
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Local-memory cache is per process, use a shared backend (memcached, database, ...)
+# when running more than one worker so invalidations reach every process.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'online-shop',
+    },
+    # Catalogue page cache, swap for FileBasedCache or a redis backend to share it between workers
+    'catalogue': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'online-shop-catalogue',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+CATALOGUE_CACHE_ALIAS = 'catalogue'
+CATALOGUE_CACHE_TIMEOUT = 60 * 10
+
+# Background admin actions
+ADMIN_JOB_WORKERS = 2
+ADMIN_JOB_BATCH_SIZE = 1000
+# Seconds a worker owns a running job without finishing a batch, then the job can be resumed
+ADMIN_JOB_LEASE = 300
+
+# Product image derivatives, workers default to the number of CPUs
+CATALOGUE_IMAGE_WIDTHS = (160, 320, 640, 1280)
+CATALOGUE_IMAGE_WORKERS = None
+
 INTERNAL_IPS = [
     '127.0.0.1',
 ]
@@ -132,6 +174,8 @@ STATIC_ROOT = BASE_DIR / 'static'  # store static file
 STATICFILES_DIRS = [
     BASE_DIR / 'static_root'
 ]
+# Fingerprinted names and .gz/.br siblings, served by config.staticfiles in front of Django
+STATICFILES_STORAGE = 'config.staticfiles.CompressedManifestStaticFilesStorage'
 
 # Media files
 
@@ -142,3 +186,17 @@ MEDIA_ROOT = BASE_DIR / 'media'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Logging
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'transaction': {'handlers': ['console'], 'level': 'INFO'},
+        'catalogue.jobs': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
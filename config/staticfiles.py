@@ -0,0 +1,242 @@
+"""
+Fingerprinted, precompressed static files and a small WSGI/ASGI layer serving them.
+
+collectstatic stores every asset under a name containing the hash of its content
+(ManifestStaticFilesStorage) and writes .gz and, when the brotli package is
+installed, .br siblings. The serving layer indexes STATIC_ROOT once at startup,
+picks the smallest encoding the client accepts and marks fingerprinted files
+immutable, so only the page itself goes through Django.
+"""
+import asyncio
+import gzip
+import mimetypes
+import os
+from email.utils import formatdate
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.map', '.svg', '.json', '.txt', '.html', '.xml', '.ico', '.eot', '.ttf')
+MIN_COMPRESS_SIZE = 256
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CACHE_CONTROL = 'public, max-age=60'
+BLOCK_SIZE = 64 * 1024
+
+
+def compress(path):
+    """Write .gz and .br siblings of path, only those smaller than the file. Return written paths."""
+    with open(path, 'rb') as file:
+        content = file.read()
+    compressed = {'.gz': gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed['.br'] = brotli.compress(content)
+
+    written = []
+    for extension, data in compressed.items():
+        if len(data) < len(content):
+            with open(path + extension, 'wb') as file:
+                file.write(data)
+            written.append(path + extension)
+    return written
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that also precompresses collected files. The manifest is read
+    once when the storage is created and urls are memoized, {% static %} is a dict
+    lookup after the first use of a name.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._urls = {}
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+        names = set(paths) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if name.endswith(COMPRESSIBLE_EXTENSIONS) and self.exists(name) and self.size(name) >= MIN_COMPRESS_SIZE:
+                compress(self.path(name))
+
+    def stored_name(self, name):
+        if not self.hashed_files:
+            # collectstatic has not run (development, tests), the finders serve plain names
+            return name
+        return super().stored_name(name)
+
+    def url(self, name, force=False):
+        if settings.DEBUG or force:
+            return super().url(name, force)
+        try:
+            return self._urls[name]
+        except KeyError:
+            url = self._urls[name] = super().url(name)
+            return url
+
+
+class StaticFile:
+    def __init__(self, path, immutable):
+        stat = os.stat(path)
+        self.path = path
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self.cache_control = IMMUTABLE_CACHE_CONTROL if immutable else CACHE_CONTROL
+        self.variants = {None: (path, stat.st_size)}
+        for encoding, extension in ENCODINGS:
+            if os.path.exists(path + extension):
+                self.variants[encoding] = (path + extension, os.path.getsize(path + extension))
+        self.etag = f'"{int(stat.st_mtime):x}-{stat.st_size:x}"'
+
+    def select(self, accept_encoding):
+        """(path, headers) of the smallest variant the client accepts"""
+        accepted = accepted_encodings(accept_encoding)
+        encoding = min(
+            (encoding for encoding in self.variants if encoding is None or encoding in accepted),
+            key=lambda encoding: self.variants[encoding][1]
+        )
+        path, size = self.variants[encoding]
+        headers = [
+            ('Content-Type', self.content_type),
+            ('Content-Length', str(size)),
+            ('Cache-Control', self.cache_control),
+            ('Last-Modified', self.last_modified),
+            ('ETag', self.etag if encoding is None else f'{self.etag[:-1]}-{encoding}"'),
+        ]
+        if len(self.variants) > 1:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if encoding is not None:
+            headers.append(('Content-Encoding', encoding))
+        return path, headers
+
+
+def accepted_encodings(header):
+    """Encodings of an Accept-Encoding header, without those refused with q=0"""
+    encodings = set()
+    for item in (header or '').split(','):
+        encoding, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if encoding and quality > 0:
+            encodings.add(encoding.lower())
+    return encodings
+
+
+class StaticFiles:
+    """Index of the files under root, built once. Fingerprinted names of the manifest are immutable."""
+
+    def __init__(self, root, prefix, immutable_names=()):
+        self.prefix = prefix
+        self.files = {}
+        immutable_names = set(immutable_names)
+        encoded_extensions = tuple(extension for _, extension in ENCODINGS)
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                if name.endswith(encoded_extensions) and os.path.exists(os.path.splitext(path)[0]):
+                    # Served as a variant of the original
+                    continue
+                self.files[name] = StaticFile(path, name in immutable_names)
+
+    @classmethod
+    def from_settings(cls):
+        hashed_files = getattr(staticfiles_storage, 'hashed_files', {})
+        return cls(settings.STATIC_ROOT or '', settings.STATIC_URL, hashed_files.values())
+
+    def find(self, method, path):
+        if method not in ('GET', 'HEAD') or not path.startswith(self.prefix):
+            return None
+        return self.files.get(unquote(path[len(self.prefix):]))
+
+    @staticmethod
+    def response(file, accept_encoding, if_none_match):
+        """(status, headers, path to send or None)"""
+        path, headers = file.select(accept_encoding)
+        etag = dict(headers)['ETag']
+        if if_none_match and etag in (tag.strip() for tag in if_none_match.split(',')):
+            return 304, [header for header in headers if header[0] not in ('Content-Length', 'Content-Type')], None
+        return 200, headers, path
+
+
+class StaticFilesWSGI:
+    """WSGI middleware answering requests of static files before they reach Django"""
+
+    def __init__(self, application, files=None):
+        self.application = application
+        self.files = StaticFiles.from_settings() if files is None else files
+
+    def __call__(self, environ, start_response):
+        file = self.files.find(environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''))
+        if file is None:
+            return self.application(environ, start_response)
+
+        status, headers, path = self.files.response(
+            file, environ.get('HTTP_ACCEPT_ENCODING'), environ.get('HTTP_IF_NONE_MATCH')
+        )
+        start_response('200 OK' if status == 200 else '304 Not Modified', headers)
+        if path is None or environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        stream = open(path, 'rb')
+        if file_wrapper:
+            return file_wrapper(stream, BLOCK_SIZE)
+        return _read_blocks(stream)
+
+
+def _read_blocks(stream):
+    with stream:
+        while True:
+            block = stream.read(BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+
+
+class StaticFilesASGI:
+    """ASGI counterpart of StaticFilesWSGI, file reads run in the default executor"""
+
+    def __init__(self, application, files=None):
+        self.application = application
+        self.files = StaticFiles.from_settings() if files is None else files
+
+    async def __call__(self, scope, receive, send):
+        file = self.files.find(scope.get('method'), scope.get('path', '')) if scope['type'] == 'http' else None
+        if file is None:
+            return await self.application(scope, receive, send)
+
+        request_headers = {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope['headers']}
+        status, headers, path = self.files.response(
+            file, request_headers.get('accept-encoding'), request_headers.get('if-none-match')
+        )
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers],
+        })
+        if path is None or scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        loop = asyncio.get_running_loop()
+        with open(path, 'rb') as stream:
+            while True:
+                block = await loop.run_in_executor(None, stream.read, BLOCK_SIZE)
+                more = len(block) == BLOCK_SIZE
+                await send({'type': 'http.response.body', 'body': block, 'more_body': more})
+                if not more:
+                    return
@@ -0,0 +1,221 @@
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import skipUnless
+
+import psycopg2
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.template import Context, Template
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from config.pooled_postgresql.pool import ConnectionPool, PoolTimeout, get_pool_stats
+from config.staticfiles import StaticFiles, StaticFilesASGI, StaticFilesWSGI, accepted_encodings
+
+
+class StaticFilesTest(SimpleTestCase):
+    def setUp(self):
+        static_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, static_root)
+        static_settings = override_settings(STATIC_ROOT=static_root)
+        static_settings.enable()
+        self.addCleanup(static_settings.disable)
+
+    def collect(self):
+        call_command('collectstatic', interactive=False, verbosity=0)
+        with open(os.path.join(settings.STATIC_ROOT, 'staticfiles.json')) as manifest:
+            return json.load(manifest)['paths']
+
+    def application(self, environ, start_response):
+        start_response('404 Not Found', [])
+        return [b'django']
+
+    def get(self, path, **headers):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, **headers}
+        response = {}
+
+        def start_response(status, response_headers):
+            response['status'], response['headers'] = status, dict(response_headers)
+
+        files = StaticFiles.from_settings()
+        body = b''.join(StaticFilesWSGI(self.application, files=files)(environ, start_response))
+        return response['status'], response['headers'], body
+
+    def test_static_tag_without_manifest(self):
+        self.assertEqual(
+            Template('{% load static %}{% static "catalogue/css/catalogue-style.css" %}').render(Context()),
+            '/static/catalogue/css/catalogue-style.css'
+        )
+
+    def test_collect_fingerprints_and_compresses(self):
+        paths = self.collect()
+        self.assertRegex(
+            paths['catalogue/css/catalogue-style.css'], r'^catalogue/css/catalogue-style\.[0-9a-f]{12}\.css$'
+        )
+        hashed = paths['admin/css/base.css']
+        path = os.path.join(settings.STATIC_ROOT, hashed)
+        with open(path, 'rb') as original, gzip.open(path + '.gz') as compressed:
+            self.assertEqual(compressed.read(), original.read())
+        # Images are already compressed
+        self.assertFalse(os.path.exists(os.path.join(settings.STATIC_ROOT, paths['images/no-image.png']) + '.gz'))
+
+        self.assertEqual(
+            Template('{% load static %}{% static "admin/css/base.css" %}').render(Context()), f'/static/{hashed}'
+        )
+
+    def test_wsgi_layer(self):
+        hashed = self.collect()['admin/css/base.css']
+
+        status, headers, body = self.get(f'/static/{hashed}', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(headers['Content-Type'], 'text/css')
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        with open(os.path.join(settings.STATIC_ROOT, hashed), 'rb') as original:
+            self.assertEqual(gzip.decompress(body), original.read())
+
+        # ETag of the gzip variant does not match the plain one
+        status, headers, body = self.get(f'/static/{hashed}', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('Content-Encoding', headers)
+        status, _, body = self.get(f'/static/{hashed}', HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual((status, body), ('304 Not Modified', b''))
+
+        status, headers, _ = self.get('/static/admin/css/base.css')
+        self.assertEqual(headers['Cache-Control'], 'public, max-age=60')
+        self.assertEqual(self.get('/static/missing.css')[2], b'django')
+        self.assertEqual(self.get('/catalogue/')[2], b'django')
+
+    def test_asgi_layer(self):
+        hashed = self.collect()['catalogue/js/catalogue-app.js']
+        application = StaticFilesASGI(None, files=StaticFiles.from_settings())
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'path': f'/static/{hashed}', 'headers': []}
+        asyncio.run(application(scope, None, send))
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'cache-control', b'public, max-age=31536000, immutable'), messages[0]['headers'])
+        with open(os.path.join(settings.STATIC_ROOT, hashed), 'rb') as original:
+            self.assertEqual(b''.join(message['body'] for message in messages[1:]), original.read())
+
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('br;q=1.0, gzip;q=0, *'), {'br', '*'})
+        self.assertEqual(accepted_encodings(None), set())
+
+
+@skipUnless(connection.settings_dict['ENGINE'] == 'config.pooled_postgresql', 'pooled PostgreSQL backend')
+class ConnectionPoolTest(SimpleTestCase):
+    databases = {'default'}
+
+    def pool(self, **options):
+        params = connection.get_connection_params()
+        pool = ConnectionPool(lambda: psycopg2.connect(**params), **options)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_connections_are_reused(self):
+        pool = self.pool(min_size=1, max_size=2)
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        stats = pool.stats()
+        self.assertEqual((stats['connections_created'], stats['checkouts'], stats['in_use']), (1, 2, 1))
+
+    def test_open_transaction_is_rolled_back(self):
+        pool = self.pool(min_size=0)
+        conn = pool.acquire()
+        conn.cursor().execute('CREATE TEMPORARY TABLE pool_test (id integer)')
+        pool.release(conn)
+        conn = pool.acquire()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_class WHERE relname = 'pool_test'")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_session_state_is_discarded(self):
+        pool = self.pool(min_size=0)
+        conn = pool.acquire()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            default_timeout = cursor.fetchone()[0]
+            cursor.execute("SET statement_timeout = '1234ms'")
+            cursor.execute('CREATE TEMPORARY TABLE pool_test (id integer)')
+            cursor.execute('PREPARE pool_test AS SELECT 1')
+        pool.release(conn)
+
+        self.assertIs(pool.acquire(), conn)
+        self.assertTrue(conn.autocommit)
+        with conn.cursor() as cursor:
+            cursor.execute('SHOW statement_timeout')
+            self.assertEqual(cursor.fetchone()[0], default_timeout)
+            cursor.execute("SELECT count(*) FROM pg_class WHERE relname = 'pool_test'")
+            self.assertEqual(cursor.fetchone()[0], 0)
+            cursor.execute('SELECT count(*) FROM pg_prepared_statements')
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_waits_for_a_released_connection(self):
+        pool = self.pool(min_size=0, max_size=1, timeout=0.1)
+        conn = pool.acquire()
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+
+        timer = threading.Timer(0.05, pool.release, (conn,))
+        timer.start()
+        pool.timeout = 5
+        self.assertIs(pool.acquire(), conn)
+        timer.join()
+        stats = pool.stats()
+        self.assertEqual((stats['waits'], stats['timeouts'], stats['connections_created']), (2, 1, 1))
+
+    def test_broken_connection_is_replaced(self):
+        pool = self.pool(min_size=1, health_check_interval=0)
+        conn = pool.acquire()
+        pool.release(conn)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [conn.get_backend_pid()])
+        time.sleep(0.1)
+
+        replacement = pool.acquire()
+        self.assertIsNot(replacement, conn)
+        self.assertTrue(conn.closed)
+        stats = pool.stats()
+        self.assertEqual((stats['health_check_failures'], stats['connections_created'], stats['size']), (1, 2, 1))
+
+    def test_django_connection_returns_to_pool(self):
+        connection.ensure_connection()
+        conn = connection.connection
+        created = get_pool_stats()[connection.alias]['connections_created']
+        connection.close()
+        self.assertFalse(conn.closed)
+        # Survives the reset of the released connection
+        self.assertEqual(conn.get_parameter_status('TimeZone'), connection.timezone_name)
+
+        connection.ensure_connection()
+        self.assertIs(connection.connection, conn)
+        stats = get_pool_stats()[connection.alias]
+        self.assertEqual(stats['connections_created'], created)
+        self.assertEqual(stats['pid'], os.getpid())
+
+
+@skipUnless(connection.settings_dict['ENGINE'] == 'config.pooled_postgresql', 'pooled PostgreSQL backend')
+class DatabasePoolStatsViewTest(TestCase):
+    def test_staff_only(self):
+        url = reverse('database-pool-stats')
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        user = get_user_model().objects.create_user('staff', password='secret', is_staff=True)
+        self.client.force_login(user)
+        stats = self.client.get(url).json()
+        self.assertGreaterEqual(stats[connection.alias]['max_size'], 1)
@@ -4,7 +4,10 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 
+from config.views import database_pool_stats
+
 urlpatterns = [
+    path('admin/database-pool/', database_pool_stats, name='database-pool-stats'),
     path('admin/', admin.site.urls),
 
     path('blog/', include('blog.urls', namespace='blog')),
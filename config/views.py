@@ -0,0 +1,10 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+
+from config.pooled_postgresql.pool import get_pool_stats
+
+
+@staff_member_required
+def database_pool_stats(request):
+    """Connection pool metrics of the worker process answering the request"""
+    return JsonResponse(get_pool_stats())
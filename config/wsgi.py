@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_wsgi_application()
+
+# Imported after setup, the static layer reads the manifest of the configured storage
+from config.staticfiles import StaticFilesWSGI  # noqa: E402
+
+application = StaticFilesWSGI(application)
@@ -1,5 +1,10 @@
 from django.contrib import admin
+from django.db import transaction
 
+from catalogue.cache import invalidate_products
+from catalogue.jobs import BackgroundActionMixin, job_action
+from catalogue.models import Product
+from partner.feeds import delete_stocks
 from partner.models import Partner, PartnerStock
 
 
@@ -9,6 +14,20 @@ class PartnerStockInline(admin.TabularInline):
 
 
 @admin.register(Partner)
-class PartnerAdmin(admin.ModelAdmin):
+class PartnerAdmin(BackgroundActionMixin, admin.ModelAdmin):
     inlines = (PartnerStockInline,)
     list_display = ('name',)
+
+    actions = ('withdraw_offers',)
+
+    @admin.action(description='Withdraw offers of selected partners')
+    def withdraw_offers(self, request, queryset):
+        self.run_in_background(request, 'delete_partner_stocks', PartnerStock.objects.filter(partner__in=queryset))
+
+
+@job_action('delete_partner_stocks')
+def delete_partner_stocks(stock_ids):
+    product_ids = set(PartnerStock.objects.filter(pk__in=stock_ids).values_list('product_id', flat=True))
+    delete_stocks(stock_ids)
+    Product.refresh_offer_summaries(Product.objects.filter(pk__in=product_ids))
+    transaction.on_commit(lambda: invalidate_products(product_ids))
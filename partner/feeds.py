@@ -0,0 +1,190 @@
+"""
+Partner price feeds: the full list of (UPC, price) offers of one partner.
+
+Applying a feed diffs it against the partner's current stocks a chunk at a time
+and writes only the differences, so the number of queries depends on the number
+of chunks, not of lines. Stocks of products missing from the feed are deleted,
+unless the feed has no valid line or too many invalid ones: a truncated or broken
+feed must not withdraw all offers of the partner.
+"""
+import csv
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection, transaction
+
+from catalogue.cache import invalidate_products
+from catalogue.models import Product
+from partner.models import PartnerStock
+
+CHUNK_SIZE = 1000
+MAX_ERRORS = 100
+# Missing stocks are kept when more than this share of feed lines is invalid
+DELETE_MAX_ERROR_RATIO = 0.1
+COLUMNS = ('upc', 'price')
+
+
+class FeedError(ValueError):
+    pass
+
+
+def read_feed(stream):
+    """Yield (line number, upc, price) of a CSV feed with upc and price columns"""
+    reader = csv.DictReader(stream)
+    missing = [column for column in COLUMNS if column not in (reader.fieldnames or ())]
+    if missing:
+        raise FeedError(f'feed header has no {", ".join(missing)} column')
+    # Header is line 1
+    for line_number, record in enumerate(reader, 2):
+        yield line_number, record.get('upc'), record.get('price')
+
+
+def parse_upc(upc):
+    try:
+        return int(upc)
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid upc "{upc}"')
+
+
+def parse_price(price):
+    try:
+        price = Decimal(price).quantize(Decimal('0.01'))
+    except (TypeError, ValueError, InvalidOperation):
+        raise ValueError(f'invalid price "{price}"')
+    if price < 0 or price.adjusted() >= 8:
+        raise ValueError(f'price out of range "{price}"')
+    return price
+
+
+class FeedResult:
+    def __init__(self):
+        self.created = self.updated = self.unchanged = self.deleted = 0
+        self.lines = 0
+        self.errors = []
+        self.error_count = 0
+        self.delete_refused = None
+
+    def error(self, line_number, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(f'line {line_number}: {message}')
+
+    def as_dict(self):
+        return {
+            'created': self.created, 'updated': self.updated, 'unchanged': self.unchanged,
+            'deleted': self.deleted, 'errors': self.error_count,
+        }
+
+
+def apply_feed(partner, lines, chunk_size=CHUNK_SIZE, delete_missing=True):
+    """
+    Make stocks of partner match feed lines of (line number, upc, price). Each chunk
+    of lines costs one product lookup, one read of current stocks, at most one
+    bulk_update, bulk_create and delete, and the offer summary refresh of touched
+    products. Unknown products and invalid lines are reported in the result.
+    """
+    result = FeedResult()
+    seen = set()
+    chunk = []
+    for line in lines:
+        result.lines += 1
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            _apply_chunk(partner, chunk, seen, result)
+            chunk = []
+    _apply_chunk(partner, chunk, seen, result)
+
+    if delete_missing:
+        if not result.created + result.updated + result.unchanged:
+            result.delete_refused = 'feed has no valid line'
+        elif result.error_count > result.lines * DELETE_MAX_ERROR_RATIO:
+            result.delete_refused = f'{result.error_count} of {result.lines} lines are invalid'
+        else:
+            _delete_missing(partner, seen, chunk_size, result)
+    return result
+
+
+def _apply_chunk(partner, lines, seen, result):
+    if not lines:
+        return
+
+    prices, kept = {}, set()
+    for line_number, upc, price in lines:
+        try:
+            upc = parse_upc(upc)
+            # A later line of the same product wins
+            prices[upc] = (line_number, parse_price(price))
+        except ValueError as e:
+            result.error(line_number, e)
+            if isinstance(upc, int):
+                # Stock of a line with a bad price is left as it is, not deleted
+                kept.add(upc)
+
+    product_ids = dict(Product.objects.filter(upc__in=prices.keys() | kept).values_list('upc', 'pk'))
+    for upc, (line_number, _) in prices.items():
+        if upc not in product_ids:
+            result.error(line_number, f'unknown product "{upc}"')
+    seen.update(product_ids[upc] for upc in kept if upc in product_ids)
+    prices = {product_ids[upc]: price for upc, (_, price) in prices.items() if upc in product_ids}
+    seen.update(prices)
+
+    stocks = {}
+    duplicates = {}
+    for stock in PartnerStock.objects.filter(partner=partner, product_id__in=prices).order_by('pk').only(
+        'pk', 'product_id', 'price'
+    ):
+        if stock.product_id in stocks:
+            duplicates[stock.pk] = stock.product_id
+        else:
+            stocks[stock.product_id] = stock
+
+    created, updated = [], []
+    for product_id, price in prices.items():
+        stock = stocks.get(product_id)
+        if stock is None:
+            created.append(PartnerStock(partner=partner, product_id=product_id, price=price))
+        elif stock.price != price:
+            stock.price = price
+            updated.append(stock)
+        else:
+            result.unchanged += 1
+
+    with transaction.atomic():
+        PartnerStock.objects.bulk_update(updated, fields=('price',))
+        PartnerStock.objects.bulk_create(created)
+        if duplicates:
+            delete_stocks(list(duplicates))
+    result.created += len(created)
+    result.updated += len(updated)
+    result.deleted += len(duplicates)
+
+    _refresh({stock.product_id for stock in created + updated} | set(duplicates.values()))
+
+
+def _delete_missing(partner, seen, chunk_size, result):
+    """Delete stocks of products not in the feed, reading partner stocks in pk order"""
+    stocks = PartnerStock.objects.filter(partner=partner).order_by('pk').values_list('pk', 'product_id')
+    last_pk = 0
+    while True:
+        chunk = list(stocks.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        missing = [(pk, product_id) for pk, product_id in chunk if product_id not in seen]
+        if missing:
+            delete_stocks([pk for pk, _ in missing])
+            result.deleted += len(missing)
+            _refresh({product_id for _, product_id in missing})
+
+
+def delete_stocks(ids):
+    # QuerySet.delete would send post_delete, and refresh the offer summary, once per row
+    placeholders = ', '.join(['%s'] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {PartnerStock._meta.db_table} WHERE id IN ({placeholders})', ids)
+
+
+def _refresh(product_ids):
+    """Bulk writes skip PartnerStock signals, redo their work once per chunk"""
+    if product_ids:
+        Product.refresh_offer_summaries(Product.objects.filter(pk__in=product_ids))
+        invalidate_products(product_ids)
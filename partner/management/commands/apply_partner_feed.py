@@ -0,0 +1,53 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from partner.feeds import CHUNK_SIZE, FeedError, apply_feed, read_feed
+from partner.models import Partner
+
+
+class Command(BaseCommand):
+    help = 'Make stocks of a partner match its CSV price feed (upc,price columns), writing only the changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('partner', help='Partner id or name')
+        parser.add_argument('path', help='CSV feed, - for stdin')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='Feed lines applied per chunk')
+        parser.add_argument(
+            '--keep-missing', action='store_true', help='Keep stocks of products that are not in the feed'
+        )
+
+    def handle(self, *args, **options):
+        partner = self.get_partner(options['partner'])
+
+        try:
+            if options['path'] == '-':
+                result = self.apply(partner, sys.stdin, options)
+            else:
+                with open(options['path'], newline='', encoding='utf-8') as stream:
+                    result = self.apply(partner, stream, options)
+        except FeedError as e:
+            raise CommandError(e)
+
+        for error in result.errors:
+            self.stderr.write(error)
+        if result.delete_refused:
+            self.stderr.write(f'Stocks of products missing from the feed were kept: {result.delete_refused}')
+        self.stdout.write(self.style.SUCCESS(
+            'Applied feed of {partner}: {created} created, {updated} updated, {unchanged} unchanged, '
+            '{deleted} deleted, {errors} errors'.format(partner=partner, **result.as_dict())
+        ))
+
+    @staticmethod
+    def apply(partner, stream, options):
+        return apply_feed(
+            partner, read_feed(stream), chunk_size=options['chunk_size'], delete_missing=not options['keep_missing']
+        )
+
+    @staticmethod
+    def get_partner(value):
+        partners = Partner.objects.filter(pk=int(value)) if value.isdigit() else Partner.objects.filter(name=value)
+        partners = list(partners[:2])
+        if len(partners) != 1:
+            raise CommandError(f'Partner "{value}" does not exist or is not unique, use its id')
+        return partners[0]
@@ -0,0 +1,21 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from catalogue.cache import invalidate_tags_on_commit, product_ids_tags
+from catalogue.models import Product
+from partner.models import Partner, PartnerStock
+
+
+@receiver([post_save, post_delete], sender=PartnerStock)
+def partner_stock_changed(sender, instance, **kwargs):
+    Product.refresh_offer_summaries(Product.objects.filter(pk=instance.product_id))
+
+
+@receiver([post_save, post_delete], sender=PartnerStock)
+def partner_stock_changed_invalidate_cache(sender, instance, **kwargs):
+    invalidate_tags_on_commit(product_ids_tags([instance.product_id]))
+
+
+@receiver([post_save, post_delete], sender=Partner)
+def partner_changed_invalidate_cache(sender, instance, **kwargs):
+    invalidate_tags_on_commit([f'partner:{instance.pk}'])
@@ -1,3 +1,141 @@
+import io
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from catalogue.jobs import run_job
+from catalogue.models import Product, AdminJob
+from catalogue.tests import create_products
+from partner.feeds import FeedError, apply_feed, read_feed
+from partner.models import Partner, PartnerStock
+
+
+class OfferSummaryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product, = create_products([1])
+        cls.digikala = Partner.objects.create(name='Digikala')
+        cls.bamilo = Partner.objects.create(name='Bamilo')
+
+    def summary(self):
+        product = Product.objects.get(pk=self.product.pk)
+        return product.best_price, product.max_price, product.offer_count, product.best_partner
+
+    def test_summary_follows_stocks(self):
+        self.assertEqual(self.summary(), (None, None, 0, None))
+
+        stock = PartnerStock.objects.create(product=self.product, partner=self.digikala, price=120)
+        self.assertEqual(self.summary(), (Decimal(120), Decimal(120), 1, self.digikala))
+        PartnerStock.objects.create(product=self.product, partner=self.bamilo, price=150)
+        self.assertEqual(self.summary(), (Decimal(120), Decimal(150), 2, self.digikala))
+
+        stock.price = 200
+        stock.save()
+        self.assertEqual(self.summary(), (Decimal(150), Decimal(200), 2, self.bamilo))
+
+        stock.delete()
+        self.assertEqual(self.summary(), (Decimal(150), Decimal(150), 1, self.bamilo))
+        self.bamilo.delete()
+        self.assertEqual(self.summary(), (None, None, 0, None))
+
+    def test_price_ties_keep_first_stock(self):
+        PartnerStock.objects.create(product=self.product, partner=self.bamilo, price=100)
+        PartnerStock.objects.create(product=self.product, partner=self.digikala, price=100)
+        self.assertEqual(self.summary()[3], self.bamilo)
+        self.assertEqual(list(Product.objects.price_range(100, 100)), [self.product])
+
+
+class PartnerFeedTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = create_products(range(1, 11))
+        cls.partner = Partner.objects.create(name='Digikala')
+        cls.other = Partner.objects.create(name='Bamilo')
+        for product in cls.products[:4]:
+            PartnerStock.objects.create(product=product, partner=cls.partner, price=100)
+        PartnerStock.objects.create(product=cls.products[0], partner=cls.other, price=90)
+
+    def feed(self, lines):
+        return read_feed(io.StringIO('upc,price\n' + ''.join(f'{upc},{price}\n' for upc, price in lines)))
+
+    def prices(self, partner):
+        return dict(PartnerStock.objects.filter(partner=partner).values_list('product__upc', 'price'))
+
+    def test_applies_only_changes(self):
+        result = apply_feed(self.partner, self.feed([(1, '100'), (2, '95.5'), (3, '100.00'), (5, '80')]))
+        self.assertEqual(
+            result.as_dict(), {'created': 1, 'updated': 1, 'unchanged': 2, 'deleted': 1, 'errors': 0}
+        )
+        self.assertEqual(
+            self.prices(self.partner), {1: Decimal(100), 2: Decimal('95.50'), 3: Decimal(100), 5: Decimal(80)}
+        )
+        self.assertEqual(self.prices(self.other), {1: Decimal(90)})
+
+        product = Product.objects.get(upc=2)
+        self.assertEqual((product.best_price, product.offer_count), (Decimal('95.50'), 1))
+        self.assertEqual(Product.objects.get(upc=4).offer_count, 0)
+        self.assertEqual(Product.objects.get(upc=5).best_partner, self.partner)
+
+    def test_keep_missing(self):
+        result = apply_feed(self.partner, self.feed([(5, '80')]), delete_missing=False)
+        self.assertEqual((result.created, result.deleted), (1, 0))
+        self.assertEqual(len(self.prices(self.partner)), 5)
+
+    def test_invalid_lines_are_reported(self):
+        result = apply_feed(self.partner, self.feed([(1, 'free'), ('x', '10'), (99, '10'), (2, '-1'), (3, '50')]))
+        self.assertEqual(result.error_count, 4)
+        self.assertIn('line 2: invalid price "free"', result.errors)
+        self.assertIn('line 4: unknown product "99"', result.errors)
+        # Too many invalid lines, stock of upc 4 is kept although it is not in the feed
+        self.assertEqual(result.delete_refused, '4 of 5 lines are invalid')
+        self.assertEqual(
+            self.prices(self.partner), {1: Decimal(100), 2: Decimal(100), 3: Decimal(50), 4: Decimal(100)}
+        )
+
+    def test_invalid_header_is_rejected(self):
+        for header in ('', 'product,cost\n', 'upc\n'):
+            with self.assertRaises(FeedError):
+                apply_feed(self.partner, read_feed(io.StringIO(header + '1,50\n')))
+        self.assertEqual(len(self.prices(self.partner)), 4)
+
+    def test_broken_feed_deletes_nothing(self):
+        for lines in ([], [('x', '10'), (99, '10')], [(1, 'free')]):
+            result = apply_feed(self.partner, self.feed(lines))
+            self.assertEqual((result.deleted, result.delete_refused), (0, 'feed has no valid line'))
+        self.assertEqual(len(self.prices(self.partner)), 4)
+
+        # Within the error threshold missing stocks are deleted
+        lines = [(upc, '100') for upc in range(3, 11)] + [(3, '100'), (99, '10')]
+        result = apply_feed(self.partner, self.feed(lines))
+        self.assertEqual((result.deleted, result.delete_refused), (2, None))
+
+    def test_query_count_depends_on_chunks(self):
+        query_counts = []
+        # Both feeds update existing stocks and create new ones
+        for upcs, price in ((range(1, 6), 10), (range(1, 11), 20)):
+            lines = [(upc, price) for upc in upcs]
+            with CaptureQueriesContext(connection) as queries:
+                apply_feed(self.partner, self.feed(lines), chunk_size=20)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_withdraw_offers_in_background(self):
+        self.client.force_login(
+            User.objects.create_superuser(username='admin', password='secret', email='admin@gmail.com')
+        )
+        with self.captureOnCommitCallbacks():
+            self.client.post('/admin/partner/partner/', {
+                'action': 'withdraw_offers', 'index': '0', '_selected_action': [self.partner.pk],
+            })
+        job = AdminJob.objects.get()
+        self.assertEqual((job.model, job.total), ('partner.partnerstock', 4))
 
-# Create your tests here.
+        with self.captureOnCommitCallbacks(execute=True):
+            run_job(job.pk)
+        self.assertEqual(self.prices(self.partner), {})
+        self.assertEqual(self.prices(self.other), {1: Decimal(90)})
+        self.assertEqual(Product.objects.get(upc=1).best_partner, self.other)
+        self.assertEqual(Product.objects.get(upc=2).offer_count, 0)
@@ -1,18 +1,42 @@
 from django.contrib import admin
 
-from transaction.models import Transaction, TransactionArchive, UserBalance
+from catalogue.pagination import EstimatedCountPaginator
+from transaction.models import Transaction, TransactionArchive, UserBalance, BalanceLedger, OpeningBalance, UserReport
+
+
+class UserRowAdmin(admin.ModelAdmin):
+    """Rows of users: users joined in the changelist, estimated counts, no select of every user in forms"""
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Transaction)
-class TransactionAdmin(admin.ModelAdmin):
+class TransactionAdmin(UserRowAdmin):
     list_display = ('user', 'transaction_type', 'amount', 'create_time')
 
 
 @admin.register(TransactionArchive)
-class TransactionArchiveAdmin(admin.ModelAdmin):
+class TransactionArchiveAdmin(UserRowAdmin):
     list_display = ('user', 'transaction_type', 'amount', 'create_time')
 
 
 @admin.register(UserBalance)
-class UserBalanceAdmin(admin.ModelAdmin):
+class UserBalanceAdmin(UserRowAdmin):
     list_display = ('user', 'balance', 'create_time')
+
+
+@admin.register(BalanceLedger)
+class BalanceLedgerAdmin(UserRowAdmin):
+    list_display = ('user', 'balance', 'update_time')
+
+
+@admin.register(OpeningBalance)
+class OpeningBalanceAdmin(UserRowAdmin):
+    list_display = ('user', 'balance', 'update_time')
+
+
+@admin.register(UserReport)
+class UserReportAdmin(UserRowAdmin):
+    list_display = ('user', 'transaction_count', 'credit', 'debit', 'update_time')
@@ -0,0 +1,113 @@
+"""
+Eligibility of users for gated views: one declared policy per view, checked against
+a cached profile (permissions and score) of the user.
+"""
+import uuid
+from functools import wraps
+
+from django.apps import apps
+from django.contrib.auth.views import redirect_to_login
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import resolve_url
+
+VERSION_KEY = 'eligibility:version'
+PROFILE_KEY = 'eligibility:user:{user_id}'
+PROFILE_TIMEOUT = 60 * 60
+
+
+def build_profile(user):
+    UserScore = apps.get_model('transaction', 'UserScore')
+    return {
+        'perms': frozenset(user.get_all_permissions()),
+        'score': UserScore.objects.filter(user_id=user.pk).values_list('score', flat=True).first() or 0,
+    }
+
+
+def get_profile(user):
+    """
+    Permissions and score of user. The entry is valid while the global version
+    (bumped when group permissions change) is unchanged, both come in one cache lookup.
+    """
+    key = PROFILE_KEY.format(user_id=user.pk)
+    entries = cache.get_many((VERSION_KEY, key))
+    version, entry = entries.get(VERSION_KEY), entries.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(VERSION_KEY, version, timeout=None)
+    if entry is not None and entry['version'] == version:
+        return entry['profile']
+
+    profile = build_profile(user)
+    cache.set(key, {'version': version, 'profile': profile}, timeout=PROFILE_TIMEOUT)
+    return profile
+
+
+def invalidate_users(user_ids):
+    cache.delete_many([PROFILE_KEY.format(user_id=user_id) for user_id in user_ids])
+
+
+def invalidate_all():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+class Policy:
+    """
+    Requirements of a view: tests on the user object, permissions and a minimum
+    score. Failing tests or score redirect to login_url, failing permissions raise
+    PermissionDenied when raise_exception is set.
+    """
+
+    def __init__(self, tests=(), perms=(), min_score=None, login_url=None, raise_exception=False):
+        self.tests = tests
+        self.perms = frozenset(perms)
+        self.min_score = min_score
+        self.login_url = login_url
+        self.raise_exception = raise_exception
+
+    def redirect(self, request):
+        return redirect_to_login(request.get_full_path(), resolve_url(self.login_url) if self.login_url else None)
+
+    def has_perms(self, user, profile):
+        if not user.is_active:
+            return not self.perms
+        # Same rule as ModelBackend.has_perm
+        return user.is_superuser or self.perms <= profile['perms']
+
+    def check(self, request):
+        """Return None when request.user is eligible, otherwise the response to return"""
+        user = request.user
+        if not user.is_authenticated:
+            return self.redirect(request)
+
+        profile = get_profile(user)
+        # ModelBackend reads permissions from this attribute, has_perm in the view costs no queries
+        user._perm_cache = set(profile['perms'])
+        user.score = profile['score']
+
+        if not all(test(user) for test in self.tests):
+            return self.redirect(request)
+        if self.min_score is not None and profile['score'] < self.min_score:
+            return self.redirect(request)
+        if not self.has_perms(user, profile):
+            if self.raise_exception:
+                raise PermissionDenied
+            return self.redirect(request)
+        return None
+
+
+def eligibility_required(policy=None, **kwargs):
+    """Decorator for views that checks request.user against policy, or Policy(**kwargs)"""
+    policy = policy or Policy(**kwargs)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = policy.check(request)
+            if response is not None:
+                return response
+            return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from transaction.models import TransactionArchive
+
+
+class Command(BaseCommand):
+    help = 'Move old transactions into the archive, carrying their balance forward'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=365, help='Archive transactions older than this many days')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Transactions moved per database transaction')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to pause between chunks')
+        parser.add_argument('--dry-run', action='store_true', help='Only count transactions that would be archived')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options['days'])
+        result = TransactionArchive.archive(
+            before, chunk_size=options['chunk_size'], sleep=options['sleep'], dry_run=options['dry_run']
+        )
+
+        message = f'{result["transaction_count"]} transactions of {result["user_count"]} users before {before}'
+        if options['dry_run']:
+            self.stdout.write(f'Would archive {message}')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Archived {message}'))
@@ -0,0 +1,36 @@
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from transaction import partitions
+
+
+class Command(BaseCommand):
+    help = 'Create monthly transaction partitions ahead of time and detach old ones (PostgreSQL only)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3, help='Months to create after the current one')
+        parser.add_argument(
+            '--retention', type=int,
+            help='Detach partitions older than this many months, only empty ones (run archive_transactions first)'
+        )
+        parser.add_argument('--drop', action='store_true', help='Drop detached partitions')
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned(connections['default']):
+            raise CommandError('Transaction table is not partitioned')
+
+        detach_before = None
+        if options['retention'] is not None:
+            now = datetime.now(timezone.utc)
+            detach_before = partitions.add_months(partitions.month_start(now), -options['retention'])
+
+        created, detached = partitions.maintain_partitions(
+            ahead=options['ahead'], detach_before=detach_before, drop=options['drop']
+        )
+        for name in created:
+            self.stdout.write(f'Created {name}')
+        for name in detached:
+            self.stdout.write(f'{"Dropped" if options["drop"] else "Detached"} {name}')
+        self.stdout.write(self.style.SUCCESS(f'{len(created)} partitions created, {len(detached)} detached'))
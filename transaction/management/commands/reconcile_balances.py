@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from transaction.models import BalanceLedger
+
+
+class Command(BaseCommand):
+    help = 'Check balance ledger against aggregated transactions and report drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Reset drifted balances to aggregated value')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Users checked per query')
+
+    def handle(self, *args, **options):
+        drifts = BalanceLedger.reconcile(fix=options['fix'], chunk_size=options['chunk_size'])
+        for user_id, ledger_balance, balance in drifts:
+            self.stdout.write(f'user {user_id}: ledger {ledger_balance}, transactions {balance}')
+
+        if not drifts:
+            self.stdout.write(self.style.SUCCESS('No drift'))
+        elif options['fix']:
+            self.stdout.write(self.style.SUCCESS(f'{len(drifts)} balances fixed'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{len(drifts)} balances drifted'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from transaction.models import UserReport
+
+
+class Command(BaseCommand):
+    help = 'Rebuild user report from transactions and archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Users refreshed per database transaction')
+
+    def handle(self, *args, **options):
+        UserReport.refresh(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('User report refreshed'))
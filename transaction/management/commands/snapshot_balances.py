@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from transaction.models import UserBalance
+
+
+class Command(BaseCommand):
+    help = 'Record balance of every user, resuming an interrupted run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Users recorded per statement')
+
+    def handle(self, *args, **options):
+        run = UserBalance.record_all_user_balance(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{run.user_count} balances recorded at {run.snapshot_time}'))
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.9 on 2026-10-18 14:30
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Sum, Q, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_balance_ledger(apps, schema_editor):
+    Transaction = apps.get_model('transaction', 'Transaction')
+    BalanceLedger = apps.get_model('transaction', 'BalanceLedger')
+
+    balances = Transaction.objects.order_by().values('user_id').annotate(
+        balance=Coalesce(Sum('amount', filter=Q(transaction_type__in=[1, 3])), Value(0)) -
+        Coalesce(Sum('amount', filter=Q(transaction_type__in=[2, 4])), Value(0))
+    )
+    BalanceLedger.objects.bulk_create(
+        (BalanceLedger(user_id=row['user_id'], balance=row['balance']) for row in balances.iterator()),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transaction', '0003_alter_userscore_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('balance', models.BigIntegerField(default=0)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, related_name='ledger', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(fill_balance_ledger, migrations.RunPython.noop),
+    ]
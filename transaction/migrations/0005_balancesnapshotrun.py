@@ -0,0 +1,23 @@
+# Generated by Django 3.2.9 on 2026-10-18 06:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transaction', '0004_balanceledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshotRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snapshot_time', models.DateTimeField()),
+                ('last_user_id', models.BigIntegerField(default=0)),
+                ('user_count', models.PositiveIntegerField(default=0)),
+                ('finish_time', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from transaction import partitions
+
+
+def partition_transactions(apps, schema_editor):
+    """Range partitions on create_time, one per month, PostgreSQL only"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    partitions.partition_table(schema_editor.connection)
+    partitions.create_partitions(schema_editor.connection)
+
+
+def unpartition_transactions(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    partitions.unpartition_table(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transaction', '0006_openingbalance'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transfertransaction',
+            name='receiver_transaction',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, related_name='received_transfers', to='transaction.transaction'),
+        ),
+        migrations.AlterField(
+            model_name='transfertransaction',
+            name='sender_transaction',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, related_name='send_transfers', to='transaction.transaction'),
+        ),
+        migrations.RunPython(partition_transactions, unpartition_transactions),
+    ]
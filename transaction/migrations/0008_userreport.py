@@ -0,0 +1,53 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:06
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Sum, Q, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_user_report(apps, schema_editor):
+    UserReport = apps.get_model('transaction', 'UserReport')
+
+    totals = {}
+    for model_name in ('Transaction', 'TransactionArchive'):
+        rows = apps.get_model('transaction', model_name).objects.order_by().values('user_id').annotate(
+            transaction_count=Count('id'),
+            credit=Coalesce(Sum('amount', filter=Q(transaction_type__in=[1, 3])), Value(0)),
+            debit=Coalesce(Sum('amount', filter=Q(transaction_type__in=[2, 4])), Value(0))
+        )
+        for row in rows.iterator():
+            count, credit, debit = totals.get(row['user_id'], (0, 0, 0))
+            totals[row['user_id']] = (count + row['transaction_count'], credit + row['credit'], debit + row['debit'])
+
+    UserReport.objects.bulk_create(
+        (
+            UserReport(user_id=user_id, transaction_count=count, credit=credit, debit=debit)
+            for user_id, (count, credit, debit) in totals.items()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('transaction', '0007_partition_transaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserReport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('transaction_count', models.BigIntegerField(default=0)),
+                ('credit', models.BigIntegerField(default=0)),
+                ('debit', models.BigIntegerField(default=0)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, related_name='report', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(fill_user_report, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.9 on 2026-10-18 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transaction', '0008_userreport'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userbalance',
+            index=models.Index(fields=['user', 'create_time'], name='userbalance_user_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbalance',
+            index=models.Index(fields=['create_time'], name='userbalance_create_time_idx'),
+        ),
+    ]
@@ -1,7 +1,17 @@
+import logging
+import time
+from datetime import timedelta
+from itertools import islice
+
 from django.contrib.auth.models import User
-from django.db import models, transaction
-from django.db.models import Count, Sum, Q, Value
-from django.db.models.functions import Coalesce
+from django.db import models, transaction, connections
+from django.db.models import Count, Sum, Q, F, Value, Max, Exists, OuterRef, FilteredRelation
+from django.db.models.functions import Coalesce, Trunc
+from django.utils import timezone
+
+from transaction.eligibility import invalidate_users
+
+logger = logging.getLogger(__name__)
 
 
 class Transaction(models.Model):
@@ -18,6 +28,9 @@ class Transaction(models.Model):
         (TRANSFER_SENT, 'Transfer Sent'),
     )
 
+    CREDIT_TYPES = (CHARGE, TRANSFER_RECEIVED)
+    DEBIT_TYPES = (PURCHASE, TRANSFER_SENT)
+
     user = models.ForeignKey(
         to=User,
         on_delete=models.PROTECT,
@@ -33,46 +46,327 @@ class Transaction(models.Model):
     def __str__(self):
         return f'{self.user} - {self.get_transaction_type_display()} - {self.amount}'
 
+    def save(self, *args, **kwargs):
+        """
+        Transaction is applied to balance ledger and user report in the same database
+        transaction. Saving a changed one reverses its previous values first, deletes
+        are reversed by a post_delete receiver.
+        """
+        using = kwargs.get('using') or 'default'
+        with transaction.atomic(using=using):
+            previous = None
+            if not self._state.adding:
+                previous = Transaction.objects.using(using).select_for_update().filter(pk=self.pk).first()
+            super().save(*args, **kwargs)
+            if previous is None:
+                BalanceLedger.apply([self], using=using)
+                UserReport.apply([self], using=using)
+            elif (previous.user_id, previous.transaction_type, previous.amount) != (
+                self.user_id, self.transaction_type, self.amount
+            ):
+                BalanceLedger.apply([self], using=using, reverse=[previous])
+                UserReport.apply([self], using=using, reverse=[previous])
+
+    @property
+    def signed_amount(self):
+        return self.amount if self.transaction_type in self.CREDIT_TYPES else -self.amount
+
     @classmethod
-    def get_report(cls):
-        """Show all users and their balance"""
-        positive_transactions = Sum(
-            'transactions__amount',
-            filter=Q(transactions__transaction_type__in=[1, 3])
-        )
-        negative_transactions = Sum(
-            'transactions__amount',
-            filter=Q(transactions__transaction_type__in=[2, 4])
+    def bulk_insert(cls, transactions, using='default'):
+        """Insert transactions with few round-trips and apply them to balance ledger and user report"""
+        transactions = list(transactions)
+        with transaction.atomic(using=using):
+            if not connections[using].features.can_return_rows_from_bulk_insert:
+                # Primary keys are needed by callers, insert one by one
+                for instance in transactions:
+                    instance.save(using=using)
+                return transactions
+
+            cls.objects.using(using).bulk_create(transactions, batch_size=1000)
+            BalanceLedger.apply(transactions, using=using)
+            UserReport.apply(transactions, using=using)
+        return transactions
+
+    @classmethod
+    def get_report(cls, start=None, end=None):
+        """
+        Show all users and their balance, read from UserReport (no join to transactions).
+        Count covers archived transactions too. With start or end it is aggregated
+        like aggregate_report.
+        """
+        if start is not None or end is not None:
+            return cls.aggregate_report(start, end)
+
+        return User.objects.annotate(
+            transaction_count=Coalesce('report__transaction_count', Value(0)),
+            balance_=Coalesce(F('report__credit') - F('report__debit'), Value(0))
         )
 
+    @classmethod
+    def aggregate_report(cls, start=None, end=None):
+        """
+        Calculate get_report from transactions. With start or end, count and balance
+        cover only transactions created in [start, end), scanning only their partitions.
+        """
+        if start is None and end is None:
+            return User.objects.annotate(
+                transaction_count=Count('transactions__id'),
+                balance_=cls.balance_expression(prefix='transactions__') + Coalesce('opening_balance__balance', Value(0))
+            )
+
         users = User.objects.annotate(
-            transaction_count=Count('transactions__id'),
-            balance_=Coalesce(positive_transactions, Value(0)) - Coalesce(negative_transactions, Value(0))
+            period_transactions=FilteredRelation('transactions', condition=cls.period_filter(start, end, 'transactions__'))
+        )
+        return users.annotate(
+            transaction_count=Count('period_transactions__id'),
+            balance_=cls.balance_expression(prefix='period_transactions__')
         )
-        return users
 
     @classmethod
     def get_total_balance(cls):
         """Sum balance all users"""
-        qs = cls.get_report()
-        return qs.aggregate(balance=Sum('get_balance'))
+        return UserReport.objects.aggregate(balance=Coalesce(Sum(F('credit') - F('debit')), Value(0)))
 
     @classmethod
-    def user_balance(cls, user):
-        """Calculate balance user"""
+    def balance_expression(cls, prefix=''):
         positive_transactions = Sum(
-            'amount',
-            filter=Q(transaction_type__in=[1, 3])
+            f'{prefix}amount',
+            filter=Q(**{f'{prefix}transaction_type__in': cls.CREDIT_TYPES})
         )
         negative_transactions = Sum(
-            'amount',
-            filter=Q(transaction_type__in=[2, 4])
+            f'{prefix}amount',
+            filter=Q(**{f'{prefix}transaction_type__in': cls.DEBIT_TYPES})
+        )
+        return Coalesce(positive_transactions, Value(0)) - Coalesce(negative_transactions, Value(0))
+
+    @classmethod
+    def period_filter(cls, start=None, end=None, prefix=''):
+        """Constant bounds on create_time, PostgreSQL prunes partitions outside them"""
+        period = Q()
+        if start is not None:
+            period &= Q(**{f'{prefix}create_time__gte': start})
+        if end is not None:
+            period &= Q(**{f'{prefix}create_time__lt': end})
+        return period
+
+    @classmethod
+    def user_balance(cls, user, start=None, end=None):
+        """
+        Balance user, read from ledger (one row). With start or end, the change of
+        balance by transactions created in [start, end).
+        """
+        if start is None and end is None:
+            return BalanceLedger.objects.filter(user=user).values_list('balance', flat=True).first() or 0
+
+        transactions = user.transactions.filter(cls.period_filter(start, end))
+        return transactions.aggregate(balance=cls.balance_expression())['balance']
+
+    @classmethod
+    def aggregate_user_balance(cls, user):
+        """Calculate balance user from all transactions and balance carried forward from archived ones"""
+        user_balance = user.transactions.all().aggregate(balance=cls.balance_expression())
+        opening_balance = OpeningBalance.objects.filter(user=user).values_list('balance', flat=True).first() or 0
+        return user_balance.get('balance', 0) + opening_balance
+
+    @classmethod
+    def aggregate_balances(cls, users):
+        """{user_id: balance} calculated like aggregate_user_balance, users is a Q on user_id"""
+        balances = dict(
+            cls.objects.filter(users).order_by().values('user_id')
+            .annotate(balance=cls.balance_expression()).values_list('user_id', 'balance')
         )
+        for user_id, balance in OpeningBalance.objects.filter(users).values_list('user_id', 'balance'):
+            balances[user_id] = balances.get(user_id, 0) + balance
+        return balances
+
+
+class RunningBalance(models.Model):
+    """Balance of user kept as a running total, changed only with upserts"""
+    balance = models.BigIntegerField(default=0)
+    update_time = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return f'{self.user} - {self.balance}'
+
+    @classmethod
+    def add(cls, deltas, using='default'):
+        """Add {user_id: amount} to balances with one upsert statement"""
+        deltas = {user_id: amount for user_id, amount in deltas.items() if amount}
+        if not deltas:
+            return
+
+        table = cls._meta.db_table
+        now = connections[using].ops.adapt_datetimefield_value(timezone.now())
+        values = ', '.join(['(%s, %s, %s)'] * len(deltas))
+        # Rows are locked in user id order like BalanceLedger.lock
+        params = [param for user_id, amount in sorted(deltas.items()) for param in (user_id, amount, now)]
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, balance, update_time) VALUES {values} '
+                f'ON CONFLICT (user_id) DO UPDATE SET '
+                f'balance = {table}.balance + EXCLUDED.balance, update_time = EXCLUDED.update_time',
+                params
+            )
+
+    @classmethod
+    def apply(cls, transactions, using='default', reverse=()):
+        """Add transactions to balances and subtract reverse (deleted or previous values) in one upsert"""
+        deltas = {}
+        for instance in transactions:
+            deltas[instance.user_id] = deltas.get(instance.user_id, 0) + instance.signed_amount
+        for instance in reverse:
+            deltas[instance.user_id] = deltas.get(instance.user_id, 0) - instance.signed_amount
+        cls.add(deltas, using=using)
+
+
+class BalanceLedger(RunningBalance):
+    """Current balance of user, updated with every new transaction"""
+    user = models.OneToOneField(
+        to=User,
+        on_delete=models.PROTECT,
+        related_name='ledger'
+    )
+
+    @classmethod
+    def lock(cls, user_ids):
+        """
+        Lock balance rows of users, always in user id order so concurrent transfers
+        can not deadlock. Must run inside transaction.atomic(). Return {user_id: balance}.
+        """
+        user_ids = sorted(set(user_ids))
+        cls.objects.bulk_create([cls(user_id=user_id) for user_id in user_ids], ignore_conflicts=True)
+        rows = cls.objects.select_for_update().filter(user_id__in=user_ids).order_by('user_id')
+        return dict(rows.values_list('user_id', 'balance'))
+
+    @classmethod
+    def reconcile(cls, fix=False, chunk_size=10000):
+        """
+        Compare ledger with balance aggregated from transactions, chunk by chunk of
+        user ids. Return drifts as (user_id, ledger balance, aggregated balance).
+        """
+        drifts = []
+        last_user_id = User.objects.aggregate(last=Max('pk'))['last'] or 0
+        for start in range(0, last_user_id + 1, chunk_size):
+            user_ids = Q(user_id__gte=start, user_id__lt=start + chunk_size)
+            balances = Transaction.aggregate_balances(user_ids)
+            ledger = dict(cls.objects.filter(user_ids).values_list('user_id', 'balance'))
+
+            for user_id in balances.keys() | ledger.keys():
+                expected, actual = balances.get(user_id, 0), ledger.get(user_id, 0)
+                if expected != actual:
+                    logger.warning('Balance drift user %s: ledger %s, transactions %s', user_id, actual, expected)
+                    drifts.append((user_id, actual, expected))
+
+        if fix and drifts:
+            cls.fix([user_id for user_id, _, _ in drifts])
+        return drifts
+
+    @classmethod
+    def fix(cls, user_ids):
+        """Reset balance of users to aggregate of their transactions and opening balance"""
+        with transaction.atomic():
+            # Locked rows block new transactions of these users until the fix is committed
+            ledger = {
+                row.user_id: row.balance for row in cls.objects.select_for_update().filter(user_id__in=user_ids)
+            }
+            balances = Transaction.aggregate_balances(Q(user_id__in=user_ids))
+            cls.add({user_id: balances.get(user_id, 0) - ledger.get(user_id, 0) for user_id in user_ids})
 
-        user_balance = user.transactions.all().aggregate(
-            balance=Coalesce(positive_transactions, Value(0)) - Coalesce(negative_transactions, Value(0))
+
+class UserReport(models.Model):
+    """Transaction count and totals of user, kept up to date with every new transaction"""
+    user = models.OneToOneField(
+        to=User,
+        on_delete=models.PROTECT,
+        related_name='report'
+    )
+    transaction_count = models.BigIntegerField(default=0)
+    credit = models.BigIntegerField(default=0)
+    debit = models.BigIntegerField(default=0)
+    update_time = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.user} - {self.transaction_count} - {self.balance}'
+
+    @property
+    def balance(self):
+        return self.credit - self.debit
+
+    @classmethod
+    def apply(cls, transactions, using='default', reverse=()):
+        """Add transactions to reports of their users and subtract reverse ones with one upsert statement"""
+        totals = {}
+        for sign, instances in ((1, transactions), (-1, reverse)):
+            for instance in instances:
+                count, credit, debit = totals.get(instance.user_id, (0, 0, 0))
+                if instance.transaction_type in Transaction.CREDIT_TYPES:
+                    credit += sign * instance.amount
+                else:
+                    debit += sign * instance.amount
+                totals[instance.user_id] = (count + sign, credit, debit)
+        totals = {user_id: total for user_id, total in totals.items() if any(total)}
+        if not totals:
+            return
+
+        table = cls._meta.db_table
+        now = connections[using].ops.adapt_datetimefield_value(timezone.now())
+        values = ', '.join(['(%s, %s, %s, %s, %s)'] * len(totals))
+        params = [param for user_id, total in sorted(totals.items()) for param in (user_id, *total, now)]
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, transaction_count, credit, debit, update_time) VALUES {values} '
+                f'ON CONFLICT (user_id) DO UPDATE SET '
+                f'transaction_count = {table}.transaction_count + EXCLUDED.transaction_count, '
+                f'credit = {table}.credit + EXCLUDED.credit, debit = {table}.debit + EXCLUDED.debit, '
+                f'update_time = EXCLUDED.update_time',
+                params
+            )
+
+    REFRESH_SQL = '''
+        INSERT INTO {report_table} (user_id, transaction_count, credit, debit, update_time)
+        SELECT t.user_id, COUNT(*),
+            COALESCE(SUM(CASE WHEN t.transaction_type IN ({credit_types}) THEN t.amount END), 0),
+            COALESCE(SUM(CASE WHEN t.transaction_type IN ({debit_types}) THEN t.amount END), 0),
+            %s
+        FROM (
+            SELECT user_id, transaction_type, amount FROM {transaction_table} WHERE user_id >= %s AND user_id < %s
+            UNION ALL
+            SELECT user_id, transaction_type, amount FROM {archive_table} WHERE user_id >= %s AND user_id < %s
+        ) AS t
+        GROUP BY t.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            transaction_count = EXCLUDED.transaction_count, credit = EXCLUDED.credit, debit = EXCLUDED.debit,
+            update_time = EXCLUDED.update_time
+    '''
+
+    @classmethod
+    def refresh(cls, chunk_size=10000):
+        """
+        Rebuild reports from transactions and archive, chunk by chunk of user ids.
+        Ledger rows of a chunk are locked meanwhile, so transactions inserted
+        concurrently wait and are added on top of the rebuilt rows.
+        """
+        sql = cls.REFRESH_SQL.format(
+            report_table=cls._meta.db_table,
+            transaction_table=Transaction._meta.db_table,
+            archive_table=TransactionArchive._meta.db_table,
+            credit_types=', '.join(map(str, Transaction.CREDIT_TYPES)),
+            debit_types=', '.join(map(str, Transaction.DEBIT_TYPES)),
         )
-        return user_balance.get('balance', 0)
+        last_user_id = User.objects.aggregate(last=Max('pk'))['last'] or 0
+        for start in range(0, last_user_id + 1, chunk_size):
+            end = start + chunk_size
+            with transaction.atomic():
+                BalanceLedger.lock(User.objects.filter(pk__gte=start, pk__lt=end).values_list('pk', flat=True))
+                cls.objects.filter(user_id__gte=start, user_id__lt=end).delete()
+                connection = connections['default']
+                with connection.cursor() as cursor:
+                    now = connection.ops.adapt_datetimefield_value(timezone.now())
+                    cursor.execute(sql, [now, start, end, start, end])
+            logger.info('User report refreshed up to user %s', min(end, last_user_id))
 
 
 class TransactionArchive(models.Model):
@@ -104,6 +398,72 @@ class TransactionArchive(models.Model):
     def __str__(self):
         return f'{self.user} - {self.get_transaction_type_display()} - {self.amount}'
 
+    ARCHIVE_SQL = '''
+        INSERT INTO {archive_table} (id, user_id, transaction_type, amount, create_time)
+        SELECT id, user_id, transaction_type, amount, create_time FROM {transaction_table} WHERE id IN ({ids})
+        ON CONFLICT (id) DO NOTHING
+    '''
+
+    @classmethod
+    def archivable(cls, before):
+        """Transactions created before cutoff, except transfer legs that TransferTransaction still protects"""
+        return Transaction.objects.filter(create_time__lt=before).exclude(
+            Exists(TransferTransaction.objects.filter(sender_transaction=OuterRef('pk')))
+        ).exclude(
+            Exists(TransferTransaction.objects.filter(receiver_transaction=OuterRef('pk')))
+        )
+
+    @classmethod
+    def archive(cls, before, chunk_size=1000, sleep=0, dry_run=False):
+        """
+        Move transactions created before cutoff into archive, chunk by chunk of ids.
+        Each chunk copies, carries balances forward to OpeningBalance and deletes in one
+        database transaction; copies keep their ids, so running it again is harmless.
+        Return number of transactions and users archived (or to archive with dry_run).
+        """
+        transactions = cls.archivable(before)
+        if dry_run:
+            return transactions.aggregate(transaction_count=Count('pk'), user_count=Count('user_id', distinct=True))
+
+        tables = {'archive_table': cls._meta.db_table, 'transaction_table': Transaction._meta.db_table}
+        transaction_count, user_ids, last_pk = 0, set(), 0
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    transactions.filter(pk__gt=last_pk).select_for_update().order_by('pk')
+                    .values_list('pk', flat=True)[:chunk_size]
+                )
+                if not ids:
+                    break
+
+                balances = dict(
+                    Transaction.objects.filter(pk__in=ids).order_by().values('user_id')
+                    .annotate(balance=Transaction.balance_expression()).values_list('user_id', 'balance')
+                )
+                placeholders = ', '.join(['%s'] * len(ids))
+                with connections['default'].cursor() as cursor:
+                    cursor.execute(cls.ARCHIVE_SQL.format(ids=placeholders, **tables), ids)
+                    cursor.execute(f'DELETE FROM {Transaction._meta.db_table} WHERE id IN ({placeholders})', ids)
+                OpeningBalance.add(balances)
+
+            transaction_count += len(ids)
+            user_ids.update(balances)
+            last_pk = ids[-1]
+            logger.info('Archived %s transactions, up to transaction %s', transaction_count, last_pk)
+            if sleep:
+                time.sleep(sleep)
+
+        return {'transaction_count': transaction_count, 'user_count': len(user_ids)}
+
+
+class OpeningBalance(RunningBalance):
+    """Balance carried forward from transactions moved into TransactionArchive"""
+    user = models.OneToOneField(
+        to=User,
+        on_delete=models.PROTECT,
+        related_name='opening_balance'
+    )
+
 
 class UserBalance(models.Model):
     user = models.ForeignKey(
@@ -114,9 +474,105 @@ class UserBalance(models.Model):
     balance = models.BigIntegerField()
     create_time = models.DateTimeField(auto_now_add=True)
 
+    BUCKETS = ('day', 'week', 'month')
+
+    class Meta:
+        indexes = (
+            models.Index(fields=('user', 'create_time'), name='userbalance_user_time_idx'),
+            models.Index(fields=('create_time',), name='userbalance_create_time_idx'),
+        )
+
     def __str__(self):
         return f'{self.user} - {self.balance} - {self.create_time}'
 
+    @classmethod
+    def balance_at(cls, user, at):
+        """Balance user (all users when user is None) including transactions created up to at"""
+        return cls._balance_until(user, at, 'lte')
+
+    @classmethod
+    def history(cls, user, start, end=None, bucket='day'):
+        """
+        Balance user (all users when user is None) at the end of every day, week or
+        month from start to end, as [(bucket start, balance)]. Starts from balance at
+        the first bucket and adds transactions grouped by bucket, two queries per table.
+        """
+        if bucket not in cls.BUCKETS:
+            raise ValueError(f'bucket must be one of {", ".join(cls.BUCKETS)}')
+        end = end or timezone.now()
+        buckets = [cls._bucket_start(start, bucket)]
+        while True:
+            next_bucket = cls._next_bucket(buckets[-1], bucket)
+            if next_bucket > end:
+                break
+            buckets.append(next_bucket)
+
+        deltas = {}
+        for model in (Transaction, TransactionArchive):
+            rows = cls._user_transactions(model, user).filter(create_time__gte=buckets[0], create_time__lte=end)
+            rows = rows.annotate(bucket=Trunc('create_time', bucket)).order_by().values('bucket').annotate(
+                balance=Transaction.balance_expression()
+            )
+            for row in rows:
+                deltas[row['bucket']] = deltas.get(row['bucket'], 0) + row['balance']
+
+        balance = cls._balance_until(user, buckets[0], 'lt')
+        history = []
+        for bucket_start in buckets:
+            balance += deltas.get(bucket_start, 0)
+            history.append((bucket_start, balance))
+        return history
+
+    @classmethod
+    def _balance_until(cls, user, at, lookup):
+        """
+        Nearest snapshot at or before at, plus transactions (live and archived) after
+        it, so the scanned window is bounded by the snapshot interval.
+        """
+        if user is not None:
+            snapshot = cls.objects.filter(user=user, **{f'create_time__{lookup}': at}).order_by(
+                '-create_time'
+            ).values_list('create_time', 'balance').first()
+        else:
+            # Every row of a snapshot run is recorded at the run snapshot time
+            run = BalanceSnapshotRun.objects.exclude(finish_time=None).filter(
+                **{f'snapshot_time__{lookup}': at}
+            ).order_by('-snapshot_time').first()
+            snapshot = run and (
+                run.snapshot_time,
+                cls.objects.filter(create_time=run.snapshot_time).aggregate(balance=Sum('balance'))['balance'] or 0
+            )
+        since, balance = snapshot or (None, 0)
+
+        for model in (Transaction, TransactionArchive):
+            transactions = cls._user_transactions(model, user).filter(**{f'create_time__{lookup}': at})
+            if since is not None:
+                transactions = transactions.filter(create_time__gt=since)
+            balance += transactions.aggregate(balance=Transaction.balance_expression())['balance']
+        return balance
+
+    @staticmethod
+    def _user_transactions(model, user):
+        return model.objects.filter(user=user) if user is not None else model.objects.all()
+
+    @staticmethod
+    def _bucket_start(value, bucket):
+        value = timezone.localtime(value).replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        if bucket == 'week':
+            value -= timedelta(days=value.weekday())
+        elif bucket == 'month':
+            value = value.replace(day=1)
+        return timezone.make_aware(value)
+
+    @staticmethod
+    def _next_bucket(value, bucket):
+        value = timezone.localtime(value).replace(tzinfo=None)
+        if bucket == 'month':
+            value = value.replace(year=value.year + value.month // 12, month=value.month % 12 + 1)
+        else:
+            value += timedelta(days=7 if bucket == 'week' else 1)
+        return timezone.make_aware(value)
+
     @classmethod
     def record_user_balance(cls, user):
         """Save balance user at time"""
@@ -126,24 +582,87 @@ class UserBalance(models.Model):
         return instance
 
     @classmethod
-    def record_all_user_balance(cls):
-        """Save balance users at time"""
-        users = User.objects.all()
-        for user in users:
-            record = cls.record_user_balance(user)
-            print(record)
+    def record_all_user_balance(cls, chunk_size=10000):
+        """
+        Save balance users at time. Each chunk of users is one INSERT ... SELECT over a
+        grouped aggregate; an interrupted run is resumed from its last chunk.
+        """
+        run = BalanceSnapshotRun.objects.filter(finish_time=None).order_by('-pk').first()
+        if run is None:
+            run = BalanceSnapshotRun.objects.create(snapshot_time=timezone.now())
+            logger.info('Balance snapshot %s started at %s', run.pk, run.snapshot_time)
+        else:
+            logger.info('Balance snapshot %s resumed after user %s', run.pk, run.last_user_id)
+
+        while True:
+            remaining = User.objects.filter(pk__gt=run.last_user_id)
+            chunk_end = remaining.order_by('pk').values_list('pk', flat=True)[chunk_size - 1:chunk_size]
+            last_user_id = next(iter(chunk_end), None) or remaining.aggregate(last=Max('pk'))['last']
+            if last_user_id is None:
+                break
+
+            with transaction.atomic():
+                connection = connections['default']
+                snapshot_time = connection.ops.adapt_datetimefield_value(run.snapshot_time)
+                with connection.cursor() as cursor:
+                    cursor.execute(cls.SNAPSHOT_SQL.format(
+                        balance_table=cls._meta.db_table,
+                        user_table=User._meta.db_table,
+                        transaction_table=Transaction._meta.db_table,
+                        opening_table=OpeningBalance._meta.db_table,
+                        credit_types=', '.join(map(str, Transaction.CREDIT_TYPES)),
+                        debit_types=', '.join(map(str, Transaction.DEBIT_TYPES)),
+                    ), [snapshot_time, snapshot_time, run.last_user_id, last_user_id])
+                    recorded = cursor.rowcount
+
+                run.last_user_id = last_user_id
+                run.user_count += recorded
+                run.save(update_fields=('last_user_id', 'user_count'))
+            logger.info('Balance snapshot %s: %s users recorded, up to user %s', run.pk, run.user_count, last_user_id)
+
+        run.finish_time = timezone.now()
+        run.save(update_fields=('finish_time',))
+        logger.info('Balance snapshot %s finished, %s users', run.pk, run.user_count)
+        return run
+
+    SNAPSHOT_SQL = '''
+        INSERT INTO {balance_table} (user_id, balance, create_time)
+        SELECT u.id, COALESCE(o.balance, 0) + COALESCE(SUM(
+            CASE WHEN t.transaction_type IN ({credit_types}) THEN t.amount
+                 WHEN t.transaction_type IN ({debit_types}) THEN -t.amount
+            END
+        ), 0), %s
+        FROM {user_table} AS u
+        LEFT JOIN {opening_table} AS o ON o.user_id = u.id
+        LEFT JOIN {transaction_table} AS t ON t.user_id = u.id AND t.create_time <= %s
+        WHERE u.id > %s AND u.id <= %s
+        GROUP BY u.id, o.balance
+    '''
+
+
+class BalanceSnapshotRun(models.Model):
+    """Progress of UserBalance.record_all_user_balance, used to resume it"""
+    snapshot_time = models.DateTimeField()
+    last_user_id = models.BigIntegerField(default=0)
+    user_count = models.PositiveIntegerField(default=0)
+    finish_time = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f'{self.snapshot_time} - {self.user_count} users'
 
 
 class TransferTransaction(models.Model):
     sender_transaction = models.ForeignKey(
         to=Transaction,
         on_delete=models.PROTECT,
-        related_name='send_transfers'
+        related_name='send_transfers',
+        db_constraint=False  # transaction table is partitioned, id alone is not unique there
     )
     receiver_transaction = models.ForeignKey(
         to=Transaction,
         on_delete=models.PROTECT,
-        related_name='received_transfers'
+        related_name='received_transfers',
+        db_constraint=False  # transaction table is partitioned, id alone is not unique there
     )
     create_time = models.DateTimeField(auto_now_add=True)
 
@@ -153,10 +672,15 @@ class TransferTransaction(models.Model):
     @classmethod
     def transfer(cls, sender, receiver, amount):
         """Transfer amount between two users"""
-        if Transaction.user_balance(user=sender) < amount:
-            return 'Transaction not allowed, insufficient balance'
+        if amount <= 0:
+            return 'Transaction not allowed, invalid amount'
 
         with transaction.atomic():
+            # Balance is checked and debited while both rows are locked
+            balances = BalanceLedger.lock([sender.pk, receiver.pk])
+            if balances[sender.pk] < amount:
+                return 'Transaction not allowed, insufficient balance'
+
             sender_transaction = Transaction.objects.create(
                 user=sender,
                 transaction_type=Transaction.TRANSFER_SENT,
@@ -175,6 +699,50 @@ class TransferTransaction(models.Model):
 
         return instance
 
+    @classmethod
+    def bulk_transfer(cls, transfers, chunk_size=1000):
+        """
+        Run many (sender_id, receiver_id, amount) transfers, in order. Each chunk locks
+        all its balance rows at once and is written with bulk inserts, a handful of
+        queries per chunk. Return created transfers and rejected (invalid amount or
+        insufficient balance) items.
+        """
+        created, rejected = [], []
+        transfers = iter(transfers)
+        while True:
+            chunk = list(islice(transfers, chunk_size))
+            if not chunk:
+                return created, rejected
+
+            with transaction.atomic():
+                balances = BalanceLedger.lock(
+                    [user_id for sender_id, receiver_id, _ in chunk for user_id in (sender_id, receiver_id)]
+                )
+
+                sent, received = [], []
+                for item in chunk:
+                    sender_id, receiver_id, amount = item
+                    if amount <= 0 or balances[sender_id] < amount:
+                        rejected.append(item)
+                        continue
+                    balances[sender_id] -= amount
+                    balances[receiver_id] += amount
+                    sent.append(
+                        Transaction(user_id=sender_id, transaction_type=Transaction.TRANSFER_SENT, amount=amount)
+                    )
+                    received.append(
+                        Transaction(user_id=receiver_id, transaction_type=Transaction.TRANSFER_RECEIVED, amount=amount)
+                    )
+
+                Transaction.bulk_insert(sent + received)
+                created += cls.objects.bulk_create(
+                    [
+                        cls(sender_transaction=sender_transaction, receiver_transaction=receiver_transaction)
+                        for sender_transaction, receiver_transaction in zip(sent, received)
+                    ],
+                    batch_size=1000
+                )
+
 
 class UserScore(models.Model):
     user = models.OneToOneField(
@@ -191,11 +759,25 @@ class UserScore(models.Model):
 
     @classmethod
     def change_score(cls, user, score):
-        qs = cls.objects.select_for_update().filter(user=user)
-        with transaction.atomic():
-            if qs.exists():
-                instance = qs.first()
-            else:
-                instance = cls.objects.create(user=user, score=0)
-            instance.score += score
-            instance.save()
+        """Add score to user in one statement, the row is locked only while it runs"""
+        cls.add_scores({user.pk: score})
+
+    @classmethod
+    def add_scores(cls, deltas, using='default'):
+        """Add {user_id: score} to scores with one upsert statement"""
+        deltas = {user_id: score for user_id, score in deltas.items() if score}
+        if not deltas:
+            return
+
+        table = cls._meta.db_table
+        values = ', '.join(['(%s, %s)'] * len(deltas))
+        # Rows are locked in user id order, concurrent batches can not deadlock
+        params = [param for user_id, score in sorted(deltas.items()) for param in (user_id, score)]
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (user_id, score) VALUES {values} '
+                f'ON CONFLICT (user_id) DO UPDATE SET score = {table}.score + EXCLUDED.score',
+                params
+            )
+        # Raw statement sends no signals
+        invalidate_users(deltas)
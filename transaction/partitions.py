@@ -0,0 +1,161 @@
+"""
+Monthly range partitions of the transaction table on create_time (PostgreSQL only).
+
+Partitions are named transaction_transaction_pYYYY_MM and cover one UTC month. Rows
+outside every partition land in transaction_transaction_default, creating the
+partition of their month later moves them out of it.
+"""
+import re
+from datetime import datetime, timezone
+
+from django.db import connections, transaction
+
+TABLE = 'transaction_transaction'
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})_(\d{{2}})$')
+
+
+def month_start(value):
+    return datetime(value.year, value.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y_%m}'
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass', [TABLE])
+        return cursor.fetchone() is not None
+
+
+def get_partitions(connection):
+    """Months that have a partition, in order"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass',
+            [TABLE]
+        )
+        names = [PARTITION_NAME.match(name) for name, in cursor.fetchall()]
+    return sorted(datetime(int(m[1]), int(m[2]), 1, tzinfo=timezone.utc) for m in names if m)
+
+
+def create_partition(connection, month):
+    """Create partition of month, moving its rows out of the default partition"""
+    name, end = partition_name(month), add_months(month, 1)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(
+            f'WITH moved AS ('
+            f'DELETE FROM {DEFAULT_PARTITION} WHERE create_time >= %s AND create_time < %s RETURNING *'
+            f') INSERT INTO {name} SELECT * FROM moved',
+            [month, end]
+        )
+        cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)', [month, end])
+    return name
+
+
+def create_partitions(connection, start=None, ahead=3):
+    """
+    Create missing partitions from month of start up to ahead months after the
+    current one. Start defaults to the oldest of the first partition and rows left
+    in the default partition. Return created partition names.
+    """
+    existing = get_partitions(connection)
+    now = datetime.now(timezone.utc)
+    if start is None:
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT MIN(create_time) FROM {DEFAULT_PARTITION}')
+            start = min(value for value in (cursor.fetchone()[0], existing[0] if existing else None, now) if value)
+
+    existing = set(existing)
+    month, last = month_start(start), add_months(month_start(now), ahead)
+    created = []
+    while month <= last:
+        if month not in existing:
+            created.append(create_partition(connection, month))
+        month = add_months(month, 1)
+    return created
+
+
+def detach_partitions(connection, before, drop=False):
+    """
+    Detach partitions of months entirely before cutoff, dropping them with drop.
+    Only empty partitions are detached: rows of a partition still count in the
+    balance ledger, user reports and transfers, archive_transactions carries them
+    into opening balances first. Return detached partition names.
+    """
+    detached = []
+    for month in get_partitions(connection):
+        if add_months(month, 1) > before:
+            break
+        name = partition_name(month)
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {name})')
+            if cursor.fetchone()[0]:
+                continue
+            cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+            if drop:
+                cursor.execute(f'DROP TABLE {name}')
+        detached.append(name)
+    return detached
+
+
+def partition_table(connection):
+    """Turn the plain transaction table into a partitioned one, rows go to default partition"""
+    with connection.cursor() as cursor:
+        _rename_old(cursor)
+        cursor.execute(f'CREATE TABLE {TABLE} (LIKE {TABLE}_old INCLUDING DEFAULTS) PARTITION BY RANGE (create_time)')
+        # Primary key of a partitioned table must contain the partition key
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id, create_time)')
+        _create_user_constraint(cursor)
+        cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT')
+        _move_rows(cursor)
+
+
+def unpartition_table(connection):
+    with connection.cursor() as cursor:
+        _rename_old(cursor)
+        cursor.execute(f'CREATE TABLE {TABLE} (LIKE {TABLE}_old INCLUDING DEFAULTS)')
+        cursor.execute(f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_pkey PRIMARY KEY (id)')
+        _create_user_constraint(cursor)
+        _move_rows(cursor)
+
+
+def _rename_old(cursor):
+    # Index names are unique per schema, the new table reuses them
+    cursor.execute(f'ALTER TABLE {TABLE} RENAME TO {TABLE}_old')
+    cursor.execute(f'ALTER INDEX {TABLE}_pkey RENAME TO {TABLE}_old_pkey')
+    cursor.execute(f'ALTER INDEX IF EXISTS {TABLE}_user_id_idx RENAME TO {TABLE}_old_user_id_idx')
+
+
+def _create_user_constraint(cursor):
+    cursor.execute(f'CREATE INDEX {TABLE}_user_id_idx ON {TABLE} (user_id)')
+    cursor.execute(
+        f'ALTER TABLE {TABLE} ADD CONSTRAINT {TABLE}_user_id_fk '
+        f'FOREIGN KEY (user_id) REFERENCES auth_user (id) DEFERRABLE INITIALLY DEFERRED'
+    )
+
+
+def _move_rows(cursor):
+    cursor.execute(f'INSERT INTO {TABLE} SELECT * FROM {TABLE}_old')
+    cursor.execute(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id')
+    cursor.execute(f'DROP TABLE {TABLE}_old CASCADE')
+
+
+def maintain_partitions(using='default', ahead=3, detach_before=None, drop=False):
+    """Create partitions ahead and detach old ones, return (created, detached) names"""
+    connection = connections[using]
+    if not is_partitioned(connection):
+        return [], []
+    created = create_partitions(connection, ahead=ahead)
+    detached = detach_partitions(connection, detach_before, drop=drop) if detach_before else []
+    return created, detached
@@ -0,0 +1,87 @@
+"""Buffered score increments, many score events of a user become one row update"""
+import logging
+import threading
+import time
+
+from django.db import DataError, IntegrityError, connections, transaction
+
+from transaction.models import UserScore
+
+logger = logging.getLogger(__name__)
+
+
+class ScoreBuffer:
+    """
+    Coalesce score increments in memory and write them with one UserScore.add_scores
+    statement. Flushed when max_size users are pending, when flush_interval seconds
+    passed since the last flush, on flush() and when used as a context manager exits.
+    Safe to share between threads.
+    """
+
+    def __init__(self, max_size=1000, flush_interval=None, using='default'):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.using = using
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, user_id, score):
+        with self._lock:
+            self.pending[user_id] = self.pending.get(user_id, 0) + score
+            due = len(self.pending) >= self.max_size or (
+                self.flush_interval is not None and time.monotonic() - self.last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Write pending increments, return number of users updated. When the write is
+        rejected (unknown user, score out of range) users are written one by one and
+        rejected increments are logged and dropped, so they can not fail every later
+        flush. Increments of a write failed for another reason are kept.
+        """
+        with self._lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        try:
+            self._write(pending)
+            return len(pending)
+        except (IntegrityError, DataError):
+            pass
+        except Exception:
+            self._requeue(pending)
+            raise
+
+        written = 0
+        items = list(pending.items())
+        for i, (user_id, score) in enumerate(items):
+            try:
+                self._write({user_id: score})
+                written += 1
+            except (IntegrityError, DataError) as e:
+                logger.error('Score increment %s of user %s rejected: %s', score, user_id, e)
+            except Exception:
+                self._requeue(dict(items[i:]))
+                raise
+        return written
+
+    def _write(self, deltas):
+        if connections[self.using].in_atomic_block:
+            # A failed statement must not break the surrounding transaction
+            with transaction.atomic(using=self.using):
+                UserScore.add_scores(deltas, using=self.using)
+        else:
+            UserScore.add_scores(deltas, using=self.using)
+
+    def _requeue(self, pending):
+        with self._lock:
+            for user_id, score in pending.items():
+                self.pending[user_id] = self.pending.get(user_id, 0) + score
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
@@ -0,0 +1,45 @@
+from django.contrib.auth.models import User, Group, Permission
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from transaction.eligibility import invalidate_users, invalidate_all
+from transaction.models import Transaction, BalanceLedger, UserReport, UserScore
+
+
+@receiver([m2m_changed], sender=User.user_permissions.through)
+@receiver([m2m_changed], sender=User.groups.through)
+def user_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_users([instance.pk])
+    elif pk_set is not None:
+        invalidate_users(pk_set)
+    else:
+        # Cleared from the permission or group side, users are not known
+        invalidate_all()
+
+
+@receiver([m2m_changed], sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_all()
+
+
+@receiver([post_delete], sender=Group)
+@receiver([post_delete], sender=Permission)
+def permissions_deleted(sender, **kwargs):
+    invalidate_all()
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=UserScore)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_users([instance.pk if sender is User else instance.user_id])
+
+
+@receiver([post_delete], sender=Transaction)
+def transaction_deleted(sender, instance, using, **kwargs):
+    # Raw deletes (archiving, partition maintenance) move rows and send no signal
+    BalanceLedger.apply([], using=using, reverse=[instance])
+    UserReport.apply([], using=using, reverse=[instance])
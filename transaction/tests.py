@@ -1,3 +1,523 @@
-from django.test import TestCase
+import io
+import random
+import threading
+from datetime import timedelta
+from unittest import skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User, Group, Permission
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from transaction import partitions
+from transaction.models import (
+    Transaction, TransferTransaction, BalanceLedger, UserBalance, BalanceSnapshotRun, TransactionArchive, OpeningBalance,
+    UserReport, UserScore
+)
+from transaction.eligibility import get_profile
+from transaction.scores import ScoreBuffer
+
+
+class TransferTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sender = User.objects.create(username='sender')
+        cls.receiver = User.objects.create(username='receiver')
+        Transaction.objects.create(user=cls.sender, amount=100)
+
+    def test_transfer(self):
+        self.assertIsInstance(TransferTransaction.transfer(self.sender, self.receiver, 60), TransferTransaction)
+        self.assertEqual(Transaction.user_balance(self.sender), 40)
+        self.assertEqual(Transaction.user_balance(self.receiver), 60)
+
+    def test_transfer_not_allowed(self):
+        self.assertEqual(
+            TransferTransaction.transfer(self.sender, self.receiver, 101), 'Transaction not allowed, insufficient balance'
+        )
+        self.assertEqual(
+            TransferTransaction.transfer(self.sender, self.receiver, -10), 'Transaction not allowed, invalid amount'
+        )
+        self.assertEqual(Transaction.user_balance(self.sender), 100)
+
+    def test_bulk_transfer(self):
+        transfers = [
+            (self.sender.pk, self.receiver.pk, 70),
+            (self.sender.pk, self.receiver.pk, 70),  # insufficient after the first one
+            (self.receiver.pk, self.sender.pk, 20),
+            (self.sender.pk, self.receiver.pk, 50),
+        ]
+        created, rejected = TransferTransaction.bulk_transfer(transfers, chunk_size=3)
+
+        self.assertEqual(len(created), 3)
+        self.assertEqual(rejected, [transfers[1]])
+        self.assertEqual(Transaction.user_balance(self.sender), 0)
+        self.assertEqual(Transaction.user_balance(self.receiver), 100)
+        self.assertEqual(BalanceLedger.reconcile(), [])
+
+
+class BalanceLedgerTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user')
+        cls.other = User.objects.create(username='other')
+        cls.charge = Transaction.objects.create(user=cls.user, amount=100)
+        Transaction.objects.create(user=cls.user, amount=30, transaction_type=Transaction.PURCHASE)
+
+    def assertBalances(self, user_balance, other_balance):
+        self.assertEqual(Transaction.user_balance(self.user), user_balance)
+        self.assertEqual(Transaction.user_balance(self.other), other_balance)
+        self.assertEqual(BalanceLedger.reconcile(), [])
+        live = {user.pk: (user.transaction_count, user.balance_) for user in Transaction.aggregate_report()}
+        self.assertEqual({user.pk: (user.transaction_count, user.balance_) for user in Transaction.get_report()}, live)
+
+    def test_changed_transaction_is_reapplied(self):
+        self.assertBalances(70, 0)
+        self.charge.amount = 150
+        self.charge.save()
+        self.assertBalances(120, 0)
+
+        self.charge.user = self.other
+        self.charge.transaction_type = Transaction.PURCHASE
+        self.charge.save()
+        self.assertBalances(-30, -150)
+
+    def test_deleted_transaction_is_reversed(self):
+        self.charge.delete()
+        self.assertBalances(-30, 0)
+        Transaction.objects.filter(user=self.user).delete()
+        self.assertBalances(0, 0)
+        self.assertEqual(UserReport.objects.get(user=self.user).transaction_count, 0)
+
+    def test_admin_edit(self):
+        self.client.force_login(
+            User.objects.create_superuser(username='admin', password='secret', email='admin@gmail.com')
+        )
+        response = self.client.post(f'/admin/transaction/transaction/{self.charge.pk}/change/', {
+            'user': self.user.pk, 'transaction_type': Transaction.CHARGE, 'amount': 80,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertBalances(50, 0)
+
+    def test_reconcile(self):
+        BalanceLedger.objects.filter(user=self.user).update(balance=999)
+        BalanceLedger.objects.create(user=self.other, balance=5)
+        with self.assertLogs('transaction.models', 'WARNING'):
+            drifts = BalanceLedger.reconcile(chunk_size=1)
+        self.assertEqual(sorted(drifts), [(self.user.pk, 999, 70), (self.other.pk, 5, 0)])
+
+        with self.assertLogs('transaction.models', 'WARNING'):
+            BalanceLedger.reconcile(fix=True)
+        self.assertEqual(BalanceLedger.reconcile(), [])
+        self.assertEqual(Transaction.user_balance(self.user), 70)
+
+    def test_reconcile_command(self):
+        BalanceLedger.objects.filter(user=self.user).update(balance=1)
+        stdout = io.StringIO()
+        with self.assertLogs('transaction.models', 'WARNING'):
+            call_command('reconcile_balances', stdout=stdout)
+        self.assertIn(f'user {self.user.pk}: ledger 1, transactions 70', stdout.getvalue())
+        self.assertIn('1 balances drifted', stdout.getvalue())
+
+        with self.assertLogs('transaction.models', 'WARNING'):
+            call_command('reconcile_balances', fix=True, stdout=io.StringIO())
+        stdout = io.StringIO()
+        call_command('reconcile_balances', stdout=stdout)
+        self.assertIn('No drift', stdout.getvalue())
+
+
+class UserBalanceSnapshotTest(TestCase):
+    def test_record_all_user_balance(self):
+        users = [User.objects.create(username=f'user{i}') for i in range(5)]
+        for i, user in enumerate(users):
+            Transaction.objects.create(user=user, amount=100 * i)
+            Transaction.objects.create(user=user, amount=i, transaction_type=Transaction.PURCHASE)
+
+        run = UserBalance.record_all_user_balance(chunk_size=2)
+        self.assertEqual(run.user_count, 5)
+        self.assertIsNotNone(run.finish_time)
+        self.assertEqual(
+            dict(UserBalance.objects.values_list('user_id', 'balance')),
+            {user.pk: Transaction.aggregate_user_balance(user) for user in users}
+        )
+
+    def test_resume_unfinished_run(self):
+        users = [User.objects.create(username=f'user{i}') for i in range(3)]
+        run = BalanceSnapshotRun.objects.create(snapshot_time=timezone.now(), last_user_id=users[0].pk, user_count=1)
+
+        self.assertEqual(UserBalance.record_all_user_balance().pk, run.pk)
+        self.assertEqual(set(UserBalance.objects.values_list('user_id', flat=True)), {users[1].pk, users[2].pk})
+
+
+class TransactionArchiveTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user')
+        cls.receiver = User.objects.create(username='receiver')
+        Transaction.objects.create(user=cls.user, amount=100)
+        Transaction.objects.create(user=cls.user, amount=30, transaction_type=Transaction.PURCHASE)
+        TransferTransaction.transfer(cls.user, cls.receiver, 20)
+        cls.recent = Transaction.objects.create(user=cls.user, amount=5)
+        Transaction.objects.exclude(pk=cls.recent.pk).update(create_time=timezone.now() - timedelta(days=400))
+
+    def test_archive(self):
+        before = timezone.now() - timedelta(days=365)
+        self.assertEqual(
+            TransactionArchive.archive(before, dry_run=True), {'transaction_count': 2, 'user_count': 1}
+        )
+        self.assertEqual(TransactionArchive.archive(before, chunk_size=1), {'transaction_count': 2, 'user_count': 1})
+
+        # Transfer legs are protected by TransferTransaction and stay
+        self.assertEqual(Transaction.objects.count(), 3)
+        self.assertEqual(TransactionArchive.objects.count(), 2)
+        self.assertEqual(OpeningBalance.objects.get(user=self.user).balance, 70)
+        self.assertEqual(Transaction.aggregate_user_balance(self.user), 55)
+        self.assertEqual(Transaction.get_report().get(pk=self.user.pk).balance_, 55)
+        self.assertEqual(BalanceLedger.reconcile(), [])
+
+        self.assertEqual(TransactionArchive.archive(before), {'transaction_count': 0, 'user_count': 0})
+        self.assertEqual(OpeningBalance.objects.get(user=self.user).balance, 70)
+
+
+class UserReportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f'user{i}') for i in range(4)]
+        for i, user in enumerate(cls.users[:3]):
+            Transaction.objects.create(user=user, amount=100 * (i + 1))
+        Transaction.bulk_insert([
+            Transaction(user=cls.users[0], amount=30, transaction_type=Transaction.PURCHASE),
+            Transaction(user=cls.users[1], amount=10),
+        ])
+        TransferTransaction.transfer(cls.users[2], cls.users[0], 50)
+        TransferTransaction.bulk_transfer([(cls.users[1].pk, cls.users[3].pk, 40)])
+
+    def assertReportIsLive(self):
+        live = {user.pk: (user.transaction_count, user.balance_) for user in Transaction.aggregate_report()}
+        report = {user.pk: (user.transaction_count, user.balance_) for user in Transaction.get_report()}
+        self.assertEqual(report, live)
+        self.assertEqual(Transaction.get_total_balance(), {'balance': sum(balance for _, balance in live.values())})
+
+    def test_report_is_incremental(self):
+        self.assertReportIsLive()
+        self.assertEqual(UserReport.objects.get(user=self.users[0]).balance, 120)
+
+    def test_refresh(self):
+        UserReport.objects.filter(user=self.users[1]).update(transaction_count=0, credit=0)
+        UserReport.objects.filter(user=self.users[3]).delete()
+        UserReport.refresh(chunk_size=2)
+        self.assertReportIsLive()
+
+    def test_get_report_queries(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(Transaction.get_report()), 4)
+
+
+class BalanceHistoryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user')
+        cls.other = User.objects.create(username='other')
+        cls.now = timezone.now()
+        for days_ago, user, amount, transaction_type in (
+            (10, cls.user, 100, Transaction.CHARGE),
+            (8, cls.other, 40, Transaction.CHARGE),
+            (6, cls.user, 30, Transaction.PURCHASE),
+            (3, cls.user, 50, Transaction.CHARGE),
+            (1, cls.other, 15, Transaction.PURCHASE),
+        ):
+            instance = Transaction.objects.create(user=user, amount=amount, transaction_type=transaction_type)
+            Transaction.objects.filter(pk=instance.pk).update(create_time=cls.now - timedelta(days=days_ago))
+
+    def live_balance(self, user, at):
+        transactions = Transaction.objects.filter(create_time__lte=at)
+        if user is not None:
+            transactions = transactions.filter(user=user)
+        return transactions.aggregate(balance=Transaction.balance_expression())['balance']
+
+    def test_balance_at(self):
+        UserBalance.objects.create(user=self.user, balance=70)
+        UserBalance.objects.filter(user=self.user).update(create_time=self.now - timedelta(days=5))
+
+        for days_ago in (11, 9, 7, 5, 4, 2, 0):
+            at = self.now - timedelta(days=days_ago)
+            for user in (self.user, self.other):
+                self.assertEqual(UserBalance.balance_at(user, at), self.live_balance(user, at))
+
+    def test_global_balance_at_uses_snapshot_run(self):
+        # Resumed run records balances at its snapshot time
+        BalanceSnapshotRun.objects.create(snapshot_time=self.now - timedelta(days=5))
+        self.assertEqual(UserBalance.record_all_user_balance().user_count, 2)
+        self.assertEqual(UserBalance.objects.aggregate(total=Sum('balance'))['total'], 110)
+
+        for days_ago in (9, 5, 2, 0):
+            at = self.now - timedelta(days=days_ago)
+            self.assertEqual(UserBalance.balance_at(None, at), self.live_balance(None, at))
+
+    def test_history(self):
+        history = UserBalance.history(self.user, self.now - timedelta(days=7), self.now)
+        self.assertEqual(len(history), 8)
+        for bucket_start, balance in history:
+            bucket_end = bucket_start + timedelta(days=1) - timedelta(microseconds=1)
+            self.assertEqual(balance, self.live_balance(self.user, bucket_end))
+
+        weeks = UserBalance.history(None, self.now - timedelta(days=14), self.now, bucket='week')
+        self.assertEqual(weeks[-1][1], self.live_balance(None, self.now))
+        self.assertEqual(weeks[0][0].weekday(), 0)
+        with self.assertRaises(ValueError):
+            UserBalance.history(self.user, self.now, bucket='year')
+
+
+class PeriodBalanceTest(TestCase):
+    def test_user_balance_in_period(self):
+        user = User.objects.create(username='user')
+        Transaction.objects.create(user=user, amount=100)
+        Transaction.objects.create(user=user, amount=30, transaction_type=Transaction.PURCHASE)
+        Transaction.objects.filter(amount=100).update(create_time=timezone.now() - timedelta(days=60))
+        month_ago = timezone.now() - timedelta(days=30)
+
+        self.assertEqual(Transaction.user_balance(user), 70)
+        self.assertEqual(Transaction.user_balance(user, start=month_ago), -30)
+        self.assertEqual(Transaction.user_balance(user, end=month_ago), 100)
+
+        report = Transaction.get_report(start=month_ago).get(pk=user.pk)
+        self.assertEqual((report.transaction_count, report.balance_), (1, -30))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Partitioning is PostgreSQL only')
+class TransactionPartitionTest(TestCase):
+    def setUp(self):
+        self.this_month = partitions.month_start(timezone.now())
+
+    def partition_count(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COUNT(*) FROM {name}')
+            return cursor.fetchone()[0]
+
+    def test_partitions_created_ahead(self):
+        self.assertTrue(partitions.is_partitioned(connection))
+        months = partitions.get_partitions(connection)
+        self.assertIn(self.this_month, months)
+        self.assertIn(partitions.add_months(self.this_month, 3), months)
+
+    def test_rows_moved_out_of_default_partition(self):
+        user = User.objects.create(username='user')
+        old_month = partitions.add_months(self.this_month, -24)
+        Transaction.objects.create(user=user, amount=100)
+        Transaction.objects.update(create_time=old_month + timedelta(days=3))
+        self.assertEqual(self.partition_count(partitions.DEFAULT_PARTITION), 1)
+
+        self.assertEqual(partitions.create_partitions(connection, start=old_month, ahead=0)[0],
+                         partitions.partition_name(old_month))
+        self.assertEqual(self.partition_count(partitions.DEFAULT_PARTITION), 0)
+        self.assertEqual(self.partition_count(partitions.partition_name(old_month)), 1)
+        self.assertEqual(Transaction.aggregate_user_balance(user), 100)
+
+    def test_period_queries_prune_partitions(self):
+        next_month = partitions.add_months(self.this_month, 1)
+        plans = [
+            Transaction.objects.filter(Transaction.period_filter(self.this_month, next_month)).explain(),
+            Transaction.get_report(start=self.this_month, end=next_month).explain(),
+        ]
+        for plan in plans:
+            self.assertIn(partitions.partition_name(self.this_month), plan)
+            self.assertNotIn(partitions.partition_name(next_month), plan)
+            self.assertNotIn(partitions.DEFAULT_PARTITION, plan)
+
+    def test_detach_only_empty_partitions(self):
+        user = User.objects.create(username='user')
+        old_month = partitions.add_months(self.this_month, -24)
+        partitions.create_partitions(connection, start=old_month, ahead=0)
+        Transaction.objects.create(user=user, amount=100)
+        Transaction.objects.update(create_time=partitions.add_months(old_month, 1))
+
+        before = partitions.add_months(old_month, 2)
+        detached = partitions.detach_partitions(connection, before=before, drop=True)
+        self.assertEqual(detached, [partitions.partition_name(old_month)])
+        self.assertNotIn(old_month, partitions.get_partitions(connection))
+        self.assertEqual(Transaction.objects.count(), 1)
+
+        # Archived rows are carried into the opening balance, then their partition is empty
+        TransactionArchive.archive(before)
+        detached = partitions.detach_partitions(connection, before=before)
+        self.assertEqual(detached, [partitions.partition_name(partitions.add_months(old_month, 1))])
+        self.assertEqual(Transaction.objects.count(), 0)
+        self.assertEqual(Transaction.aggregate_user_balance(user), 100)
+        self.assertEqual(Transaction.user_balance(user), 100)
+
+
+class UserScoreTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [User.objects.create(username=f'user{i}') for i in range(3)]
+
+    def test_change_score(self):
+        with self.assertNumQueries(1):
+            UserScore.change_score(self.users[0], 5)
+        UserScore.change_score(self.users[0], 3)
+        self.assertEqual(UserScore.objects.get(user=self.users[0]).score, 8)
+
+    def test_score_buffer(self):
+        with ScoreBuffer() as buffer:
+            for i in range(30):
+                buffer.add(self.users[i % 2].pk, 1)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(buffer.flush(), 2)
+            self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT')]), 1)
+            buffer.add(self.users[2].pk, 4)
+        self.assertEqual(dict(UserScore.objects.values_list('user_id', 'score')), {
+            self.users[0].pk: 15, self.users[1].pk: 15, self.users[2].pk: 4
+        })
+
+    def test_score_buffer_flushes_when_full(self):
+        buffer = ScoreBuffer(max_size=2)
+        buffer.add(self.users[0].pk, 1)
+        self.assertFalse(UserScore.objects.exists())
+        buffer.add(self.users[1].pk, 1)
+        self.assertEqual(UserScore.objects.count(), 2)
+        self.assertEqual(buffer.pending, {})
+
+
+class ScoreBufferRejectTest(TransactionTestCase):
+    def test_rejected_increments_are_dropped(self):
+        users = [User.objects.create(username=f'user{i}') for i in range(3)]
+        UserScore.change_score(users[0], 5)
+
+        buffer = ScoreBuffer()
+        buffer.add(users[0].pk, 2)
+        buffer.add(users[1].pk, -1)  # negative score
+        buffer.add(users[2].pk, 3)
+        buffer.add(users[2].pk + 1000, 1)  # unknown user
+        with self.assertLogs('transaction.scores', 'ERROR') as logs:
+            self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(buffer.pending, {})
+        self.assertEqual(dict(UserScore.objects.values_list('user_id', 'score')), {users[0].pk: 7, users[2].pk: 3})
+
+        buffer.add(users[1].pk, 4)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(UserScore.objects.get(user=users[1]).score, 4)
+
+
+class EligibilityProfileTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.permission = Permission.objects.get(codename='has_score_permission')
+        cls.group = Group.objects.create(name='scorers')
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='user')
+
+    def profile(self):
+        # Fresh instance, like a new request
+        return get_profile(User.objects.get(pk=self.user.pk))
+
+    def test_profile_is_cached(self):
+        UserScore.change_score(self.user, 10)
+        self.assertEqual(self.profile(), {'perms': frozenset(), 'score': 10})
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            get_profile(user)
+
+    def test_invalidation(self):
+        self.profile()
+        self.user.user_permissions.add(self.permission)
+        self.assertEqual(self.profile()['perms'], {'transaction.has_score_permission'})
+
+        self.user.user_permissions.clear()
+        self.user.groups.add(self.group)
+        self.assertEqual(self.profile()['perms'], frozenset())
+        self.group.permissions.add(self.permission)
+        self.assertEqual(self.profile()['perms'], {'transaction.has_score_permission'})
+
+        UserScore.change_score(self.user, 7)
+        self.assertEqual(self.profile()['score'], 7)
+        UserScore.objects.filter(user=self.user).get().delete()
+        self.assertEqual(self.profile()['score'], 0)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'SQLite serializes writers, row locks are not exercised')
+class ConcurrentScoreTest(TransactionTestCase):
+    THREADS = 8
+    EVENTS = 50
+
+    def add_scores(self, user, buffered):
+        try:
+            if buffered:
+                with ScoreBuffer(max_size=1) as buffer:
+                    for _ in range(self.EVENTS):
+                        buffer.add(user.pk, 1)
+            else:
+                for _ in range(self.EVENTS):
+                    UserScore.change_score(user, 1)
+        finally:
+            connection.close()
+
+    def test_no_lost_updates(self):
+        user = User.objects.create(username='hot')
+        threads = [
+            threading.Thread(target=self.add_scores, args=(user, seed % 2)) for seed in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(UserScore.objects.get(user=user).score, self.THREADS * self.EVENTS)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'SQLite serializes writers, row locks are not exercised')
+class ConcurrentTransferTest(TransactionTestCase):
+    USERS = 5
+    THREADS = 8
+    TRANSFERS = 40
+
+    def setUp(self):
+        self.users = [User.objects.create(username=f'user-{i}') for i in range(self.USERS)]
+        for user in self.users:
+            Transaction.objects.create(user=user, amount=100)
+
+    def run_transfers(self, seed):
+        rnd = random.Random(seed)
+        try:
+            for _ in range(self.TRANSFERS):
+                sender, receiver = rnd.sample(self.users, 2)
+                if rnd.random() < 0.2:
+                    TransferTransaction.bulk_transfer(
+                        [(sender.pk, receiver.pk, rnd.randint(1, 60)), (receiver.pk, sender.pk, rnd.randint(1, 60))]
+                    )
+                else:
+                    TransferTransaction.transfer(sender, receiver, rnd.randint(1, 60))
+        finally:
+            connection.close()
+
+    def test_no_overdraft_under_concurrency(self):
+        threads = [threading.Thread(target=self.run_transfers, args=(seed,)) for seed in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        balances = [Transaction.aggregate_user_balance(user) for user in self.users]
+        self.assertTrue(all(balance >= 0 for balance in balances), balances)
+        self.assertEqual(sum(balances), 100 * self.USERS)
+        self.assertEqual(BalanceLedger.reconcile(), [])
+
+
+class TransactionAdminTest(TestCase):
+    def test_changelist_query_count_is_constant(self):
+        admin = User.objects.create_superuser(username='admin', password='secret', email='admin@gmail.com')
+        self.client.force_login(admin)
+
+        query_counts = []
+        for count in (1, 5):
+            for i in range(count):
+                Transaction.objects.create(user=User.objects.create(username=f'user-{count}-{i}'), amount=100)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get('/admin/transaction/transaction/')
+            self.assertContains(response, 'user-1-0')
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])